@@ -1,3 +1,11 @@
 SERVER_TCP_ADDR = ("127.0.0.1", 1234)
 SERVER_UDP_ADDR = ("127.0.0.1", 4321)
-GLOBAL_CHAT_ID = -1
\ No newline at end of file
+GLOBAL_CHAT_ID = -1
+
+OUTBOX_LIMIT = 1024
+OUTBOX_POLICY = "drop-oldest"
+OUTBOX_HIGH_WATER = 0.8
+SPILL_DIR = "spill"
+STATS_TOP_QUEUES = 50
+STATS_ADMIN_HOSTS = ("127.0.0.1", "::1")
+STATS_DATAGRAM_SIZE = 65507
@@ -0,0 +1 @@
+../Chatroom_v2/metrics.py
\ No newline at end of file
@@ -0,0 +1 @@
+../Chatroom_v2/outbox.py
\ No newline at end of file
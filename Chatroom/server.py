@@ -1,6 +1,5 @@
-from time import sleep
-from queue import Queue
-from threading import Thread
+from threading import Thread, Lock
+from time import perf_counter
 import socket
 import re
 import logging
@@ -8,6 +7,21 @@ import logging
 import numpy
 
 from config import *
+from metrics import Metrics
+from outbox import Outbox
+
+
+class OutboundQueue(Outbox):
+    def __init__(self, owner_id, **kwargs):
+        super().__init__(owner_id, **kwargs)
+        self.discard_spill()
+
+    def dump(self, item):
+        message, sender_id, is_global, queued = item
+        return [[message, int(sender_id), is_global, queued]]
+
+    def load(self, record):
+        return tuple(record)
 
 
 class Client:
@@ -15,9 +29,10 @@ class Client:
         self.id = identifier
         self.addr = addr
         self.socket = socket
-        self.message_queue = Queue()
+        self.message_queue = OutboundQueue(identifier)
         self.name = "Unknown"
         self.active = True
+        self.accepted = perf_counter()
 
     def set_name(self, name):
         self.name = name
@@ -29,7 +44,7 @@ class Client:
         return not self.message_queue.empty()
 
     def enqueue_message(self, message, sender_id, is_global="0"):
-        self.message_queue.put((message, sender_id, is_global))
+        return self.message_queue.put((message, sender_id, is_global, perf_counter()))
 
     def dequeue_message(self):
         return self.message_queue.get()
@@ -37,6 +52,7 @@ class Client:
     def shutdown(self):
         self.active = False
         self.socket.close()
+        self.message_queue.close()
 
 
 class Server:
@@ -45,6 +61,14 @@ class Server:
         self.client_list = {}
         self.client_ids = numpy.random.choice(range(1000, 10000), 100, replace=False)
         self.client_idx = 0
+        self.presence_lock = Lock()
+        self.presence_version = 0
+        self.active_users_reply = b""
+        self.active_users_version = 0
+
+        self.metrics = Metrics()
+        self.metrics.gauge("clients_active", lambda: len(self.client_list))
+        self.metrics.section("queues", self.queue_depths)
 
         self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
         self.socket.bind(tcp_addr)
@@ -63,11 +87,14 @@ class Server:
         while True:
             try:
                 client_socket, addr = self.socket.accept()
+                self.metrics.incr("connections_accepted")
 
                 if len(self.client_list) <= self.max_client:
                     given_id = self.client_ids[self.client_idx]
                     client = Client(given_id, addr, client_socket)
+                    client.message_queue.on_high_water = self.queue_alert
                     self.client_list[given_id] = client
+                    self.presence_changed()
                     self.client_idx = (self.client_idx + 1) % len(self.client_ids)
                     logging.info(f"{client.get_name_id()} entered the server.")
 
@@ -87,36 +114,57 @@ class Server:
                 logging.info("Server turned off.")
                 exit(0)
 
+    def presence_changed(self):
+        with self.presence_lock:
+            self.presence_version += 1
+
     def handle_udp(self):
         while True:
             message, addr = self.udp_socket.recvfrom(1024)
-            if message.decode() == "getactiveusers":
-                activeusers = ""
-                for id in self.client_list:
-                    activeusers += f"ID:{id},NAME:{self.client_list[id].name};"
-                self.udp_socket.sendto(activeusers.encode(), addr)
+            if (message == b"getstats" or message.startswith(b"getstats:")) and addr[0] in STATS_ADMIN_HOSTS:
+                fmt = message[len(b"getstats:"):].decode(errors="replace")
+                self.udp_socket.sendto(self.metrics.render(fmt, STATS_DATAGRAM_SIZE).encode(), addr)
+
+            elif message == b"getactiveusers":
+                if self.active_users_version != self.presence_version:
+                    version = self.presence_version
+                    self.active_users_reply = "".join(f"ID:{id},NAME:{client.name};"
+                                                      for id, client in list(self.client_list.items())).encode()
+                    self.active_users_version = version
+                self.udp_socket.sendto(self.active_users_reply, addr)
 
     def handle_req(self, client: Client):
         client.socket.settimeout(10)
         while client.active:
             try:
-                message = client.socket.recv(2048).decode()
+                data = client.socket.recv(2048)
+                self.metrics.incr("bytes_in", len(data))
+                message = data.decode()
+                started = perf_counter()
+                self.metrics.incr("commands")
 
                 if message == "alive":
                     continue
 
                 elif message == "close":
                     self.client_list.pop(client.id)
+                    self.presence_changed()
                     client.shutdown()
                     logging.info(f"{client.get_name_id()} left the server.")
                     break
 
-                elif (matches := re.match(r"setname:(.+)", message)) is not None:
+                elif (matches := re.fullmatch(r"setname:(\w+)", message)) is not None:
+                    self.metrics.observe("command_parse", perf_counter() - started)
                     client.set_name(matches.groups()[0])
+                    self.presence_changed()
                     logging.info(f"{client.get_name_id()} changed his/her name to: {client.name}.")
 
+                elif message.startswith("setname:"):
+                    self.reply(client, "log:Names may only contain letters, digits and underscores.")
+
                 elif (matches := re.match(r"sendto:(\-?\d+)\smsg:(.+)", message, flags=re.S)) is not None:
                         receiver_id, client_message = matches.groups()
+                        self.metrics.observe("command_parse", perf_counter() - started)
 
                         if int(receiver_id) == GLOBAL_CHAT_ID:
                             self.send_all(client, client_message)
@@ -125,34 +173,72 @@ class Server:
                         target_client = self.client_list[int(receiver_id)]
 
                         if target_client is not None:
-                            target_client.enqueue_message(client_message, client.id)
-                            client.socket.send(f"log:Message sent to {target_client.name}#{target_client.id} successfully.".encode())
+                            self.metrics.incr("messages_routed")
+                            if not target_client.enqueue_message(client_message, client.id):
+                                self.reply(client, f"log:Couldn't deliver to {target_client.name}#{target_client.id}, their inbox is full.")
+                                continue
+                            self.reply(client, f"log:Message sent to {target_client.name}#{target_client.id} successfully.")
                             logging.info(f"{client.get_name_id()} sent a message to: {target_client.name}.")
 
                         else:
-                            client.socket.send("log:Specified user doesn't exist.".encode())
+                            self.reply(client, "log:Specified user doesn't exist.")
+
+                self.metrics.add_busy("requests", perf_counter() - started)
             except socket.error:
                 self.client_list.pop(client.id)
+                self.presence_changed()
                 client.shutdown()
                 logging.info(f"{client.get_name_id()} disconnected.")
                 break
 
+    def queue_alert(self, client_id, depth, limit):
+        logging.warning(f"Outbound queue of client #{client_id} is at {depth} of {limit} messages.")
+
+    def queue_depths(self):
+        stats = {client.get_name_id(): client.message_queue.stats() for client in list(self.client_list.values())}
+        deepest = sorted(stats, key=lambda name: stats[name]["depth"], reverse=True)[:STATS_TOP_QUEUES]
+        return {
+            "total_depth": sum(queue["depth"] for queue in stats.values()),
+            "depth": {name: stats[name]["depth"] for name in deepest},
+            "dropped": {name: stats[name]["dropped"] for name in deepest},
+        }
+
+    def reply(self, client: Client, message):
+        self.metrics.incr("bytes_out", client.socket.send(message.encode()))
+
     def handle_res(self, client: Client):
-        client.socket.send(f"setid:{client.id}".encode())
+        self.reply(client, f"setid:{client.id}")
+        self.metrics.observe("handshake", perf_counter() - client.accepted)
         while client.active:
-            if client.has_incoming_messages():
-                message, sender_id, is_global = client.dequeue_message()
-                sender_name = self.client_list[sender_id].name
-                client.socket.send(f"global:{is_global} msgfrom:{sender_id} name:{sender_name} msg:{message}".encode())
-            else:
-                sleep(2)
+            item = client.dequeue_message()
+            if client.message_queue.overflowed:
+                logging.info(f"{client.get_name_id()} got disconnected for not reading its messages.")
+                client.shutdown()
+                break
+            if item is None:
+                continue
+            message, sender_id, is_global, queued = item
+            sender_name = self.client_list[sender_id].name
+            started = perf_counter()
+            self.reply(client, f"global:{is_global} msgfrom:{sender_id} name:{sender_name} msg:{message}")
+
+            sent = perf_counter()
+            self.metrics.observe("enqueue_to_send", sent - queued)
+            self.metrics.incr("messages_out")
+            self.metrics.add_busy("responses", sent - started)
 
     def send_all(self, client, message):
+        full = []
+        self.metrics.incr("messages_routed")
         for client_id in self.client_list:
             if client_id != client.id:
                 target_client = self.client_list[client_id]
-                target_client.enqueue_message(message, client.id, "1")
-        client.socket.send(f"log:Message sent to all successfully".encode())
+                if not target_client.enqueue_message(message, client.id, "1"):
+                    full.append(target_client.get_name_id())
+        if full:
+            self.reply(client, f"log:Message sent to all except {', '.join(full)}, their inbox is full.")
+        else:
+            self.reply(client, f"log:Message sent to all successfully")
         logging.info(f"{client.get_name_id()} sent a message globally")
 
     def refuse(self, client_socket: socket):
@@ -0,0 +1,387 @@
+from concurrent.futures import TimeoutError as RequestTimeout
+from queue import Queue
+from threading import Thread
+from itertools import count
+from time import monotonic
+import asyncio
+import logging
+import json
+
+from config import *
+from codec import *
+from history_cache import HistoryCache
+from client import Roster, UI, wait_reply
+
+
+class AsyncClient:
+    def __init__(self, name, password, status=STATUS.AVAILABLE, server_tcp_addr=SERVER_TCP_ADDR,
+                 features=SUPPORTED_FEATURES):
+        self.name = name
+        self.password = password
+        self.status = status
+        self.server_addr = server_tcp_addr
+        self.features = features
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.online = False
+        self.framed = False
+        self.tagged = False
+        self.compressor = None
+        self.decoder = None
+        self.session = None
+        self.delivered = 0
+        self.acked = 0
+        self.last_write = 0.0
+        self.tasks = []
+
+        self.request_ids = count(1)
+        self.pending = {}
+        self.inbox = asyncio.Queue()
+        self.on_message = None
+        self.on_log = None
+
+        self.roster = Roster()
+        self.live_roster = False
+        self.roster_ready = asyncio.Event()
+        self.history = None
+
+    async def handshake(self, server_addr):
+        self.decoder = FrameDecoder()
+        self.reader, self.writer = await asyncio.open_connection(*server_addr)
+        enable_keepalive(self.writer.get_extra_info("socket"))
+        features = self.features
+        if self.session is not None:
+            features = [*features, make_session(self.session, self.delivered)]
+        if (await self.reader.read(1024)).decode() == "?name":
+            self.writer.write(make_hello(self.name, features).encode())
+        reply = await self.reader.read(1024)
+        if reply == b"?pass":
+            self.writer.write(self.password.encode())
+            reply = await self.reader.read(1024)
+        reply, pending = split_reply(reply)
+        self.decoder.feed(pending)
+        return reply
+
+    async def open_session(self):
+        try:
+            reply = await self.handshake(self.server_addr)
+            if (redirect := parse_redirect(reply)) is not None:
+                logging.info(f"Redirected to {redirect[0]}:{redirect[1]}.")
+                self.writer.close()
+                reply = await self.handshake(redirect)
+            features = parse_accept(reply)
+            if features is None:
+                self.writer.close()
+                return False
+            self.framed = FEATURE_FRAMED in features
+            self.tagged = FEATURE_RID in features
+            if self.tagged:
+                self.decoder.enable_tagging()
+            self.compressor = None
+            if FEATURE_ZLIB in features:
+                self.compressor = FrameCompressor()
+                self.decoder.enable_decompression()
+        except OSError:
+            return False
+
+        session = parse_session(features)
+        self.session = session[0] if session is not None else None
+        if RESUMED not in features:
+            self.delivered = 0
+            self.acked = 0
+        self.online = True
+        self.last_write = monotonic()
+        return True
+
+    async def recover(self):
+        self.online = False
+        self.writer.close()
+        self.fail_pending()
+        if self.session is None:
+            return False
+
+        for attempt in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(RECONNECT_DELAY * 2 ** attempt)
+            if not self.connected:
+                return False
+            if await self.open_session():
+                logging.info(f"{self.name} reconnected to the server.")
+                if self.live_roster:
+                    self.write(OP.SUBSCRIBE, TOPIC_PRESENCE)
+                return True
+        return False
+
+    async def connect(self):
+        if not await self.open_session():
+            return False
+        self.connected = True
+        self.tasks = [asyncio.create_task(self.read_loop()), asyncio.create_task(self.heartbeat_loop())]
+        return True
+
+    def encode(self, opcode, *fields, rid=None):
+        data = encode(self.framed, opcode, *fields, rid=rid if self.tagged else None)
+        if self.compressor is not None:
+            data = self.compressor.compress_frames(data)
+        return data
+
+    def write(self, opcode, *fields, rid=None):
+        if not self.online:
+            raise ConnectionError("not connected to the server")
+        self.writer.write(self.encode(opcode, *fields, rid=rid))
+        self.last_write = monotonic()
+
+    async def request(self, opcode, *fields, timeout=REQUEST_TIMEOUT):
+        rid = next(self.request_ids)
+        reply_opcode = REPLY_OPCODES.get(opcode)
+        future = None
+        if reply_opcode is not None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[rid] = (reply_opcode, future)
+
+        try:
+            self.write(opcode, *fields, rid=rid)
+            await self.writer.drain()
+            if future is None:
+                return None
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(rid, None)
+
+    async def send(self, receivers, message):
+        return await self.request(OP.SENDTO, ",".join(receivers), message)
+
+    async def conversations(self):
+        return json.loads(await self.request(OP.GETHISTORY))
+
+    async def query_history(self, peer="", since=0, limit=HISTORY_PAGE_SIZE):
+        return json.loads(await self.request(OP.QUERYHISTORY, peer, str(since), str(limit)))
+
+    async def sync_history(self):
+        if self.history is None:
+            self.history = HistoryCache.for_session(self.name, self.server_addr)
+
+        since = self.history.high
+        fetched = 0
+        while True:
+            page = await self.query_history(since=since, limit=HISTORY_PAGE_LIMIT)
+            if page.get("epoch", 0) != self.history.epoch:
+                logging.info(f"History epoch changed to {page.get('epoch', 0)}, resyncing the local cache.")
+                self.history.reset(page.get("epoch", 0))
+                if since != 0:
+                    since = 0
+                    continue
+
+            fetched += self.history.extend(page["messages"])
+            if page["next"] is None:
+                return fetched
+            since = page["next"]
+
+    async def set_status(self, status):
+        self.status = status
+        await self.request(OP.SETSTATUS, status)
+
+    async def subscribe_presence(self):
+        await self.request(OP.SUBSCRIBE, TOPIC_PRESENCE)
+
+    async def join_channel(self, channel):
+        return await self.request(OP.JOIN, channel)
+
+    async def leave_channel(self, channel):
+        return await self.request(OP.LEAVE, channel)
+
+    async def presence(self, timeout=REQUEST_TIMEOUT):
+        if not self.live_roster:
+            await self.subscribe_presence()
+            await asyncio.wait_for(self.roster_ready.wait(), timeout)
+        return self.roster.active_users()
+
+    async def messages(self):
+        while True:
+            message = await self.inbox.get()
+            if message is None:
+                return
+            yield message
+
+    def resolve(self, opcode, fields, rid):
+        if rid is None:
+            rid = next((key for key, (expected, _) in self.pending.items() if expected == opcode), None)
+        _, future = self.pending.pop(rid, (None, None))
+        if future is not None and not future.done():
+            future.set_result(fields[0])
+
+    def handle_response(self, opcode, fields, rid=None):
+        if opcode in REPLY_OPCODES.values():
+            self.resolve(opcode, fields, rid)
+
+        if opcode == OP.LOG and self.on_log is not None:
+            self.on_log(fields[0])
+
+        elif opcode == OP.MSGFROM:
+            if rid is not None:
+                if rid <= self.delivered:
+                    return
+                self.delivered = rid
+            sender_name, received_message = fields
+            if self.on_message is not None:
+                self.on_message(sender_name, received_message)
+            else:
+                self.inbox.put_nowait((sender_name, received_message))
+
+        elif opcode == OP.PRESENCE:
+            self.roster.apply_push(json.loads(fields[0]))
+            self.live_roster = True
+            self.roster_ready.set()
+
+    async def read_loop(self):
+        while True:
+            if self.framed:
+                for opcode, fields in self.decoder.frames():
+                    self.handle_response(opcode, fields, self.decoder.rid)
+                self.acknowledge()
+
+            try:
+                data = await self.reader.read(RECV_SIZE)
+            except OSError:
+                data = b""
+            if data == b"":
+                if self.connected and await self.recover():
+                    continue
+                break
+
+            if self.framed:
+                self.decoder.feed(data)
+            else:
+                self.handle_response(*parse_legacy(data.decode()))
+        self.disconnected()
+
+    def acknowledge(self):
+        if self.delivered > self.acked and self.online:
+            self.acked = self.delivered
+            self.write(OP.ACK, str(self.acked))
+
+    async def heartbeat_loop(self):
+        while self.connected:
+            await asyncio.sleep(max(self.last_write + HEARTBEAT_INTERVAL - monotonic(), RECONNECT_DELAY))
+            if self.online and monotonic() - self.last_write >= HEARTBEAT_INTERVAL:
+                self.write(OP.ALIVE)
+
+    def fail_pending(self):
+        pending, self.pending = self.pending, {}
+        for _, future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("disconnected from the server"))
+
+    def disconnected(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self.online = False
+        self.writer.close()
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+        self.fail_pending()
+        self.inbox.put_nowait(None)
+        if self.history is not None:
+            self.history.close()
+            self.history = None
+
+    async def close(self):
+        if not self.connected:
+            return
+        self.session = None
+        try:
+            self.write(OP.CLOSE)
+            await self.writer.drain()
+        except OSError:
+            pass
+        self.disconnected()
+
+
+class BlockingClient:
+    def __init__(self, name, password, status, server_tcp_addr):
+        self.message_queue = Queue()
+        self.log_queue = Queue()
+
+        self.loop = asyncio.new_event_loop()
+        loop_thread = Thread(target=self.loop.run_forever)
+        loop_thread.daemon = True
+        loop_thread.start()
+
+        self.engine = AsyncClient(name, password, status, server_tcp_addr)
+        self.engine.on_message = lambda sender_name, message: self.message_queue.put((sender_name, message))
+        self.engine.on_log = self.log_queue.put
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    @property
+    def status(self):
+        return self.engine.status
+
+    @property
+    def connected(self):
+        return self.engine.connected
+
+    @property
+    def roster(self):
+        return self.engine.roster
+
+    @property
+    def live_roster(self):
+        return self.engine.live_roster
+
+    @property
+    def history(self):
+        return self.engine.history
+
+    def connect(self):
+        return self.call(self.engine.connect()).result()
+
+    def request(self, opcode, *fields):
+        return self.call(self.engine.request(opcode, *fields))
+
+    def enqueue_command(self, opcode, *fields):
+        return self.request(opcode, *fields)
+
+    def set_status(self, status):
+        return self.call(self.engine.set_status(status))
+
+    def subscribe_presence(self):
+        return self.call(self.engine.subscribe_presence())
+
+    def sync_history(self, timeout=REQUEST_TIMEOUT):
+        return wait_reply(self.call(self.engine.sync_history()), timeout)
+
+    def join_channel(self, channel):
+        return self.call(self.engine.join_channel(channel))
+
+    def leave_channel(self, channel):
+        return self.call(self.engine.leave_channel(channel))
+
+    def has_messages(self, mtype):
+        if mtype == "message":
+            return not self.message_queue.empty()
+        else:
+            return not self.log_queue.empty()
+
+    def dequeue_message(self, mtype):
+        if mtype == "message":
+            return self.message_queue.get()
+        else:
+            return self.log_queue.get()
+
+    def close(self):
+        try:
+            self.call(self.engine.close()).result(REQUEST_TIMEOUT)
+        except (RequestTimeout, OSError):
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    ui = UI(SERVER_UDP_ADDR, client_factory=BlockingClient)
+    ui.main_menu()
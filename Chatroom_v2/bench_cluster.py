@@ -0,0 +1,111 @@
+from time import sleep, perf_counter
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+
+from config import *
+from codec import *
+from cluster import ClusterNode
+from bench_common import BenchClient, summarize
+
+
+def free_port(kind):
+    probe = socket.socket(family=socket.AF_INET, type=kind)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def localhost_nodes(count):
+    return {node_id: {"tcp": ("127.0.0.1", free_port(socket.SOCK_STREAM)),
+                      "udp": ("127.0.0.1", free_port(socket.SOCK_DGRAM)),
+                      "peer": ("127.0.0.1", free_port(socket.SOCK_STREAM))}
+            for node_id in range(count)}
+
+
+def run_node(node_id, nodes):
+    os.chdir(tempfile.mkdtemp(prefix=f"chatroom-node{node_id}-"))
+    ClusterNode(node_id, nodes).start()
+
+
+def spawn_cluster(count):
+    nodes = localhost_nodes(count)
+    processes = [multiprocessing.Process(target=run_node, args=(node_id, nodes), daemon=True)
+                 for node_id in nodes]
+    for process in processes:
+        process.start()
+    sleep(0.5 + CLUSTER_RECONNECT_INTERVAL)
+    return processes, nodes
+
+
+def measure(sender, receiver, count, payload):
+    samples = []
+    for _ in range(count):
+        started = perf_counter()
+        sender.send(OP.SENDTO, receiver.name, payload)
+        receiver.receive(OP.MSGFROM)
+        samples.append(perf_counter() - started)
+        sender.receive(OP.LOG)
+    return summarize(samples)
+
+
+def merged_active_users(nodes):
+    udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    udp_socket.settimeout(2)
+    replies = []
+    for node in nodes.values():
+        udp_socket.sendto(b"getactiveusers", node["udp"])
+        replies.append(sorted(udp_socket.recvfrom(65535)[0].decode().split(";")[:-1]))
+    return replies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure same-node and cross-node delivery latency on a localhost cluster.")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    processes, nodes = spawn_cluster(args.nodes)
+    payload = "x" * args.size
+
+    sender = BenchClient(nodes[0]["tcp"], "sender")
+    local_receiver = BenchClient(nodes[0]["tcp"], "local")
+    remote_receivers = [BenchClient(nodes[node_id]["tcp"], f"remote{node_id}") for node_id in nodes if node_id != 0]
+    sleep(0.2)
+
+    roamer = BenchClient(nodes[len(nodes) - 1]["tcp"], "roamer")
+    roamer.close()
+    sleep(0.2)
+    roamer = BenchClient(nodes[0]["tcp"], "roamer")
+    redirected = roamer.socket.getpeername() == nodes[len(nodes) - 1]["tcp"]
+    roamer.close()
+
+    results = {"same-node": measure(sender, local_receiver, args.count, payload)}
+    for receiver in remote_receivers:
+        results[f"cross-node ({receiver.name})"] = measure(sender, receiver, args.count, payload)
+
+    views = merged_active_users(nodes)
+    consistent = all(view == views[0] for view in views)
+
+    for client in [sender, local_receiver, *remote_receivers]:
+        client.close()
+    for process in processes:
+        process.terminate()
+
+    if args.json:
+        print(json.dumps({"latency": results, "redirected": redirected, "active_users_consistent": consistent}, indent=2))
+    else:
+        print(f"{'path':<22}{'count':>8}{'mean ms':>12}{'p50 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+        for path, result in results.items():
+            print(f"{path:<22}{result['count']:>8}{result['mean_ms']:>12.3f}{result['p50_ms']:>12.3f}"
+                  f"{result['p99_ms']:>12.3f}{result['max_ms']:>12.3f}")
+        print(f"login through node 0 redirected to the owning node: {redirected}")
+        print(f"getactiveusers consistent across {len(nodes)} nodes: {consistent} ({len(views[0])} users)")
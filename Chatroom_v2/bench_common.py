@@ -0,0 +1,103 @@
+from threading import Thread
+from time import sleep, perf_counter
+import os
+import socket
+import multiprocessing
+import tempfile
+
+from codec import *
+
+
+def start_server(server_class, *args, **kwargs):
+    os.chdir(tempfile.mkdtemp(prefix="chatroom-bench-"))
+    server = server_class(("127.0.0.1", 0), ("127.0.0.1", 0), *args, **kwargs)
+    server_thread = Thread(target=server.start)
+    server_thread.daemon = True
+    server_thread.start()
+    sleep(0.2)
+    return server
+
+
+def run_server(server_class, args, kwargs, pipe):
+    os.chdir(tempfile.mkdtemp(prefix="chatroom-bench-"))
+    server = server_class(("127.0.0.1", 0), ("127.0.0.1", 0), *args, **kwargs)
+    pipe.send((server.socket.getsockname(), server.udp_socket.getsockname()))
+    pipe.close()
+    server.start()
+
+
+def spawn_server(server_class, *args, **kwargs):
+    parent_pipe, child_pipe = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_server, args=(server_class, args, kwargs, child_pipe))
+    process.daemon = True
+    process.start()
+    tcp_addr, udp_addr = parent_pipe.recv()
+    sleep(0.2)
+    return process, tcp_addr, udp_addr
+
+
+def percentile(samples, fraction):
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+BENCH_FEATURES = [FEATURE_FRAMED, FEATURE_ZLIB, FEATURE_RID]
+
+
+class BenchClient:
+    def __init__(self, addr, name, password="benchmark", features=BENCH_FEATURES):
+        self.name = name
+        self.decoder = FrameDecoder()
+
+        started = perf_counter()
+        reply = self.handshake(addr, features, password)
+        if (redirect := parse_redirect(reply)) is not None:
+            self.socket.close()
+            reply = self.handshake(redirect, features, password)
+        self.features = parse_accept(reply)
+        self.handshake_time = perf_counter() - started
+        if self.features is None:
+            raise ConnectionRefusedError(f"{name} got rejected")
+        if FEATURE_ZLIB in self.features:
+            self.decoder.enable_decompression()
+
+    def handshake(self, addr, features, password):
+        self.socket = socket.create_connection(addr)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.recv(1024)
+        self.socket.send(make_hello(self.name, features).encode())
+        self.socket.recv(1024)
+        self.socket.send(password.encode())
+        reply, pending = split_reply(self.socket.recv(1024))
+        self.decoder.feed(pending)
+        return reply
+
+    def send(self, opcode, *fields):
+        self.socket.sendall(encode_frame(opcode, *fields))
+
+    def receive(self, opcode=None):
+        while True:
+            for frame_opcode, fields in self.decoder.frames():
+                if opcode is None or frame_opcode == opcode:
+                    return frame_opcode, fields
+            if self.decoder.recv_from(self.socket) == 0:
+                raise ConnectionResetError(f"{self.name} got disconnected")
+
+    def close(self):
+        try:
+            self.send(OP.CLOSE)
+            self.socket.close()
+        except OSError:
+            pass
@@ -0,0 +1,90 @@
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import logging
+
+from codec import *
+from server import Server
+from event_server import EventServer
+from bench_common import spawn_server, summarize
+
+
+SERVERS = {
+    "threaded": Server,
+    "event": EventServer,
+}
+
+
+async def login(addr, name, results):
+    started = perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(*addr)
+        await reader.read(1024)
+        writer.write(make_hello(name, SUPPORTED_FEATURES).encode())
+        await reader.read(1024)
+        writer.write("benchmark".encode())
+        reply = await reader.read(1024)
+    except OSError:
+        results["failed"] += 1
+        return None
+
+    if parse_accept(reply.decode()) is None:
+        results["failed"] += 1
+        writer.close()
+        return None
+    results["samples"].append(perf_counter() - started)
+    return writer
+
+
+async def stall(addr):
+    try:
+        reader, writer = await asyncio.open_connection(*addr)
+        await reader.read(1024)
+        return writer
+    except OSError:
+        return None
+
+
+async def storm(addr, count, silent):
+    results = {"samples": [], "failed": 0}
+    stalled = await asyncio.gather(*[stall(addr) for _ in range(silent)])
+
+    started = perf_counter()
+    writers = await asyncio.gather(*[login(addr, f"storm{i}", results) for i in range(count)])
+    elapsed = perf_counter() - started
+
+    for writer in writers + stalled:
+        if writer is not None:
+            writer.close()
+
+    report = summarize(results["samples"])
+    report["failed"] = results["failed"]
+    report["silent_clients"] = silent
+    report["elapsed_s"] = elapsed
+    report["logins_per_s"] = len(results["samples"]) / elapsed if elapsed else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open many simultaneous logins against a chat server.")
+    parser.add_argument("--modes", default="threaded,event")
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--silent", type=int, default=10, help="connections that never answer ?name")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {}
+    for mode in args.modes.split(","):
+        process, tcp_addr, _ = spawn_server(SERVERS[mode], args.count + args.silent + 1)
+        results[mode] = asyncio.run(storm(tcp_addr, args.count, args.silent))
+        process.terminate()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<10}{'logins':>8}{'failed':>8}{'logins/s':>12}{'p50 ms':>12}{'p99 ms':>12}")
+        for mode, result in results.items():
+            print(f"{mode:<10}{result['count']:>8}{result['failed']:>8}{result['logins_per_s']:>12.1f}"
+                  f"{result['p50_ms']:>12.3f}{result['p99_ms']:>12.3f}")
@@ -0,0 +1,70 @@
+from time import sleep, perf_counter
+import argparse
+import json
+import logging
+
+from codec import *
+from server import Server
+from event_server import EventServer
+from bench_common import BenchClient, start_server, summarize
+
+
+class PollingServer(Server):
+    def handle_res(self, client):
+        while client.active:
+            if client.has_incoming_messages():
+                envelope = client.dequeue_message()
+                if envelope is not None:
+                    client.socket.sendall(envelope.encode(client.framed))
+            else:
+                sleep(2)
+
+
+SERVERS = {
+    "polling": PollingServer,
+    "threaded": Server,
+    "event": EventServer,
+}
+
+
+def measure(server_class, count, payload):
+    server = start_server(server_class)
+    addr = server.socket.getsockname()
+    sender = BenchClient(addr, "sender")
+    receiver = BenchClient(addr, "receiver")
+
+    samples = []
+    for _ in range(count):
+        started = perf_counter()
+        sender.send(OP.SENDTO, receiver.name, payload)
+        receiver.receive(OP.MSGFROM)
+        samples.append(perf_counter() - started)
+        sender.receive(OP.LOG)
+
+    sender.close()
+    receiver.close()
+    return summarize(samples)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure sendto -> msgfrom delivery latency on localhost.")
+    parser.add_argument("--modes", default="polling,threaded,event")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--polling-count", type=int, default=10)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {}
+    for mode in args.modes.split(","):
+        count = args.polling_count if mode == "polling" else args.count
+        results[mode] = measure(SERVERS[mode], count, "x" * args.size)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<10}{'count':>8}{'mean ms':>12}{'p50 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+        for mode, result in results.items():
+            print(f"{mode:<10}{result['count']:>8}{result['mean_ms']:>12.3f}{result['p50_ms']:>12.3f}"
+                  f"{result['p99_ms']:>12.3f}{result['max_ms']:>12.3f}")
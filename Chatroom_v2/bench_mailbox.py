@@ -0,0 +1,76 @@
+from threading import Thread
+from time import sleep, perf_counter
+import argparse
+import json
+import logging
+
+from codec import *
+from server import Server
+from event_server import EventServer
+from bench_common import BenchClient, start_server
+
+
+SERVERS = {
+    "threaded": Server,
+    "event": EventServer,
+}
+
+
+def measure(server_class, count, payload):
+    server = start_server(server_class)
+    addr = server.socket.getsockname()
+    BenchClient(addr, "offline").close()
+    sender = BenchClient(addr, "sender")
+    sleep(0.1)
+
+    def drain_logs():
+        for _ in range(count):
+            sender.receive(OP.LOG)
+
+    log_thread = Thread(target=drain_logs)
+    log_thread.start()
+    started = perf_counter()
+    for _ in range(count):
+        sender.send(OP.SENDTO, "offline", payload)
+    log_thread.join()
+    store_time = perf_counter() - started
+    server.mailbox.sync()
+    stored = server.mailbox.stats()
+
+    started = perf_counter()
+    receiver = BenchClient(addr, "offline")
+    for _ in range(count):
+        receiver.receive(OP.MSGFROM)
+    replay_time = perf_counter() - started
+
+    sender.close()
+    receiver.close()
+    return {
+        "messages": count,
+        "mailbox_bytes": stored["bytes"],
+        "mailbox_messages": stored["messages"],
+        "store_msgs_per_s": count / store_time,
+        "replay_seconds": replay_time,
+        "replay_msgs_per_s": count / replay_time,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure mailbox size and replay throughput for an offline user.")
+    parser.add_argument("--modes", default="threaded,event")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {mode: measure(SERVERS[mode], args.count, "x" * args.size) for mode in args.modes.split(",")}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<10}{'messages':>10}{'box KiB':>10}{'store/s':>12}{'replay s':>10}{'replay/s':>12}")
+        for mode, result in results.items():
+            print(f"{mode:<10}{result['messages']:>10}{result['mailbox_bytes'] / 1024:>10.0f}"
+                  f"{result['store_msgs_per_s']:>12.0f}{result['replay_seconds']:>10.3f}"
+                  f"{result['replay_msgs_per_s']:>12.0f}")
@@ -0,0 +1,89 @@
+from threading import Thread
+from time import sleep, perf_counter
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+from codec import *
+from sharded import ShardedServer
+from bench_common import BenchClient, run_server
+
+
+def spawn_sharded(workers):
+    parent_pipe, child_pipe = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_server, args=(ShardedServer, (), {"workers": workers}, child_pipe))
+    process.start()
+    tcp_addr, _ = parent_pipe.recv()
+    sleep(0.5)
+    return process, tcp_addr
+
+
+def run_pair(addr, pair, count, payload, ready, results):
+    sender = BenchClient(addr, f"sender{pair}")
+    receiver = BenchClient(addr, f"receiver{pair}")
+    ready.wait()
+
+    def drain_logs():
+        for _ in range(count):
+            sender.receive(OP.LOG)
+
+    log_thread = Thread(target=drain_logs)
+    log_thread.daemon = True
+    log_thread.start()
+
+    started = perf_counter()
+    for _ in range(count):
+        sender.send(OP.SENDTO, receiver.name, payload)
+    for _ in range(count):
+        receiver.receive(OP.MSGFROM)
+    results.put((started, perf_counter()))
+
+    log_thread.join()
+    sender.close()
+    receiver.close()
+
+
+def measure(workers, pairs, count, payload):
+    process, addr = spawn_sharded(workers)
+    ready = multiprocessing.Barrier(pairs + 1)
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_pair, args=(addr, pair, count, payload, ready, results))
+               for pair in range(pairs)]
+    for client in clients:
+        client.start()
+    ready.wait()
+
+    spans = [results.get() for _ in clients]
+    for client in clients:
+        client.join()
+    process.terminate()
+    process.join()
+
+    elapsed = max(end for _, end in spans) - min(start for start, _ in spans)
+    return {"messages": pairs * count, "seconds": elapsed, "msgs_per_s": pairs * count / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure sendto throughput of the sharded server per worker count.")
+    parser.add_argument("--workers", default=",".join(str(count) for count in range(1, (os.cpu_count() or 1) + 1)))
+    parser.add_argument("--pairs", type=int, default=8)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {}
+    for workers in [int(count) for count in args.workers.split(",")]:
+        results[workers] = measure(workers, args.pairs, args.count, "x" * args.size)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'workers':<10}{'messages':>10}{'seconds':>10}{'msgs/s':>12}{'speedup':>10}")
+        baseline = next(iter(results.values()))["msgs_per_s"]
+        for workers, result in results.items():
+            print(f"{workers:<10}{result['messages']:>10}{result['seconds']:>10.2f}"
+                  f"{result['msgs_per_s']:>12.0f}{result['msgs_per_s'] / baseline:>10.2f}")
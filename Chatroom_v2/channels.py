@@ -0,0 +1,126 @@
+from threading import Lock
+import os
+import re
+import json
+import fcntl
+
+from config import *
+
+
+CHANNEL_PREFIX = "#"
+CHANNEL_PATTERN = re.compile(r"^#[a-zA-Z0-9_.\-]+$")
+
+
+def is_channel(name):
+    return name.startswith(CHANNEL_PREFIX)
+
+
+def valid_channel(name):
+    return CHANNEL_PATTERN.match(name) is not None and not name.startswith(CHANNEL_PREFIX + ".")
+
+
+def channel_sender(channel, sender_name):
+    return f"{channel}:{sender_name}"
+
+
+class ChannelDirectory:
+    def __init__(self, directory=CHANNELS_DIR):
+        self.directory = directory
+        self.lock_path = os.path.join(directory, ".lock")
+        self.lock = Lock()
+        self.members = {}
+        self.memberships = {}
+        self.versions = {}
+
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                self.refresh(CHANNEL_PREFIX + name[:-len(".json")])
+
+    def path(self, channel):
+        return os.path.join(self.directory, f"{channel[len(CHANNEL_PREFIX):]}.json")
+
+    def version(self, channel):
+        try:
+            stat = os.stat(self.path(channel))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self, channel, force=False):
+        version = self.version(channel)
+        if not force and self.versions.get(channel) == version:
+            return
+
+        members = frozenset()
+        if version is not None:
+            try:
+                file = open(self.path(channel), "r")
+                members = frozenset(json.loads(file.read())["members"])
+                file.close()
+            except (OSError, ValueError, KeyError):
+                return
+        self.index(channel, members)
+        self.versions[channel] = version
+
+    def index(self, channel, members):
+        for name in self.members.get(channel, frozenset()) - members:
+            self.memberships[name].discard(channel)
+        for name in members:
+            self.memberships.setdefault(name, set()).add(channel)
+        if members:
+            self.members[channel] = members
+        else:
+            self.members.pop(channel, None)
+
+    def save(self, channel, members):
+        path = self.path(channel)
+        if not members:
+            os.remove(path)
+        else:
+            file = open(path + ".tmp", "w")
+            file.write(json.dumps({"members": sorted(members)}))
+            file.close()
+            os.replace(path + ".tmp", path)
+        self.index(channel, members)
+        self.versions[channel] = self.version(channel)
+
+    def members_of(self, channel):
+        if not valid_channel(channel):
+            return None
+        with self.lock:
+            self.refresh(channel)
+            return self.members.get(channel)
+
+    def channels_of(self, name):
+        with self.lock:
+            return sorted(self.memberships.get(name, ()))
+
+    def update(self, channel, name, joining):
+        if not valid_channel(channel):
+            return False
+        with self.lock:
+            lock_file = open(self.lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.refresh(channel, force=True)
+                members = self.members.get(channel, frozenset())
+                if (name in members) == joining:
+                    return False
+                self.save(channel, members | {name} if joining else members - {name})
+                return True
+            finally:
+                lock_file.close()
+
+    def join(self, channel, name):
+        return self.update(channel, name, True)
+
+    def leave(self, channel, name):
+        return self.update(channel, name, False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "channels": len(self.members),
+                "memberships": sum(len(members) for members in self.members.values()),
+            }
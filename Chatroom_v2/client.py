@@ -1,6 +1,8 @@
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+from concurrent.futures import Future, TimeoutError as RequestTimeout
+from itertools import count
 from time import sleep
-from queue import Queue
-from threading import Thread
 import socket
 import re
 import logging
@@ -8,6 +10,17 @@ import json
 from datetime import datetime
 
 from config import *
+from codec import *
+from history_cache import HistoryCache
+from channels import CHANNEL_PATTERN, is_channel
+
+
+def wait_reply(request, timeout=REQUEST_TIMEOUT):
+    try:
+        return request.result(timeout)
+    except RequestTimeout:
+        request.cancel()
+        raise
 
 
 class Client:
@@ -17,17 +30,67 @@ class Client:
         self.status = status
         self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
         self.sever_addr = server_tcp_addr
+        self.connected = False
+        self.online = Event()
+        self.framed = False
+        self.tagged = False
+        self.compressor = None
+        self.session = None
+        self.delivered = 0
+        self.acked = 0
 
         self.command_queue = Queue()
         self.message_queue = Queue()
         self.log_queue = Queue()
-        self.history_queue = Queue()
 
-    def enqueue_command(self, command):
-        self.command_queue.put(command)
+        self.request_ids = count(1)
+        self.pending = {}
+        self.pending_lock = Lock()
+
+        self.roster = Roster()
+        self.live_roster = False
+        self.history = None
+
+    def enqueue_command(self, opcode, *fields):
+        return self.request(opcode, *fields)
+
+    def request(self, opcode, *fields):
+        future = Future()
+        if not self.connected:
+            future.set_exception(ConnectionError("not connected to the server"))
+            return future
+        with self.pending_lock:
+            rid = next(self.request_ids)
+            if opcode in REPLY_OPCODES:
+                self.pending[rid] = (REPLY_OPCODES[opcode], future)
+                future.add_done_callback(lambda _, rid=rid: self.forget(rid))
+        self.command_queue.put((opcode, fields, rid, future))
+        return future
+
+    def forget(self, rid):
+        with self.pending_lock:
+            self.pending.pop(rid, None)
+
+    def resolve(self, opcode, fields, rid):
+        with self.pending_lock:
+            if rid is None:
+                rid = next((key for key, (expected, _) in self.pending.items() if expected == opcode), None)
+            _, future = self.pending.pop(rid, (None, None))
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(fields[0])
+        return True
+
+    def fail_pending(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for _, future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("disconnected from the server"))
 
-    def dequeue_command(self):
-        return self.command_queue.get()
+    def dequeue_command(self, timeout=None):
+        return self.command_queue.get(timeout=timeout)
 
     def has_command(self):
         return not self.command_queue.empty()
@@ -49,32 +112,83 @@ class Client:
             return not self.message_queue.empty()
         else:
             return not self.log_queue.empty()
-        
-    def enqueue_history(self, history):
-        self.history_queue.put(history)
-
-    def dequeue_history(self):
-        return self.history_queue.get()
-    
-    def has_history(self):
-        return not self.history_queue.empty()
-    
+
     def set_status(self, status):
         self.status = status
-        self.enqueue_command(f"setstatus:{self.status}")
-
-    def connect(self):
+        self.enqueue_command(OP.SETSTATUS, self.status)
+
+    def handshake(self, server_addr):
+        self.decoder = FrameDecoder()
+        self.socket.connect(server_addr)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        enable_keepalive(self.socket)
+        features = SUPPORTED_FEATURES
+        if self.session is not None:
+            features = [*features, make_session(self.session, self.delivered)]
+        if self.socket.recv(1024).decode() == "?name":
+            self.socket.send(make_hello(self.name, features).encode())
+        reply = self.socket.recv(1024)
+        if reply == b"?pass":
+            self.socket.send(self.password.encode())
+            reply = self.socket.recv(1024)
+        reply, pending = split_reply(reply)
+        self.decoder.feed(pending)
+        return reply
+
+    def open_session(self):
         try:
-            self.socket.connect(self.sever_addr)
-            if self.socket.recv(1024).decode() == "?name":
-                self.socket.send(self.name.encode())
-            if self.socket.recv(1024).decode() == "?pass":
-                self.socket.send(self.password.encode())
-            if self.socket.recv(1024).decode() == "reject":
+            reply = self.handshake(self.sever_addr)
+            if (redirect := parse_redirect(reply)) is not None:
+                logging.info(f"Redirected to {redirect[0]}:{redirect[1]}.")
+                self.socket.close()
+                self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+                reply = self.handshake(redirect)
+            features = parse_accept(reply)
+            if features is None:
                 return False
+            self.framed = FEATURE_FRAMED in features
+            self.tagged = FEATURE_RID in features
+            if self.tagged:
+                self.decoder.enable_tagging()
+            self.compressor = None
+            if FEATURE_ZLIB in features:
+                self.compressor = FrameCompressor()
+                self.decoder.enable_decompression()
         except socket.error:
             return False
+
+        session = parse_session(features)
+        self.session = session[0] if session is not None else None
+        if RESUMED not in features:
+            self.delivered = 0
+            self.acked = 0
+        return True
+
+    def recover(self):
+        self.online.clear()
+        self.fail_pending()
+        if self.session is None:
+            return False
+
+        for attempt in range(RECONNECT_ATTEMPTS):
+            sleep(RECONNECT_DELAY * 2 ** attempt)
+            if not self.connected:
+                return False
+            self.socket.close()
+            self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+            if self.open_session():
+                logging.info("Reconnected to the server.")
+                if self.live_roster:
+                    self.subscribe_presence()
+                self.online.set()
+                return True
+        return False
+
+    def connect(self):
+        if not self.open_session():
+            return False
         self.connected = True
+        self.online.set()
 
         req_thread = Thread(target=self.handle_req)
         req_thread.daemon = True
@@ -86,64 +200,202 @@ class Client:
 
         return True
 
+    def gather_commands(self):
+        try:
+            commands = [self.dequeue_command(HEARTBEAT_INTERVAL)]
+        except Empty:
+            return [(OP.ALIVE, (), None, None)]
+        while commands[-1] is not None and self.framed and len(commands) < GATHER_LIMIT and self.has_command():
+            commands.append(self.dequeue_command())
+        return commands
+
     def handle_req(self):
-        slept = 0
         while self.connected == True:
-            try:
-                if self.has_command():
-                    command= self.dequeue_command()
-                    self.socket.send(command.encode())
-                    slept = 0
-                else:
-                    sleep(1)
-                    slept += 1
-                
-                if slept > 5:
-                    self.socket.send("alive".encode())
-                    slept = 0
+            commands = self.gather_commands()
+            closing = commands[-1] is None
+            if closing:
+                commands.pop()
 
+            try:
+                self.online.wait()
+                self.socket.sendall(b"".join(self.encode(opcode, *fields, rid=rid)
+                                             for opcode, fields, rid, _ in commands))
             except socket.error:
-                self.close()
+                for _, _, _, future in commands:
+                    if future is not None and not future.done():
+                        future.set_exception(ConnectionError("disconnected from the server"))
+                continue
+
+            for opcode, _, _, future in commands:
+                if future is not None and opcode not in REPLY_OPCODES and not future.done():
+                    future.set_result(None)
+            if closing:
                 return
             
+    def encode(self, opcode, *fields, rid=None):
+        data = encode(self.framed, opcode, *fields, rid=rid if self.tagged else None)
+        if self.compressor is not None:
+            data = self.compressor.compress_frames(data)
+        return data
+
     def handle_res(self):
         while self.connected == True:
             try:
-                message = self.socket.recv(2048).decode()
+                if self.framed:
+                    for opcode, fields in self.decoder.frames():
+                        self.handle_response(opcode, fields, self.decoder.rid)
+                    self.acknowledge()
+                    if self.decoder.recv_from(self.socket) == 0:
+                        raise ConnectionResetError
+                else:
+                    message = self.socket.recv(2048).decode()
+                    self.handle_response(*parse_legacy(message))
             except OSError:
+                if self.connected and self.recover():
+                    continue
                 self.close()
                 return
 
-            if (matches := re.match(r"log:(.+)", message)) is not None:
-                self.enqueue_message("log", None, matches.groups()[0])
-                
-            elif (matches := re.match(r"msgfrom:(.+)\smsg:(.+)", message, flags= re.S)) is not None:
-                sender_name, received_message = matches.groups()
-                self.enqueue_message("message", sender_name, received_message)
+    def acknowledge(self):
+        if self.delivered > self.acked:
+            self.acked = self.delivered
+            self.enqueue_command(OP.ACK, str(self.acked))
+
+    def handle_response(self, opcode, fields, rid=None):
+        if opcode in REPLY_OPCODES.values():
+            self.resolve(opcode, fields, rid)
+
+        if opcode == OP.LOG:
+            self.enqueue_message("log", None, fields[0])
+
+        elif opcode == OP.MSGFROM:
+            if rid is not None:
+                if rid <= self.delivered:
+                    return
+                self.delivered = rid
+            sender_name, received_message = fields
+            self.enqueue_message("message", sender_name, received_message)
+
+        elif opcode == OP.PRESENCE:
+            self.roster.apply_push(json.loads(fields[0]))
+            self.live_roster = True
+
+    def sync_history(self, timeout=REQUEST_TIMEOUT):
+        if self.history is None:
+            self.history = HistoryCache.for_session(self.name, self.sever_addr)
+
+        since = self.history.high
+        fetched = 0
+        while True:
+            request = self.request(OP.QUERYHISTORY, "", str(since), str(HISTORY_PAGE_LIMIT))
+            page = json.loads(wait_reply(request, timeout))
+            if page.get("epoch", 0) != self.history.epoch:
+                logging.info(f"History epoch changed to {page.get('epoch', 0)}, resyncing the local cache.")
+                self.history.reset(page.get("epoch", 0))
+                if since != 0:
+                    since = 0
+                    continue
+
+            fetched += self.history.extend(page["messages"])
+            if page["next"] is None:
+                return fetched
+            since = page["next"]
 
-            elif (matches := re.match(r"history:(.+)", message, flags=re.S)) is not None:
-                self.enqueue_history(matches.groups()[0])
+    def subscribe_presence(self):
+        self.enqueue_command(OP.SUBSCRIBE, TOPIC_PRESENCE)
+
+    def join_channel(self, channel):
+        return self.request(OP.JOIN, channel)
+
+    def leave_channel(self, channel):
+        return self.request(OP.LEAVE, channel)
 
     def close(self):
         self.connected = False
+        self.session = None
+        self.online.set()
+        self.command_queue.put(None)
+        self.fail_pending()
+        if self.history is not None:
+            self.history.close()
+            self.history = None
         try:
-            self.socket.send("close".encode())
+            self.socket.sendall(encode(self.framed, OP.CLOSE))
             self.socket.close()
 
         except socket.error:
             pass
 
 
+class Roster:
+    def __init__(self):
+        self.version = 0
+        self.users = {}
+        self.parts = {}
+
+    def apply(self, reply):
+        if reply["type"] == "delta":
+            if reply["from"] != self.version:
+                return False
+            for event in reply["events"]:
+                if event[0] == "+":
+                    self.users[event[1]] = event[2]
+                else:
+                    self.users.pop(event[1], None)
+            self.version = reply["version"]
+            return True
+
+        parts = self.parts.setdefault(reply["version"], {})
+        parts[reply["part"]] = reply["users"]
+        if len(parts) < reply["parts"]:
+            return False
+
+        self.users = {name: status for part in sorted(parts) for name, status in parts[part]}
+        self.version = reply["version"]
+        self.parts = {}
+        return True
+
+    def apply_push(self, reply):
+        if reply["type"] == "snapshot":
+            self.users = {name: status for name, status in reply["users"]}
+        else:
+            for event in reply["events"]:
+                if event[0] == "+":
+                    self.users[event[1]] = event[2]
+                else:
+                    self.users.pop(event[1], None)
+        self.version = max(self.version, reply["version"])
+
+    def active_users(self):
+        return list(self.users)
+
+
 class UI:
-    def __init__(self, server_udp_addr):
+    def __init__(self, server_udp_addr, client_factory=Client):
         self.client = None
+        self.client_factory = client_factory
         self.username = "[UNKNOWN]"
         self.password = None
         
         self.udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self.server_udp_addr = server_udp_addr
+        self.roster = Roster()
 
     def get_active_users(self):
+        if self.client is not None and self.client.live_roster:
+            return self.client.roster.active_users()
+
+        try:
+            self.udp_socket.settimeout(5)
+            self.udp_socket.sendto(f"getpresence:{self.roster.version}".encode(), self.server_udp_addr)
+            while True:
+                data, _ = self.udp_socket.recvfrom(65535)
+                if data.startswith(b"{") and self.roster.apply(json.loads(data)):
+                    return self.roster.active_users()
+        except socket.error:
+            return self.get_active_users_legacy()
+
+    def get_active_users_legacy(self):
         try:
             self.udp_socket.sendto("getactiveusers".encode(), self.server_udp_addr)
             self.udp_socket.settimeout(5)
@@ -169,13 +421,13 @@ class UI:
 
         if len(userlist) == 0:
             print("No active users!")
-            return
-
-        print("[G]: Send a message to everyone")
-        for i in range(len(userlist)):
-            print(f"{i + 1}: {userlist[i]}")
-        print("\nType \'G\' to send a message to everyone in the server")
-        print("Type a list of comma separated numbers (eg. 1,2,3) to select receivers")
+        else:
+            print("[G]: Send a message to everyone")
+            for i in range(len(userlist)):
+                print(f"{i + 1}: {userlist[i]}")
+            print("\nType \'G\' to send a message to everyone in the server")
+            print("Type a list of comma separated numbers (eg. 1,2,3) to select receivers")
+        print("Type a channel name (eg. #general) to send a message to a channel you joined")
         print("Type \'C\' to cancle:")
 
         receivers = None
@@ -184,7 +436,11 @@ class UI:
             if choice == "C":
                 return
 
-            elif choice == "G":
+            elif CHANNEL_PATTERN.match(choice):
+                receivers_names = choice
+                break
+
+            elif choice == "G" and len(userlist) > 0:
                 receivers = list(range(len(userlist)))
                 break
 
@@ -192,7 +448,7 @@ class UI:
                 index_list = choice.split(",")
                 validated = True
                 for index in index_list:
-                    if int(index) > len(userlist):
+                    if int(index) == 0 or int(index) > len(userlist):
                         print("The ID must be within the list!")
                         validated = False
                         break
@@ -221,11 +477,13 @@ class UI:
                 return
         message += f"\n[TIME: {datetime.now()}]"
 
-        receivers_names = userlist[receivers[0]]
-        for i in range(1, len(receivers)):
-            receivers_names += "," + userlist[receivers[i]]
-            
-        self.client.enqueue_command(f"sendto:{receivers_names} msg:{message}")
+        if receivers is not None:
+            receivers_names = userlist[receivers[0]]
+            for i in range(1, len(receivers)):
+                receivers_names += "," + userlist[receivers[i]]
+
+
+        self.client.enqueue_command(OP.SENDTO, receivers_names, message)
 
     def receive_messages(self):
         print("\nMessages\n------------")
@@ -256,22 +514,84 @@ class UI:
     def show_history(self):
         print("\nHistory")
         print("------------")
-        self.client.enqueue_command("gethistory")
-        while not self.client.has_history():
-            pass
+        print("Type a name to only see messages from that user, a channel (eg. #general) to see its messages,"
+              " or press \'enter\' to see everyone:")
+        peer = input(">> ").strip()
+        if is_channel(peer):
+            self.show_channel_history(peer)
+            return
 
-        history = json.loads(self.client.dequeue_history())
+        try:
+            self.client.sync_history()
+        except (RequestTimeout, ConnectionError):
+            print("Server isn't responding right now, showing cached history.\n")
+        if self.client.history is None:
+            return
 
-        if len(history) == 0:
+        records = self.client.history.messages(peer)
+        shown = 0
+        while True:
+            for record in records[shown:shown + HISTORY_PAGE_SIZE]:
+                print(f"{record['peer']}:")
+                for line in record["msg"].split("\n"):
+                    print(f"\t{line}")
+                print("-----\n")
+            shown = min(shown + HISTORY_PAGE_SIZE, len(records))
+
+            if shown == len(records):
+                break
+            if input("Press \'enter\' to load more or type \'C\' to stop: ") == "C":
+                break
+
+        if shown == 0:
             print("No messages here!")
-            return
 
-        for name in history:
-            print(f"{name}:")
-            for message in history[name]:
-                for line in message.split("\n"):
+    def show_channel_history(self, channel):
+        since = 0
+        shown = 0
+        while True:
+            try:
+                request = self.client.request(OP.QUERYHISTORY, channel, str(since), str(HISTORY_PAGE_SIZE))
+                page = json.loads(wait_reply(request))
+            except (RequestTimeout, ConnectionError):
+                print("Server isn't responding right now. Please try again later.\n")
+                return
+
+            for record in page["messages"]:
+                print(f"{record['peer']}:")
+                for line in record["msg"].split("\n"):
                     print(f"\t{line}")
-            print("-----\n")
+                print("-----\n")
+            shown += len(page["messages"])
+
+            if page["next"] is None:
+                break
+            since = page["next"]
+            if input("Press \'enter\' to load more or type \'C\' to stop: ") == "C":
+                break
+
+        if shown == 0:
+            print("No messages here! Make sure you joined the channel.")
+
+    def manage_channels(self):
+        print("\nChannels")
+        print("------------")
+        print("Type \'J #name\' to join a channel, \'L #name\' to leave one or \'C\' to cancle:")
+        while True:
+            choice = input(">> ").strip()
+            if choice == "C":
+                return
+            match = re.match(r"^([JL])\s+(\S+)$", choice)
+            if match is not None and CHANNEL_PATTERN.match(match.group(2)):
+                break
+            print("Invalid channel command! Channel names start with # and contain alphabets, numbers, _, - or dot(.)")
+
+        action, channel = match.groups()
+        request = self.client.join_channel(channel) if action == "J" else self.client.leave_channel(channel)
+        try:
+            print(f"[SERVER]: {wait_reply(request)}")
+        except (RequestTimeout, ConnectionError):
+            print("Server isn't responding right now. Please try again later.")
 
     def set_username(self):
         print("Please enter your name. The name should only contain alphabets, numbers, _, - or dot(.):")
@@ -344,9 +664,10 @@ class UI:
                     print("You didn't set a password, canceling...")
                     continue
 
-                self.client = Client(self.username, self.password, STATUS.AVAILABLE, SERVER_TCP_ADDR)
+                self.client = self.client_factory(self.username, self.password, STATUS.AVAILABLE, SERVER_TCP_ADDR)
                 if self.client.connect():
                     print("You are connected to the server!")
+                    self.client.subscribe_presence()
                     try:
                         self.start_chat()
                     except Exception as e:
@@ -377,7 +698,8 @@ class UI:
                 self.client.has_messages("message") else ""))
             print("[3]. Show history")
             print(f"[4]. Change Status (Currently {self.client.status})")
-            print("[5]. Exit chatroom\n")
+            print("[5]. Join or leave a channel")
+            print("[6]. Exit chatroom\n")
 
             option = -1
             while True:
@@ -386,8 +708,8 @@ class UI:
                     print("Please enter a number")
                     continue
                 option = int(choice)
-                if option < 0 or option > 5:
-                    print("Please choose a number between 0 and 4")
+                if option < 0 or option > 6:
+                    print("Please choose a number between 0 and 6")
                 else:
                     break
 
@@ -412,6 +734,9 @@ class UI:
             elif option == 4:
                 self.change_status()
 
+            elif option == 5:
+                self.manage_channels()
+
             else:
                 self.client.close()
                 self.client = None
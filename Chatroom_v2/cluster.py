@@ -0,0 +1,281 @@
+import selectors
+import socket
+import logging
+import errno
+import hashlib
+import hmac
+import json
+import sys
+import os
+from time import monotonic
+from collections import deque
+
+from config import *
+from codec import *
+from event_server import Connection, EventServer
+
+
+class RoutingTable:
+    def __init__(self, path=CLUSTER_ROUTES):
+        self.path = path
+        self.routes = {}
+
+        try:
+            file = open(self.path, "r")
+            for line in file:
+                try:
+                    name, node = json.loads(line)
+                except ValueError:
+                    break
+                self.routes[name] = node
+            file.close()
+        except OSError:
+            pass
+        self.file = open(self.path, "a")
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get(self, name):
+        return self.routes.get(name)
+
+    def set(self, name, node):
+        if self.routes.get(name) == node:
+            return False
+        self.routes[name] = node
+        self.file.write(json.dumps([name, node]) + "\n")
+        self.file.flush()
+        return True
+
+    def owned_by(self, node):
+        return [name for name, owner in self.routes.items() if owner == node]
+
+    def close(self):
+        self.file.close()
+
+
+class ClusterNode(EventServer):
+    def __init__(self, node_id, nodes=CLUSTER_NODES):
+        node = nodes[node_id]
+        super().__init__(node["tcp"], node["udp"], data_dir=f"node-{node_id}")
+        self.node_id = node_id
+        self.nodes = nodes
+        self.routes = RoutingTable(os.path.join(self.data_dir, CLUSTER_ROUTES))
+        self.peers = {}
+        self.connecting = {}
+        self.backlog = {peer_id: deque(maxlen=CLUSTER_BACKLOG_SIZE) for peer_id in nodes if peer_id != node_id}
+        self.next_connect = 0
+
+        self.fanout.router = self
+        self.presence.listeners.append(self.on_presence)
+
+        self.peer_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        self.peer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.peer_socket.bind(node["peer"])
+
+    def start(self):
+        self.peer_socket.listen(len(self.nodes))
+        self.peer_socket.setblocking(False)
+        self.selector.register(self.peer_socket, selectors.EVENT_READ, self.accept_peer)
+        logging.info(f"Cluster node {self.node_id} knows {len(self.routes)} routes.")
+        super().start()
+
+    def expire_timers(self):
+        super().expire_timers()
+        if monotonic() >= self.next_connect:
+            self.next_connect = monotonic() + CLUSTER_RECONNECT_INTERVAL
+            self.connect_peers()
+
+    def connect_peers(self):
+        for peer_id in self.backlog:
+            if peer_id > self.node_id or peer_id in self.peers:
+                continue
+            pending = self.connecting.get(peer_id)
+            if pending is not None and not pending.closed:
+                continue
+
+            peer_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+            peer_socket.setblocking(False)
+            error = peer_socket.connect_ex(self.nodes[peer_id]["peer"])
+            if error not in (0, errno.EINPROGRESS):
+                peer_socket.close()
+                continue
+
+            conn = self.open_link(peer_socket, self.nodes[peer_id]["peer"])
+            conn.name = peer_id
+            conn.state = "connecting"
+            conn.writing = True
+            self.selector.modify(peer_socket, selectors.EVENT_WRITE, conn)
+            self.idle.schedule(conn, CLUSTER_CONNECT_TIMEOUT)
+            self.connecting[peer_id] = conn
+
+    def finish_connect(self, conn: Connection):
+        self.idle.cancel(conn)
+        del self.connecting[conn.name]
+        if conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self.drop(conn)
+            return
+
+        conn.state = "peer"
+        conn.writing = False
+        self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+        conn.send(encode_frame(ROUTE.NODE, str(self.node_id), self.node_proof(self.node_id)))
+        self.link_up(conn, conn.name)
+
+    def handle_event(self, conn: Connection, mask):
+        if conn.state == "connecting":
+            self.finish_connect(conn)
+            return
+        super().handle_event(conn, mask)
+
+    def node_proof(self, node_id):
+        if CLUSTER_SECRET is None:
+            return ""
+        return hmac.new(CLUSTER_SECRET.encode(), str(node_id).encode(), hashlib.sha256).hexdigest()
+
+    def trusted(self, conn: Connection, fields):
+        node_id, proof = fields
+        if not node_id.isdigit() or int(node_id) not in self.backlog:
+            return False
+        return (conn.addr[0] == self.nodes[int(node_id)]["peer"][0]
+                and hmac.compare_digest(proof, self.node_proof(int(node_id))))
+
+    def accept_peer(self):
+        while True:
+            try:
+                peer_socket, addr = self.peer_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.open_link(peer_socket, addr)
+
+    def open_link(self, peer_socket, addr):
+        peer_socket.setblocking(False)
+        peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(self, peer_socket, addr)
+        conn.state = "peer"
+        conn.decoder = FrameDecoder(max_frame=MAX_ROUTE_FRAME_SIZE)
+        self.connections[peer_socket.fileno()] = conn
+        self.selector.register(peer_socket, selectors.EVENT_READ, conn)
+        return conn
+
+    def link_up(self, conn: Connection, peer_id):
+        conn.name = peer_id
+        self.peers[peer_id] = conn
+        logging.info(f"Cluster node {self.node_id} linked with node {peer_id}.")
+
+        for name in self.routes.owned_by(self.node_id):
+            conn.send(encode_frame(ROUTE.OWNER, name, str(self.node_id)))
+            if name in self.presence:
+                conn.send(encode_frame(ROUTE.PRESENCE, str(self.node_id), name, self.presence.status_of(name)))
+        while self.backlog[peer_id]:
+            conn.send(self.backlog[peer_id].popleft())
+
+    def link_down(self, conn: Connection):
+        peer_id = conn.name
+        if self.peers.get(peer_id) is conn:
+            del self.peers[peer_id]
+            logging.info(f"Cluster node {self.node_id} lost the link to node {peer_id}.")
+            for name in self.routes.owned_by(peer_id):
+                if name in self.presence:
+                    self.presence.apply(name, None)
+        self.drop(conn)
+
+    def send_to_node(self, peer_id, frame):
+        conn = self.peers.get(peer_id)
+        if conn is None:
+            self.backlog[peer_id].append(frame)
+        else:
+            conn.send(frame)
+
+    def is_local(self, name):
+        return self.routes.get(name) in (None, self.node_id)
+
+    def forward(self, sender_name, receiver_names, message):
+        outcomes = {}
+        nodes = {}
+        for receiver_name in receiver_names:
+            nodes.setdefault(self.routes.get(receiver_name), []).append(receiver_name)
+            outcomes[receiver_name] = "busy" if self.presence.status_of(receiver_name) == STATUS.BUSY else "sent"
+
+        for peer_id, names in nodes.items():
+            self.send_to_node(peer_id, encode_frame(ROUTE.DELIVER, str(peer_id), ",".join(names), sender_name, message))
+        return outcomes
+
+    def on_presence(self, name, status, remote):
+        if remote:
+            return
+        frame = encode_frame(ROUTE.PRESENCE, str(self.node_id), name, status or "")
+        for peer_id in self.backlog:
+            self.send_to_node(peer_id, frame)
+
+    def login(self, client_hello, client_password, client_socket):
+        client_name, _ = parse_hello(client_hello)
+        owner = self.routes.get(client_name)
+        if owner is not None and owner != self.node_id:
+            client_socket.send(make_redirect(self.nodes[owner]["tcp"]).encode())
+            logging.info(f"Redirected {client_name} to cluster node {owner}.")
+            return None
+
+        client = super().login(client_hello, client_password, client_socket)
+        if client is not None and self.routes.set(client_name, self.node_id):
+            for peer_id in self.backlog:
+                self.send_to_node(peer_id, encode_frame(ROUTE.OWNER, client_name, str(self.node_id)))
+        return client
+
+    def read_frames(self, conn: Connection):
+        if conn.state != "peer":
+            super().read_frames(conn)
+            return
+
+        try:
+            received = conn.decoder.recv_from(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+
+        if received == 0:
+            self.link_down(conn)
+            return
+        for opcode, fields in conn.decoder.frames():
+            self.handle_peer(conn, opcode, fields)
+            if conn.closed:
+                return
+
+    def handle_peer(self, conn: Connection, opcode, fields):
+        if conn.name is None:
+            if opcode == ROUTE.NODE and self.trusted(conn, fields):
+                self.link_up(conn, int(fields[0]))
+            else:
+                logging.warning(f"Dropped an unauthenticated cluster link from {conn.addr[0]}.")
+                self.drop(conn)
+            return
+
+        if opcode == ROUTE.OWNER:
+            name, node = fields
+            self.routes.set(name, int(node))
+
+        elif opcode == ROUTE.DELIVER:
+            _, receiver_names, sender_name, message = fields
+            self.fanout.deliver(sender_name, receiver_names.split(","), message)
+
+        elif opcode == ROUTE.PRESENCE:
+            _, name, status = fields
+            self.presence.apply(name, status or None)
+
+    def disconnect(self, conn: Connection):
+        if conn.state == "peer":
+            self.link_down(conn)
+        else:
+            super().disconnect(conn)
+
+    def stop(self):
+        self.peer_socket.close()
+        self.routes.close()
+        super().stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    server = ClusterNode(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    server.start()
@@ -0,0 +1,386 @@
+from time import perf_counter
+import socket
+import struct
+import zlib
+import re
+
+
+class OP:
+    ALIVE = 1
+    CLOSE = 2
+    GETHISTORY = 3
+    SETSTATUS = 4
+    SETNAME = 5
+    SENDTO = 6
+    LOG = 7
+    MSGFROM = 8
+    HISTORY = 9
+    QUERYHISTORY = 10
+    HISTORYPAGE = 11
+    SUBSCRIBE = 12
+    PRESENCE = 13
+    ACK = 14
+    JOIN = 15
+    LEAVE = 16
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class ROUTE:
+    REGISTER = 101
+    DELIVER = 102
+    PRESENCE = 103
+    NODE = 104
+    OWNER = 105
+    QUERY = 106
+    REPLY = 107
+
+
+FEATURE_FRAMED = "framed"
+FEATURE_ZLIB = "zlib"
+FEATURE_RID = "rid"
+FEATURE_RESUME = "resume"
+SESSION_PREFIX = "session="
+RESUMED = "resumed"
+TOPIC_PRESENCE = "presence"
+SUPPORTED_FEATURES = [FEATURE_FRAMED, FEATURE_ZLIB, FEATURE_RID, FEATURE_RESUME]
+
+HEADER = struct.Struct("!IB")
+FIELD_SEPARATOR = b"\0"
+RECV_SIZE = 4096
+MAX_FRAME_SIZE = 1 << 20
+MAX_ROUTE_FRAME_SIZE = 16 << 20
+
+COMPRESSED = 0x80
+TAGGED = 0x40
+COMPRESS_THRESHOLD = 512
+COMPRESS_LEVEL = 6
+
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+FIELD_COUNTS = {
+    OP.ALIVE: 0,
+    OP.CLOSE: 0,
+    OP.GETHISTORY: 0,
+    OP.SETSTATUS: 1,
+    OP.SETNAME: 1,
+    OP.SENDTO: 2,
+    OP.LOG: 1,
+    OP.MSGFROM: 2,
+    OP.HISTORY: 1,
+    OP.QUERYHISTORY: 3,
+    OP.HISTORYPAGE: 1,
+    OP.SUBSCRIBE: 1,
+    OP.PRESENCE: 1,
+    OP.ACK: 1,
+    OP.JOIN: 1,
+    OP.LEAVE: 1,
+    ROUTE.REGISTER: 1,
+    ROUTE.DELIVER: 4,
+    ROUTE.PRESENCE: 3,
+    ROUTE.NODE: 2,
+    ROUTE.OWNER: 2,
+    ROUTE.QUERY: 7,
+    ROUTE.REPLY: 4,
+}
+
+REPLY_OPCODES = {
+    OP.GETHISTORY: OP.HISTORY,
+    OP.QUERYHISTORY: OP.HISTORYPAGE,
+    OP.SENDTO: OP.LOG,
+    OP.JOIN: OP.LOG,
+    OP.LEAVE: OP.LOG,
+}
+
+LEGACY_FORMATS = {
+    OP.ALIVE: "alive",
+    OP.CLOSE: "close",
+    OP.GETHISTORY: "gethistory",
+    OP.SETSTATUS: "setstatus:{0}",
+    OP.SETNAME: "setname:{0}",
+    OP.SENDTO: "sendto:{0} msg:{1}",
+    OP.LOG: "log:{0}",
+    OP.MSGFROM: "msgfrom:{0} msg:{1}",
+    OP.HISTORY: "history:{0}",
+    OP.QUERYHISTORY: "queryhistory:{0} since:{1} limit:{2}",
+    OP.HISTORYPAGE: "historypage:{0}",
+    OP.SUBSCRIBE: "subscribe:{0}",
+    OP.PRESENCE: "presence:{0}",
+    OP.JOIN: "join:{0}",
+    OP.LEAVE: "leave:{0}",
+}
+
+LEGACY_PATTERNS = [
+    (OP.SETSTATUS, re.compile(r"setstatus:(Available|Busy)")),
+    (OP.SETNAME, re.compile(r"setname:(.+)")),
+    (OP.SENDTO, re.compile(r"sendto:(.+?)\smsg:(.+)", flags=re.S)),
+    (OP.LOG, re.compile(r"log:(.+)", flags=re.S)),
+    (OP.MSGFROM, re.compile(r"msgfrom:(.+?)\smsg:(.+)", flags=re.S)),
+    (OP.HISTORY, re.compile(r"history:(.+)", flags=re.S)),
+    (OP.QUERYHISTORY, re.compile(r"queryhistory:(\S*) since:(\d+) limit:(\d+)")),
+    (OP.HISTORYPAGE, re.compile(r"historypage:(.+)", flags=re.S)),
+    (OP.SUBSCRIBE, re.compile(r"subscribe:(\w+)")),
+    (OP.PRESENCE, re.compile(r"presence:(.+)", flags=re.S)),
+    (OP.JOIN, re.compile(r"join:(\S+)")),
+    (OP.LEAVE, re.compile(r"leave:(\S+)")),
+]
+
+LEGACY_KEYWORDS = {
+    "alive": OP.ALIVE,
+    "close": OP.CLOSE,
+    "gethistory": OP.GETHISTORY,
+}
+
+
+def parse_hello(hello: str):
+    name, *features = hello.split("|")
+    features = [feature for feature in features if feature in SUPPORTED_FEATURES]
+    if FEATURE_FRAMED not in features:
+        features = [feature for feature in features if feature not in (FEATURE_ZLIB, FEATURE_RID)]
+    if FEATURE_RID not in features and FEATURE_RESUME in features:
+        features.remove(FEATURE_RESUME)
+    return name, features
+
+
+def make_hello(name: str, features):
+    return "|".join([name, *features])
+
+
+def parse_accept(reply: str):
+    status, *features = reply.split("|")
+    if status != "accept":
+        return None
+    return features
+
+
+def make_accept(features):
+    return "|".join(["accept", *features])
+
+
+def make_session(token, ack=None):
+    if ack is None:
+        return SESSION_PREFIX + token
+    return f"{SESSION_PREFIX}{token}:{ack}"
+
+
+def parse_session(fields):
+    for field in fields:
+        if field.startswith(SESSION_PREFIX):
+            token, _, ack = field[len(SESSION_PREFIX):].partition(":")
+            try:
+                return token, int(ack or 0)
+            except ValueError:
+                return None
+    return None
+
+
+def split_reply(data: bytes):
+    end = data.find(FIELD_SEPARATOR)
+    if end == -1:
+        return data.decode(), b""
+    return data[:end].decode(), data[end:]
+
+
+def make_redirect(addr):
+    return f"redirect|{addr[0]}:{addr[1]}"
+
+
+def parse_redirect(reply: str):
+    status, _, addr = reply.partition("|")
+    if status != "redirect":
+        return None
+    host, _, port = addr.rpartition(":")
+    return host, int(port)
+
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+def encode_frame(opcode, *fields):
+    payload = FIELD_SEPARATOR.join(field.encode() if isinstance(field, str) else field for field in fields)
+    return HEADER.pack(len(payload), opcode) + payload
+
+
+def encode_tagged(rid, opcode, *fields):
+    return encode_frame(opcode | TAGGED, str(rid), *fields)
+
+
+def tag_frame(rid, frame):
+    length, opcode = HEADER.unpack_from(frame)
+    prefix = str(rid).encode() + FIELD_SEPARATOR
+    return HEADER.pack(length + len(prefix), opcode | TAGGED) + prefix + frame[HEADER.size:]
+
+
+def decode_fields(opcode, payload: bytes):
+    count = FIELD_COUNTS.get(opcode, 1)
+    if count == 0:
+        if payload:
+            raise ProtocolError(f"opcode {opcode} takes no fields")
+        return []
+    fields = payload.split(FIELD_SEPARATOR, count - 1)
+    if len(fields) != count:
+        raise ProtocolError(f"opcode {opcode} takes {count} field(s), got {len(fields)}")
+    try:
+        return [field.decode() for field in fields]
+    except UnicodeDecodeError as error:
+        raise ProtocolError(f"opcode {opcode} has a field that isn't UTF-8") from error
+
+
+def parse_number(field):
+    try:
+        return int(field)
+    except ValueError:
+        raise ProtocolError(f"expected a number, got {field[:32]!r}") from None
+
+
+def encode_legacy(opcode, *fields):
+    return LEGACY_FORMATS[opcode].format(*fields).encode()
+
+
+def encode(framed, opcode, *fields, rid=None):
+    if framed and rid is not None:
+        return encode_tagged(rid, opcode, *fields)
+    if framed:
+        return encode_frame(opcode, *fields)
+    return encode_legacy(opcode, *fields)
+
+
+def parse_legacy(message: str):
+    opcode = LEGACY_KEYWORDS.get(message)
+    if opcode is not None:
+        return opcode, []
+
+    for opcode, pattern in LEGACY_PATTERNS:
+        if (matches := pattern.match(message)) is not None:
+            return opcode, list(matches.groups())
+    return None, []
+
+
+class FrameCompressor:
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.compressor = zlib.compressobj(level)
+        self.on_compress = None
+
+    def compress_frames(self, data):
+        if len(data) < HEADER.size + self.threshold:
+            return data
+
+        parts = []
+        offset = 0
+        with memoryview(data) as view:
+            while offset < len(data):
+                length, opcode = HEADER.unpack_from(data, offset)
+                end = offset + HEADER.size + length
+                if length < self.threshold:
+                    parts.append(view[offset:end].tobytes())
+                else:
+                    started = perf_counter()
+                    payload = self.compressor.compress(view[offset + HEADER.size:end])
+                    payload += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+                    parts.append(HEADER.pack(len(payload), opcode | COMPRESSED) + payload)
+                    if self.on_compress is not None:
+                        self.on_compress(length, len(payload), perf_counter() - started)
+                offset = end
+        return b"".join(parts)
+
+
+class FrameDecoder:
+    def __init__(self, size=RECV_SIZE, max_frame=None):
+        self.size = size
+        self.max_frame = max_frame
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.decompressor = None
+        self.on_decompress = None
+        self.tagged = False
+        self.rid = None
+
+    def enable_decompression(self):
+        self.decompressor = zlib.decompressobj()
+
+    def enable_tagging(self):
+        self.tagged = True
+
+    def reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+
+        pending = self.end - self.start
+        if self.start > 0:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+        missing = size - (len(self.buffer) - self.end)
+        if missing > 0:
+            self.buffer.extend(bytes(max(missing, len(self.buffer))))
+
+    def recv_from(self, sock, size=RECV_SIZE):
+        self.reserve(size)
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        available = self.end - self.start
+        if available < HEADER.size:
+            self.reset()
+            return None
+
+        length, opcode = HEADER.unpack_from(self.buffer, self.start)
+        if self.max_frame is not None and length > self.max_frame:
+            raise ProtocolError(f"frame of {length} bytes is over the {self.max_frame} byte limit")
+        total = HEADER.size + length
+        if available < total:
+            self.reserve(total - available)
+            return None
+
+        with memoryview(self.buffer) as view:
+            payload = view[self.start + HEADER.size:self.start + total].tobytes()
+        self.start += total
+        if opcode & COMPRESSED and self.decompressor is not None:
+            payload, opcode = self.decompress(payload), opcode & ~COMPRESSED
+        self.rid = None
+        if opcode & TAGGED and self.tagged:
+            rid, _, payload = payload.partition(FIELD_SEPARATOR)
+            self.rid, opcode = parse_number(rid), opcode & ~TAGGED
+        return opcode, decode_fields(opcode, payload)
+
+    def decompress(self, payload):
+        started = perf_counter()
+        limit = 0 if self.max_frame is None else self.max_frame + 1
+        data = self.decompressor.decompress(payload, limit)
+        if self.max_frame is not None and len(data) > self.max_frame:
+            raise ProtocolError(f"compressed frame inflates past the {self.max_frame} byte limit")
+        if self.on_decompress is not None:
+            self.on_decompress(len(data), len(payload), perf_counter() - started)
+        return data
+
+    def frames(self):
+        while (frame := self.next_frame()) is not None:
+            yield frame
+
+    def reset(self):
+        if self.start != self.end:
+            return
+        self.start = 0
+        self.end = 0
+        if len(self.buffer) > self.size:
+            self.buffer = bytearray(self.size)
@@ -3,4 +3,72 @@ class STATUS:
     BUSY = "Busy"
 
 SERVER_TCP_ADDR = ("127.0.0.1", 1234)
-SERVER_UDP_ADDR = ("127.0.0.1", 4321)
\ No newline at end of file
+SERVER_UDP_ADDR = ("127.0.0.1", 4321)
+
+EVENT_MAX_CLIENT = 20000
+SHARD_WORKERS = None
+
+LISTEN_BACKLOG = 1024
+HANDSHAKE_TIMEOUT = 5
+HANDSHAKE_WORKERS = 32
+
+IDLE_TIMEOUT = 15
+HEARTBEAT_INTERVAL = 5
+REQUEST_TIMEOUT = 10
+RESUME_WINDOW = 60
+RESUME_TAIL_LIMIT = 1024
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.5
+WHEEL_TICK = 0.5
+WHEEL_SLOTS = 512
+
+GATHER_LIMIT = 64
+REPORT_NAME_LIMIT = 10
+
+HISTORY_DIR = "history"
+HISTORY_SEGMENT_SIZE = 16 * 1024 * 1024
+HISTORY_SYNC_INTERVAL = 0.05
+HISTORY_RETENTION = None
+HISTORY_COMPACT_INTERVAL = 60
+HISTORY_COMPACT_RATIO = 0.5
+HISTORY_OPEN_INDEXES = 256
+HISTORY_PAGE_SIZE = 20
+HISTORY_PAGE_LIMIT = 200
+HISTORY_CACHE_DIR = "history_cache"
+
+CLIENTS_DIR = "clients"
+CHANNELS_DIR = "channels"
+CLIENT_CACHE_SIZE = 10000
+
+OUTBOX_LIMIT = 1024
+OUTBOX_POLICY = "drop-oldest"
+OUTBOX_HIGH_WATER = 0.8
+SPILL_DIR = "spill"
+
+STATS_TOP_QUEUES = 50
+STATS_ADMIN_HOSTS = ("127.0.0.1", "::1")
+STATS_DATAGRAM_SIZE = 65507
+
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP_FUNCTIONS = 50
+PROFILE_ADMIN_HOSTS = ("127.0.0.1", "::1")
+
+MAILBOX_DIR = "mailbox"
+MAILBOX_BATCH = 256
+MAILBOX_OPEN_FILES = 256
+
+PRESENCE_LOG_SIZE = 4096
+PRESENCE_DATAGRAM_SIZE = 1200
+ACTIVE_USERS_DATAGRAM_SIZE = 65507
+PRESENCE_PUSH_INTERVAL = 0.2
+
+CLUSTER_NODES = {
+    0: {"tcp": ("127.0.0.1", 1234), "udp": ("127.0.0.1", 4321), "peer": ("127.0.0.1", 5234)},
+    1: {"tcp": ("127.0.0.1", 1235), "udp": ("127.0.0.1", 4322), "peer": ("127.0.0.1", 5235)},
+}
+CLUSTER_ROUTES = "routes.log"
+CLUSTER_CONNECT_TIMEOUT = 1
+CLUSTER_SECRET = None
+CLUSTER_RECONNECT_INTERVAL = 1
+CLUSTER_BACKLOG_SIZE = 10000
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from threading import RLock
+import os
+import re
+import json
+import logging
+
+from config import *
+
+
+NAME_PATTERN = re.compile(r"^[a-zA-Z0-9_.\-]+$")
+
+
+def valid_name(name):
+    return NAME_PATTERN.match(name) is not None and not name.startswith(".")
+
+
+class ClientDirectory:
+    def __init__(self, client_class, history, directory=CLIENTS_DIR, capacity=CLIENT_CACHE_SIZE, spill_dir=SPILL_DIR):
+        self.client_class = client_class
+        self.history = history
+        self.directory = directory
+        self.spill_dir = spill_dir
+        self.capacity = capacity
+        self.on_message = None
+        self.on_high_water = None
+
+        self.lock = RLock()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.import_legacy("clients_list.json")
+
+    def record_path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def import_legacy(self, path):
+        try:
+            file = open(path, "r")
+            clients = json.loads(file.read())
+            file.close()
+        except (OSError, ValueError):
+            return
+
+        for name in clients:
+            if not os.path.exists(self.record_path(name)):
+                self.write_record(name, {"password": clients[name], "status": STATUS.AVAILABLE})
+        os.replace(path, path + ".imported")
+        logging.info(f"Imported {len(clients)} clients from {path}.")
+
+    def read_record(self, name):
+        try:
+            file = open(self.record_path(name), "r")
+            record = json.loads(file.read())
+            file.close()
+            return record
+        except (OSError, ValueError):
+            return None
+
+    def write_record(self, name, record):
+        path = self.record_path(name)
+        file = open(path + ".tmp", "w")
+        file.write(json.dumps(record))
+        file.close()
+        os.replace(path + ".tmp", path)
+
+    def get(self, name):
+        if not valid_name(name):
+            return None
+
+        with self.lock:
+            client = self.cache.get(name)
+            if client is not None:
+                self.hits += 1
+                self.cache.move_to_end(name)
+                return client
+
+            self.misses += 1
+            record = self.read_record(name)
+            if record is None:
+                return None
+
+            client = self.client_class(name, record["password"], None, self.spill_dir)
+            client.active = False
+            client.status = record.get("status", STATUS.AVAILABLE)
+            client.on_message = self.on_message
+            client.message_queue.on_high_water = self.on_high_water
+            self.history.import_legacy(name, f"{name}_hist.json")
+            self.insert(client)
+            return client
+
+    def register(self, name, password, client_socket):
+        with self.lock:
+            client = self.client_class(name, password, client_socket, self.spill_dir)
+            client.on_message = self.on_message
+            client.message_queue.on_high_water = self.on_high_water
+            self.write_record(name, {"password": password, "status": client.status})
+            self.insert(client)
+            return client
+
+    def insert(self, client):
+        self.cache[client.login] = client
+        self.evict()
+
+    def evictable(self, client):
+        return not client.active and not client.has_pending_messages() and not client.has_session()
+
+    def evict(self):
+        overflow = len(self.cache) - self.capacity
+        if overflow <= 0:
+            return
+
+        for name in list(self.cache)[:-1]:
+            if overflow <= 0:
+                break
+            client = self.cache[name]
+            if self.evictable(client):
+                self.save(name, client)
+                del self.cache[name]
+                self.evictions += 1
+                overflow -= 1
+
+    def save(self, name, client):
+        self.write_record(name, {"password": client.password, "status": client.status})
+
+    def stats(self):
+        with self.lock:
+            return {
+                "cached": len(self.cache),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def queue_stats(self):
+        with self.lock:
+            return {name: client.message_queue.stats() for name, client in self.cache.items()}
+
+    def close(self):
+        with self.lock:
+            for name, client in self.cache.items():
+                self.save(name, client)
@@ -0,0 +1,353 @@
+import selectors
+import socket
+import logging
+import resource
+import threading
+from time import perf_counter
+from collections import deque
+from itertools import islice
+
+from config import *
+from codec import *
+from server import Client, Server
+from fanout import Replay, consume_buffers
+
+
+class Connection:
+    __slots__ = ("server", "sock", "addr", "client", "state", "name", "accepted", "decoder",
+                 "out_buffers", "writing", "closed")
+
+    def __init__(self, server, sock: socket, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.client = None
+        self.state = "name"
+        self.name = None
+        self.accepted = perf_counter()
+        self.decoder = None
+        self.out_buffers = deque()
+        self.writing = False
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def gather_limit(self):
+        return GATHER_LIMIT if self.decoder is not None else 1
+
+    def send(self, data: bytes):
+        if self.closed:
+            raise OSError("Connection is closed")
+        self.out_buffers.append(data)
+        self.server.want_write(self)
+        return len(data)
+
+    sendall = send
+
+    def settimeout(self, timeout):
+        pass
+
+    def shutdown(self, how):
+        self.close()
+
+    def close(self):
+        self.server.drop(self)
+
+
+class EventServer(Server):
+    def __init__(self, tcp_addr, udp_addr, max_client=EVENT_MAX_CLIENT, **kwargs):
+        super().__init__(tcp_addr, udp_addr, max_client, **kwargs)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self.loop_thread = None
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+
+        self.client_list.on_message = self.notify
+
+    def start(self):
+        self.raise_fd_limit()
+        self.install_signals()
+
+        self.socket.listen(LISTEN_BACKLOG)
+        self.socket.setblocking(False)
+        self.udp_socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.udp_socket, selectors.EVENT_READ, self.read_udp)
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.read_wakeup)
+        self.loop_thread = threading.get_ident()
+
+        logging.info("Event server started, Listening to incoming connections.")
+        try:
+            while True:
+                events = self.selector.select(self.idle.tick)
+                started = perf_counter()
+                for key, mask in events:
+                    if isinstance(key.data, Connection):
+                        self.handle_event(key.data, mask)
+                    else:
+                        self.run_callback(key.data)
+                self.expire_timers()
+                self.metrics.add_busy("loop", perf_counter() - started)
+
+        except KeyboardInterrupt:
+            self.stop()
+            exit(0)
+
+    def run_callback(self, callback):
+        try:
+            callback()
+        except Exception:
+            logging.exception(f"Event loop callback {callback.__name__} failed.")
+
+    def raise_fd_limit(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError):
+                logging.info(f"Couldn't raise the open file limit above {soft}.")
+
+    def accept(self):
+        while True:
+            try:
+                client_socket, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            enable_keepalive(client_socket)
+            if len(self.connections) >= self.max_client:
+                client_socket.setblocking(True)
+                self.refuse(client_socket)
+                continue
+
+            conn = Connection(self, client_socket, addr)
+            self.connections[client_socket.fileno()] = conn
+            self.idle.schedule(conn, HANDSHAKE_TIMEOUT)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+            self.metrics.incr("connections_accepted")
+            conn.send("?name".encode())
+
+    def expire_timers(self):
+        for conn in self.idle.expired():
+            if conn.closed:
+                continue
+            if conn.state == "active":
+                logging.info(f"{conn.client.name} was idle for {IDLE_TIMEOUT}s, closing the connection.")
+                self.disconnect(conn)
+            else:
+                logging.info(f"A client didn't finish the handshake in time. Address: {conn.addr}")
+                self.drop(conn)
+
+    def read_udp(self):
+        while True:
+            try:
+                message, addr = self.udp_socket.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self.handle_udp_request(message, addr)
+            except OSError as error:
+                logging.info(f"Couldn't answer a UDP request from {addr}: {error}")
+
+    def handle_event(self, conn: Connection, mask):
+        if conn.closed:
+            return
+
+        try:
+            if mask & selectors.EVENT_READ:
+                if conn.decoder is not None:
+                    self.read_frames(conn)
+                else:
+                    self.read_message(conn)
+
+            if mask & selectors.EVENT_WRITE and not conn.closed:
+                self.flush(conn)
+        except Exception:
+            logging.exception(f"Dropping a connection after an error. Address: {conn.addr}")
+            if not conn.closed:
+                self.disconnect(conn)
+
+    def read_message(self, conn: Connection):
+        try:
+            data = conn.sock.recv(2048)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if data == b"":
+            self.disconnect(conn)
+        else:
+            if conn.client is not None:
+                self.idle.touch(conn, IDLE_TIMEOUT)
+            self.metrics.incr("bytes_in", len(data))
+            self.handle_data(conn, data.decode(errors="replace"))
+
+    def read_frames(self, conn: Connection):
+        try:
+            received = conn.decoder.recv_from(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+
+        if received == 0:
+            self.disconnect(conn)
+            return
+
+        self.idle.touch(conn, IDLE_TIMEOUT)
+        self.metrics.incr("bytes_in", received)
+        try:
+            for opcode, fields in self.parse_frames(conn.decoder):
+                if conn.client.socket is not conn:
+                    self.drop(conn)
+                    return
+                self.handle_command(conn.client, opcode, fields, conn.decoder.rid)
+                if conn.closed:
+                    return
+        except ProtocolError as error:
+            logging.info(f"{conn.client.name} got disconnected for a malformed command: {error}")
+            self.disconnect(conn)
+
+    def handle_data(self, conn: Connection, message):
+        if conn.state == "name":
+            conn.name = message
+            client = self.resume(message, conn)
+            if client is not None:
+                self.activate(conn, client)
+                return
+            conn.state = "pass"
+            conn.send("?pass".encode())
+
+        elif conn.state == "pass":
+            client = self.login(conn.name, message, conn)
+            if client is None:
+                self.drop(conn)
+                return
+            self.activate(conn, client)
+
+        else:
+            try:
+                self.handle_command(conn.client, *self.parse_message(message))
+            except ProtocolError as error:
+                logging.info(f"{conn.client.name} got disconnected for a malformed command: {error}")
+                self.disconnect(conn)
+
+    def activate(self, conn: Connection, client: Client):
+        conn.client = client
+        conn.state = "active"
+        self.idle.schedule(conn, IDLE_TIMEOUT)
+        self.metrics.observe("handshake", perf_counter() - conn.accepted)
+        if client.framed:
+            conn.decoder = self.new_decoder(client)
+        self.deliver(client)
+
+    def notify(self, client: Client):
+        if threading.get_ident() == self.loop_thread:
+            self.deliver(client)
+            return
+
+        with self.pending_lock:
+            self.pending.add(client)
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def read_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.pending_lock:
+            pending, self.pending = self.pending, set()
+        for client in pending:
+            self.deliver(client)
+
+    def deliver(self, client: Client):
+        if not client.active or client.socket is None:
+            return
+        if client.message_queue.take_overflow():
+            self.logout(client)
+            logging.info(f"{client.name} got disconnected for not reading its messages.")
+            return
+
+        conn = client.socket
+        while len(conn.out_buffers) < GATHER_LIMIT and client.has_incoming_messages():
+            envelope = client.dequeue_message()
+            if isinstance(envelope, Replay):
+                replayed, cursor = self.fanout.take_replay(client)
+                for stored in replayed:
+                    conn.send(client.encode_envelope(stored))
+                self.fanout.replayed(client, cursor)
+            elif envelope is not None:
+                conn.send(client.encode_envelope(envelope))
+                self.metrics.observe("enqueue_to_send", perf_counter() - envelope.created)
+                self.metrics.incr("messages_out")
+
+    def reply(self, client: Client, opcode, *fields, rid=None):
+        client.send_frame(opcode, *fields, rid=rid)
+
+    def want_write(self, conn: Connection):
+        if conn.closed or conn.writing:
+            return
+        conn.writing = True
+        self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+
+    def flush(self, conn: Connection):
+        try:
+            while conn.out_buffers:
+                sent = conn.sock.sendmsg(list(islice(conn.out_buffers, conn.gather_limit())))
+                consume_buffers(conn.out_buffers, sent)
+                self.metrics.incr("bytes_out", sent)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            conn.out_buffers.clear()
+            if not conn.closed:
+                self.disconnect(conn)
+            return
+
+        if not conn.closed:
+            conn.writing = False
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+            if conn.client is not None:
+                self.deliver(conn.client)
+
+    def disconnect(self, conn: Connection):
+        if conn.client is not None and conn.client.active and conn.client.socket is conn:
+            self.logout(conn.client)
+            logging.info(f"{conn.client.name} disconnected.")
+        else:
+            self.drop(conn)
+
+    def drop(self, conn: Connection):
+        if conn.sock is None:
+            return
+        if conn.out_buffers:
+            try:
+                conn.sock.sendmsg(list(islice(conn.out_buffers, conn.gather_limit())))
+            except OSError:
+                pass
+
+        conn.closed = True
+        self.connections.pop(conn.sock.fileno(), None)
+        self.idle.cancel(conn)
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        conn.sock = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    server = EventServer(SERVER_TCP_ADDR, SERVER_UDP_ADDR)
+    server.start()
@@ -0,0 +1,201 @@
+from collections import deque
+from itertools import islice
+from time import perf_counter
+import logging
+
+from config import *
+from codec import *
+from outbox import Outbox
+from channels import is_channel, valid_channel, channel_sender
+
+
+class Envelope:
+    __slots__ = ("opcode", "fields", "encodings", "created")
+
+    def __init__(self, opcode, *fields):
+        self.opcode = opcode
+        self.fields = fields
+        self.encodings = [None, None]
+        self.created = perf_counter()
+
+    def encode(self, framed):
+        data = self.encodings[framed]
+        if data is None:
+            data = encode(framed, self.opcode, *self.fields)
+            self.encodings[framed] = data
+        return data
+
+
+class Batch:
+    __slots__ = ("envelopes", "created")
+
+    def __init__(self, envelopes):
+        self.envelopes = envelopes
+        self.created = perf_counter()
+
+    def encode(self, framed):
+        return b"".join(envelope.encode(framed) for envelope in self.envelopes)
+
+
+class Replay:
+    __slots__ = ("created",)
+
+    def __init__(self):
+        self.created = perf_counter()
+
+
+class EnvelopeOutbox(Outbox):
+    def is_marker(self, envelope):
+        return isinstance(envelope, Replay)
+
+    def dump(self, envelope):
+        return [[item.opcode, *item.fields] for item in getattr(envelope, "envelopes", [envelope])]
+
+    def load(self, record):
+        opcode, *fields = record
+        return Envelope(opcode, *fields)
+
+
+def consume_buffers(buffers: deque, sent):
+    while sent > 0:
+        first = buffers[0]
+        if len(first) <= sent:
+            sent -= len(first)
+            buffers.popleft()
+        else:
+            buffers[0] = memoryview(first)[sent:]
+            sent = 0
+
+
+def send_buffers(sock, buffers, limit=GATHER_LIMIT):
+    buffers = deque(buffers)
+    while buffers:
+        sent = sock.sendmsg(list(islice(buffers, limit)))
+        consume_buffers(buffers, sent)
+
+
+class FanOut:
+    def __init__(self, client_list, history, mailbox, metrics, channels):
+        self.client_list = client_list
+        self.history = history
+        self.mailbox = mailbox
+        self.metrics = metrics
+        self.channels = channels
+        self.router = None
+
+    def send(self, sender, receiver_names, message):
+        receiver_names = list(dict.fromkeys(receiver_names))
+        outcomes = {}
+
+        for channel in [name for name in receiver_names if is_channel(name)]:
+            outcomes[channel] = self.send_channel(sender, channel, message)
+
+        if self.router is not None:
+            remote_names = [name for name in receiver_names
+                            if name not in outcomes and not self.router.is_local(name)]
+            if remote_names:
+                outcomes.update(self.router.forward(sender.name, remote_names, message))
+
+        local_names = [name for name in receiver_names if name not in outcomes]
+        outcomes.update(self.deliver(sender.name, local_names, message))
+
+        sent = [name for name in receiver_names if outcomes[name] == "sent"]
+        busy = [name for name in receiver_names if outcomes[name] == "busy"]
+        missing = [name for name in receiver_names if outcomes[name] == "missing"]
+        full = [name for name in receiver_names if outcomes[name] == "full"]
+        denied = [name for name in receiver_names if outcomes[name] == "denied"]
+        self.metrics.incr("messages_routed", len(receiver_names))
+        if sent:
+            logging.info(f"{sender.name} sent a message to {len(sent)} user(s).")
+        return self.report(sent, busy, missing, full, denied)
+
+    def send_channel(self, sender, channel, message):
+        if not valid_channel(channel):
+            return "missing"
+        members = self.channels.members_of(channel)
+        if members is None:
+            return "missing"
+        if sender.login not in members:
+            return "denied"
+
+        if self.router is not None and not self.router.is_local(channel):
+            self.router.forward(sender.login, [channel], message)
+        else:
+            self.publish(channel, sender.login, message)
+        return "sent"
+
+    def publish(self, channel, sender_name, message):
+        members = self.channels.members_of(channel) or frozenset()
+        composite = channel_sender(channel, sender_name)
+        receiver_names = [name for name in members if name != sender_name]
+        self.metrics.incr("channel_messages")
+        self.metrics.incr("channel_deliveries", len(receiver_names))
+        if self.router is not None:
+            remote_names = [name for name in receiver_names if not self.router.is_local(name)]
+            if remote_names:
+                self.router.forward(composite, remote_names, message)
+                receiver_names = [name for name in receiver_names if self.router.is_local(name)]
+        self.deliver(composite, receiver_names, message)
+        self.history.append(channel, sender_name, message)
+
+    def deliver(self, sender_name, receiver_names, message):
+        record = not is_channel(sender_name)
+        envelope = Envelope(OP.MSGFROM, sender_name, message)
+        outcomes = {}
+
+        for receiver_name in receiver_names:
+            if is_channel(receiver_name) and not valid_channel(receiver_name):
+                outcomes[receiver_name] = "missing"
+                continue
+            if is_channel(receiver_name):
+                self.publish(receiver_name, sender_name, message)
+                outcomes[receiver_name] = "sent"
+                continue
+            receiver_client = self.client_list.get(receiver_name)
+            if receiver_client is None:
+                outcomes[receiver_name] = "missing"
+                continue
+            if not receiver_client.active or receiver_client.status != STATUS.AVAILABLE:
+                self.mailbox.store(receiver_name, sender_name, message)
+                outcomes[receiver_name] = "sent" if receiver_client.status == STATUS.AVAILABLE else "busy"
+            elif not receiver_client.enqueue_message(envelope):
+                outcomes[receiver_name] = "full"
+                continue
+            else:
+                outcomes[receiver_name] = "sent"
+            if record:
+                self.history.append(receiver_name, sender_name, message)
+        return outcomes
+
+    def replay(self, client):
+        if self.mailbox.pending(client.login) > 0:
+            client.enqueue_message(Replay())
+
+    def take_replay(self, client):
+        records, cursor = self.mailbox.peek(client.login, MAILBOX_BATCH)
+        envelopes = [Envelope(OP.MSGFROM, sender_name, message) for sender_name, message in records]
+        return [Batch(envelopes)] if client.framed else envelopes, cursor
+
+    def replayed(self, client, cursor):
+        if cursor is None:
+            return
+        self.mailbox.commit(client.login, cursor)
+        logging.info(f"Replayed {cursor[1]} stored message(s) to {client.login}.")
+        if self.mailbox.pending(client.login) > 0:
+            client.message_queue.put(Replay())
+
+    def report(self, sent, busy, missing, full=(), denied=()):
+        parts = []
+        if len(sent) > REPORT_NAME_LIMIT:
+            parts.append(f"Message sent to {len(sent)} users successfully.")
+        elif sent:
+            parts.append(f"Message sent to {', '.join(sent)} successfully.")
+        if busy:
+            parts.append(f"Busy right now, stored for later: {', '.join(busy)}.")
+        if missing:
+            parts.append(f"Not found: {', '.join(missing)}.")
+        if full:
+            parts.append(f"Not delivered, inbox full: {', '.join(full)}.")
+        if denied:
+            parts.append(f"Not a member of: {', '.join(denied)}.")
+        return " ".join(parts)
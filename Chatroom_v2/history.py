@@ -0,0 +1,426 @@
+from threading import Thread, Lock, Condition
+from time import sleep
+import os
+import json
+import struct
+import logging
+
+from config import *
+
+
+RECORD_HEADER = struct.Struct("!I")
+INDEX_ENTRY = struct.Struct("!QII")
+ALL_PEERS = "@all"
+
+
+class HistoryStore:
+    def __init__(self, directory=HISTORY_DIR, segment_size=HISTORY_SEGMENT_SIZE,
+                 sync_interval=HISTORY_SYNC_INTERVAL, retention=HISTORY_RETENTION):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.retention = retention
+
+        self.lock = Lock()
+        self.synced = Condition(self.lock)
+        self.dirty = set()
+        self.index_files = {}
+        self.read_files = {}
+        self.seq = 0
+        self.synced_seq = 0
+        self.epoch = 0
+        self.generation = 0
+
+        os.makedirs(self.segment_dir(), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, "index"), exist_ok=True)
+        self.load_meta()
+
+        self.segments = sorted(int(name.split(".")[0]) for name in os.listdir(self.segment_dir())
+                               if name.endswith(".log"))
+        if len(self.segments) == 0:
+            self.segments.append(1)
+        self.recover()
+        self.active_number = self.segments[-1]
+        self.active = open(self.segment_path(self.active_number), "ab", buffering=0)
+        self.active_size = self.active.tell()
+
+        flusher = Thread(target=self.flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+        compactor = Thread(target=self.compact_loop)
+        compactor.daemon = True
+        compactor.start()
+
+    def segment_dir(self):
+        return os.path.join(self.directory, "segments")
+
+    def segment_path(self, number):
+        return os.path.join(self.segment_dir(), f"{number:08d}.log")
+
+    def index_path(self, owner, peer):
+        return os.path.join(self.directory, "index", owner, f"{peer}.idx")
+
+    def meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    def load_meta(self):
+        try:
+            file = open(self.meta_path(), "r")
+            self.epoch = json.loads(file.read())["epoch"]
+            file.close()
+        except Exception:
+            self.save_meta()
+
+    def save_meta(self):
+        file = open(self.meta_path() + ".tmp", "w")
+        file.write(json.dumps({"epoch": self.epoch}))
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace(self.meta_path() + ".tmp", self.meta_path())
+
+    def recover(self):
+        for number in reversed(self.segments):
+            path = self.segment_path(number)
+            if not os.path.exists(path):
+                continue
+
+            valid = 0
+            last_seq = None
+            for offset, (record, length) in self.scan_segment(number):
+                valid = offset + RECORD_HEADER.size + length
+                last_seq = record["seq"]
+            if valid != os.path.getsize(path):
+                logging.info(f"Truncating a torn write at the end of history segment {number}.")
+                os.truncate(path, valid)
+
+            if last_seq is not None:
+                self.seq = last_seq
+                break
+        self.synced_seq = self.seq
+
+    def scan_segment(self, number):
+        file = open(self.segment_path(number), "rb")
+        data = file.read()
+        file.close()
+
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            (length,) = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > len(data):
+                break
+            try:
+                record = json.loads(data[offset + RECORD_HEADER.size:end])
+            except ValueError:
+                break
+            yield offset, (record, length)
+            offset = end
+
+    def append(self, owner, peer, message):
+        with self.lock:
+            self.seq += 1
+            body = json.dumps({"seq": self.seq, "owner": owner, "peer": peer, "msg": message}).encode()
+            if self.active_size > 0 and self.active_size + RECORD_HEADER.size + len(body) > self.segment_size:
+                self.roll()
+
+            offset = self.active_size
+            self.active.write(RECORD_HEADER.pack(len(body)) + body)
+            self.active_size += RECORD_HEADER.size + len(body)
+            self.dirty.add(self.active)
+
+            entry = INDEX_ENTRY.pack(self.seq, self.active_number, offset)
+            for index_peer in (peer, ALL_PEERS):
+                index_file = self.open_index(owner, index_peer)
+                index_file.write(entry)
+                self.dirty.add(index_file)
+            return self.seq
+
+    def roll(self):
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        self.dirty.discard(self.active)
+        self.active.close()
+
+        self.active_number += 1
+        self.segments.append(self.active_number)
+        self.active = open(self.segment_path(self.active_number), "ab", buffering=0)
+        self.active_size = 0
+
+    def open_index(self, owner, peer):
+        index_file = self.index_files.get((owner, peer))
+        if index_file is not None:
+            return index_file
+
+        if len(self.index_files) >= HISTORY_OPEN_INDEXES:
+            self.close_index(next(iter(self.index_files)))
+
+        path = self.index_path(owner, peer)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index_file = open(path, "ab", buffering=0)
+        torn = index_file.tell() % INDEX_ENTRY.size
+        if torn:
+            index_file.truncate(index_file.tell() - torn)
+            index_file.seek(0, os.SEEK_END)
+        self.index_files[(owner, peer)] = index_file
+        return index_file
+
+    def close_index(self, key):
+        index_file = self.index_files.pop(key, None)
+        if index_file is None:
+            return
+        if index_file in self.dirty:
+            os.fsync(index_file.fileno())
+            self.dirty.discard(index_file)
+        index_file.close()
+
+    def flush_loop(self):
+        while True:
+            sleep(self.sync_interval)
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            seq = self.seq
+
+        for file in dirty:
+            try:
+                os.fsync(file.fileno())
+            except (ValueError, OSError):
+                pass
+
+        with self.lock:
+            self.synced_seq = max(self.synced_seq, seq)
+            self.synced.notify_all()
+
+    def wait_durable(self, seq, timeout=None):
+        with self.lock:
+            return self.synced.wait_for(lambda: self.synced_seq >= seq, timeout)
+
+    def read_entries(self, owner, peer):
+        try:
+            file = open(self.index_path(owner, peer), "rb")
+        except FileNotFoundError:
+            return []
+        data = file.read()
+        file.close()
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+    def read_record(self, number, offset):
+        fd = self.read_files.get(number)
+        if fd is None:
+            fd = os.open(self.segment_path(number), os.O_RDONLY)
+            self.read_files[number] = fd
+
+        (length,) = RECORD_HEADER.unpack(os.pread(fd, RECORD_HEADER.size, offset))
+        return json.loads(os.pread(fd, length, offset + RECORD_HEADER.size))
+
+    def empty_page(self):
+        return {"messages": [], "next": None, "epoch": self.epoch}
+
+    def query(self, owner, peer=None, since=0, limit=HISTORY_PAGE_SIZE):
+        limit = max(1, min(limit, HISTORY_PAGE_LIMIT))
+        page = self.empty_page()
+
+        with self.lock:
+            try:
+                fd = os.open(self.index_path(owner, peer or ALL_PEERS), os.O_RDONLY)
+            except FileNotFoundError:
+                return page
+
+            try:
+                low, high = 0, os.fstat(fd).st_size // INDEX_ENTRY.size
+                while low < high:
+                    middle = (low + high) // 2
+                    (seq, _, _) = INDEX_ENTRY.unpack(os.pread(fd, INDEX_ENTRY.size, middle * INDEX_ENTRY.size))
+                    if seq <= since:
+                        low = middle + 1
+                    else:
+                        high = middle
+                data = os.pread(fd, (limit + 1) * INDEX_ENTRY.size, low * INDEX_ENTRY.size)
+            finally:
+                os.close(fd)
+
+            entries = list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+            for seq, number, offset in entries[:limit]:
+                record = self.read_record(number, offset)
+                page["messages"].append({"seq": seq, "peer": record["peer"], "msg": record["msg"]})
+
+        if len(entries) > limit:
+            page["next"] = entries[limit - 1][0]
+        return page
+
+    def conversations(self, owner):
+        while True:
+            generation = self.generation
+            entries = self.read_entries(owner, ALL_PEERS)
+            history = {}
+            for start in range(0, len(entries), HISTORY_PAGE_LIMIT):
+                with self.lock:
+                    if self.generation != generation:
+                        break
+                    for _, number, offset in entries[start:start + HISTORY_PAGE_LIMIT]:
+                        record = self.read_record(number, offset)
+                        history.setdefault(record["peer"], []).append(record["msg"])
+            else:
+                return history
+
+    def import_legacy(self, owner, path):
+        try:
+            file = open(path, "r")
+            history = json.loads(file.read())
+            file.close()
+        except (OSError, ValueError):
+            return
+
+        for peer in history:
+            for message in history[peer]:
+                self.append(owner, peer, message)
+        os.replace(path, path + ".imported")
+        logging.info(f"Imported {path} into the history log.")
+
+    def compact_loop(self):
+        while True:
+            sleep(HISTORY_COMPACT_INTERVAL)
+            for number in list(self.segments[:-1]):
+                try:
+                    self.compact_segment(number)
+                except OSError:
+                    logging.exception(f"Couldn't compact history segment {number}.")
+
+    def references(self, owner, peer, number, refs):
+        if (owner, peer) not in refs:
+            refs[(owner, peer)] = {seq for seq, entry_number, _ in self.read_entries(owner, peer)
+                                   if entry_number == number}
+        return refs[(owner, peer)]
+
+    def is_referenced(self, record, number, refs):
+        owner, peer, seq = record["owner"], record["peer"], record["seq"]
+        return (seq in self.references(owner, peer, number, refs) or
+                seq in self.references(owner, ALL_PEERS, number, refs))
+
+    def is_expired(self, record, floors):
+        if self.retention is None:
+            return False
+        return record["seq"] < self.retention_floor(record["owner"], record["peer"], floors)
+
+    def retention_floor(self, owner, peer, floors):
+        if (owner, peer) not in floors:
+            floor = 0
+            path = self.index_path(owner, peer)
+            count = os.path.getsize(path) // INDEX_ENTRY.size if os.path.exists(path) else 0
+            if count > self.retention:
+                file = open(path, "rb")
+                file.seek((count - self.retention) * INDEX_ENTRY.size)
+                floor = INDEX_ENTRY.unpack(file.read(INDEX_ENTRY.size))[0]
+                file.close()
+            floors[(owner, peer)] = floor
+        return floors[(owner, peer)]
+
+    def compact_segment(self, number):
+        with self.lock:
+            if number == self.active_number or number not in self.segments:
+                return
+
+        refs, floors = {}, {}
+        records = list(self.scan_segment(number))
+        referenced = [(offset, record) for offset, (record, _) in records if self.is_referenced(record, number, refs)]
+        live = [(offset, record) for offset, record in referenced if not self.is_expired(record, floors)]
+        if len(records) == 0 or len(live) > len(records) * HISTORY_COMPACT_RATIO:
+            return
+
+        remap = {}
+        path = self.segment_path(number)
+        file = open(path + ".tmp", "wb")
+        for offset, record in live:
+            body = json.dumps(record).encode()
+            remap[offset] = file.tell()
+            file.write(RECORD_HEADER.pack(len(body)) + body)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+
+        owners = {record["owner"] for _, (record, _) in records}
+        conversations = {(record["owner"], record["peer"]) for _, (record, _) in records}
+        for owner in owners:
+            conversations.add((owner, ALL_PEERS))
+        prepared = [(key, self.prepare_index(*key, number, remap)) for key in conversations]
+
+        with self.lock:
+            grown = [key for key, size in prepared if size is not None and self.swap_index(key, size)]
+
+            self.generation += 1
+            fd = self.read_files.pop(number, None)
+            if fd is not None:
+                os.close(fd)
+            if len(live) == 0:
+                os.remove(path + ".tmp")
+                os.remove(path)
+                self.segments.remove(number)
+            else:
+                os.replace(path + ".tmp", path)
+
+            if len(live) < len(referenced):
+                self.epoch += 1
+                self.save_meta()
+
+        for key in grown:
+            fd = os.open(self.index_path(*key), os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        logging.info(f"Compacted history segment {number}: kept {len(live)} of {len(records)} records.")
+
+    def prepare_index(self, owner, peer, number, remap):
+        path = self.index_path(owner, peer)
+        if not os.path.exists(path):
+            return None
+        snapshot = self.read_entries(owner, peer)
+        entries = []
+        for seq, entry_number, offset in snapshot:
+            if entry_number == number:
+                if offset not in remap:
+                    continue
+                offset = remap[offset]
+            entries.append(INDEX_ENTRY.pack(seq, entry_number, offset))
+
+        file = open(path + ".tmp", "wb")
+        file.write(b"".join(entries))
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        return len(snapshot) * INDEX_ENTRY.size
+
+    def swap_index(self, key, size):
+        index_file = self.index_files.pop(key, None)
+        if index_file is not None:
+            self.dirty.discard(index_file)
+            index_file.close()
+        path = self.index_path(*key)
+        try:
+            file = open(path, "rb")
+            file.seek(size)
+            tail = file.read()
+            file.close()
+        except FileNotFoundError:
+            tail = b""
+
+        tail = tail[:len(tail) - len(tail) % INDEX_ENTRY.size]
+        if tail:
+            file = open(path + ".tmp", "ab")
+            file.write(tail)
+            file.close()
+        os.replace(path + ".tmp", path)
+        return len(tail) > 0
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            for key in list(self.index_files):
+                self.close_index(key)
+            self.active.close()
+            for fd in self.read_files.values():
+                os.close(fd)
+            self.read_files = {}
@@ -0,0 +1,86 @@
+from threading import Lock
+import os
+import json
+
+from config import *
+
+
+class HistoryCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.epoch = None
+        self.records = []
+        self.high = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.load()
+        self.file = open(self.path, "a")
+
+    @classmethod
+    def for_session(cls, name, server_addr, directory=HISTORY_CACHE_DIR):
+        host, port = server_addr
+        return cls(os.path.join(directory, f"{host}_{port}", f"{name}.jsonl"))
+
+    def load(self):
+        try:
+            file = open(self.path, "r")
+        except FileNotFoundError:
+            return
+
+        lines = file.read().split("\n")
+        file.close()
+        try:
+            self.epoch = json.loads(lines[0])["epoch"]
+        except (ValueError, KeyError, TypeError):
+            self.rewrite()
+            return
+
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if line != "":
+                    self.rewrite()
+                break
+            if record["seq"] > self.high:
+                self.records.append(record)
+                self.high = record["seq"]
+
+    def rewrite(self):
+        file = open(self.path + ".tmp", "w")
+        file.write(json.dumps({"epoch": self.epoch}) + "\n")
+        for record in self.records:
+            file.write(json.dumps(record) + "\n")
+        file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def reset(self, epoch):
+        with self.lock:
+            self.epoch = epoch
+            self.records = []
+            self.high = 0
+            self.file.close()
+            self.rewrite()
+            self.file = open(self.path, "a")
+
+    def extend(self, records):
+        with self.lock:
+            fresh = [record for record in records if record["seq"] > self.high]
+            if len(fresh) == 0:
+                return 0
+            self.file.write("".join(json.dumps(record) + "\n" for record in fresh))
+            self.file.flush()
+            self.records.extend(fresh)
+            self.high = fresh[-1]["seq"]
+        return len(fresh)
+
+    def messages(self, peer=None):
+        with self.lock:
+            if not peer:
+                return list(self.records)
+            return [record for record in self.records if record["peer"] == peer]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
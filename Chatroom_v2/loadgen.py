@@ -0,0 +1,496 @@
+from collections import deque
+from datetime import datetime, timezone
+from time import sleep, monotonic, monotonic_ns, perf_counter
+import argparse
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import selectors
+import socket
+
+from config import *
+from codec import *
+from metrics import Histogram
+from server import Server
+from event_server import EventServer
+from bench_common import BenchClient, spawn_server
+
+
+SERVERS = {
+    "threaded": Server,
+    "event": EventServer,
+}
+
+MESSAGE = "message"
+REPLY = "reply"
+HISTORY = "history"
+
+SEND = 0
+GET_HISTORY = 1
+CHURN = 2
+HEARTBEAT = 3
+
+PIPELINE_WINDOW = 32
+HEARTBEAT_INTERVAL = 3
+REPLY_TIMEOUT = 5
+DRAIN_TIME = 1
+
+# Chatroom v1 has no framing, so the stream is split in front of each reply and a
+# piece is only complete once it ends with the "." every payload and log ends with.
+V1_REPLY_START = re.compile(r"(?=global:[01] msgfrom:|log:)")
+
+
+class V2Session:
+    window = PIPELINE_WINDOW
+    max_fanout = None
+    history_supported = True
+
+    def __init__(self, addr, name):
+        self.client = BenchClient(addr, name)
+        self.socket = self.client.socket
+        self.address = name
+        self.handshake_time = self.client.handshake_time
+
+    def message(self, addresses, payload):
+        return encode_frame(OP.SENDTO, ",".join(addresses), payload)
+
+    def history(self):
+        return encode_frame(OP.GETHISTORY)
+
+    def heartbeat(self):
+        return encode_frame(OP.ALIVE)
+
+    def goodbye(self):
+        return encode_frame(OP.CLOSE)
+
+    def feed(self, data):
+        self.client.decoder.feed(data)
+        for opcode, fields in self.client.decoder.frames():
+            if opcode == OP.MSGFROM:
+                yield MESSAGE, fields[1]
+            elif opcode == OP.LOG:
+                yield REPLY, fields[0]
+            elif opcode in (OP.HISTORY, OP.HISTORYPAGE):
+                yield HISTORY, None
+
+
+class V1Session:
+    window = 1
+    max_fanout = 1
+    history_supported = False
+
+    def __init__(self, addr, name):
+        started = perf_counter()
+        self.socket = socket.create_connection(addr)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reply = self.socket.recv(1024).decode()
+        if not reply.startswith("setid:"):
+            self.socket.close()
+            raise ConnectionRefusedError(f"{name} got rejected: {reply}")
+        self.address = reply[len("setid:"):]
+        self.handshake_time = perf_counter() - started
+        self.pending = ""
+
+    def message(self, addresses, payload):
+        return f"sendto:{addresses[0]} msg:{payload}".encode()
+
+    def history(self):
+        return b""
+
+    def heartbeat(self):
+        return b"alive"
+
+    def goodbye(self):
+        return b"close"
+
+    def feed(self, data):
+        pieces = V1_REPLY_START.split(self.pending + data.decode(errors="replace"))
+        self.pending = pieces.pop() if not pieces[-1].endswith(".") else ""
+        for piece in pieces:
+            if piece.startswith("global:"):
+                yield MESSAGE, piece.split(" msg:", 1)[-1]
+            elif piece.startswith("log:"):
+                yield REPLY, piece[len("log:"):]
+
+
+PROTOCOLS = {
+    "v1": V1Session,
+    "v2": V2Session,
+}
+
+
+class SimClient:
+    def __init__(self, name):
+        self.name = name
+        self.session = None
+        self.out = bytearray()
+        self.inflight = 0
+        self.history_sent = deque()
+        self.last_sent = 0.0
+        self.last_reply = 0.0
+
+
+class Worker:
+    def __init__(self, worker_id, args):
+        self.args = args
+        self.protocol = PROTOCOLS[args.protocol]
+        self.addr = (args.host, args.port)
+        self.selector = selectors.DefaultSelector()
+        self.clients = [SimClient(f"load{worker_id}-{index}") for index in range(args.clients_per_worker[worker_id])]
+        self.timers = []
+        self.sequence = 0
+        self.window_start = 0.0
+        self.window_end = 0.0
+
+        self.latency = Histogram()
+        self.history_latency = Histogram()
+        self.handshake_latency = Histogram()
+        self.counts = {"sent": 0, "expected": 0, "delivered": 0, "replies": 0, "history": 0, "deferred": 0,
+                       "reconnects": 0, "timeouts": 0, "errors": 0}
+
+    def measuring(self, now):
+        return self.window_start <= now < self.window_end
+
+    def connect(self, client: SimClient):
+        try:
+            client.session = self.protocol(self.addr, client.name)
+        except OSError as error:
+            logging.warning(f"{client.name} couldn't connect: {error}")
+            self.counts["errors"] += 1
+            return False
+        client.session.socket.setblocking(False)
+        client.out.clear()
+        client.inflight = 0
+        client.history_sent.clear()
+        client.last_sent = client.last_reply = monotonic()
+        self.selector.register(client.session.socket, selectors.EVENT_READ, client)
+        self.handshake_latency.record(client.session.handshake_time)
+        return True
+
+    def disconnect(self, client: SimClient, polite=True):
+        if client.session is None:
+            return
+        session, client.session = client.session, None
+        self.selector.unregister(session.socket)
+        try:
+            if polite:
+                session.socket.setblocking(True)
+                session.socket.sendall(session.goodbye())
+            session.socket.close()
+        except OSError:
+            pass
+
+    def schedule(self, delay, kind, client: SimClient):
+        self.sequence += 1
+        heapq.heappush(self.timers, (monotonic() + delay, self.sequence, kind, client))
+
+    def schedule_random(self, rate, kind, client: SimClient):
+        if rate > 0:
+            self.schedule(random.expovariate(rate), kind, client)
+
+    def write(self, client: SimClient, data):
+        if len(data) == 0:
+            return
+        client.out += data
+        client.last_sent = monotonic()
+        self.flush(client)
+
+    def flush(self, client: SimClient):
+        try:
+            sent = client.session.socket.send(client.out)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.lost(client)
+            return
+        del client.out[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.out else 0)
+        self.selector.modify(client.session.socket, events, client)
+
+    def lost(self, client: SimClient):
+        self.counts["errors"] += 1
+        self.disconnect(client, polite=False)
+        self.schedule(1, CHURN, client)
+
+    def read(self, client: SimClient):
+        try:
+            data = client.session.socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if data == b"":
+            self.lost(client)
+            return
+
+        now = monotonic()
+        measuring = self.measuring(now)
+        for kind, body in client.session.feed(data):
+            if kind == MESSAGE:
+                if measuring:
+                    self.counts["delivered"] += 1
+                    sent_at = body.split(" ", 1)[0]
+                    if sent_at.isdigit():
+                        self.latency.record((monotonic_ns() - int(sent_at)) / 1e9)
+                continue
+
+            client.inflight = max(0, client.inflight - 1)
+            client.last_reply = now
+            if kind == HISTORY and client.history_sent:
+                started = client.history_sent.popleft()
+                if measuring:
+                    self.counts["history"] += 1
+                    self.history_latency.record(now - started)
+            elif measuring:
+                self.counts["replies"] += 1
+
+    def fire(self, kind, client: SimClient, now):
+        args = self.args
+        if kind == CHURN:
+            self.disconnect(client)
+            if self.connect(client) and self.measuring(now):
+                self.counts["reconnects"] += 1
+            self.schedule_random(args.churn, CHURN, client)
+            return
+
+        if kind == HEARTBEAT:
+            self.schedule(HEARTBEAT_INTERVAL, HEARTBEAT, client)
+            if client.session is None:
+                return
+            if client.inflight > 0 and now - client.last_reply > REPLY_TIMEOUT:
+                self.counts["timeouts"] += client.inflight
+                client.inflight = 0
+            if client.inflight == 0 and now - client.last_sent >= HEARTBEAT_INTERVAL:
+                self.write(client, client.session.heartbeat())
+            return
+
+        self.schedule_random(args.rate if kind == SEND else args.history_rate, kind, client)
+        if client.session is None or now >= self.window_end:
+            return
+        if client.inflight >= client.session.window:
+            if self.measuring(now):
+                self.counts["deferred"] += 1
+            return
+
+        if client.inflight == 0:
+            client.last_reply = now
+        if kind == GET_HISTORY:
+            client.history_sent.append(now)
+            client.inflight += 1
+            self.write(client, client.session.history())
+            return
+
+        others = [other for other in self.clients if other is not client and other.session is not None]
+        fanout = min(args.fanout, client.session.max_fanout or args.fanout, len(others))
+        if fanout == 0:
+            return
+        targets = random.sample(others, fanout)
+        payload = f"{monotonic_ns()} ".ljust(args.size - 1, "x") + "."
+        client.inflight += 1
+        self.write(client, client.session.message([target.session.address for target in targets], payload))
+        if self.measuring(now):
+            self.counts["sent"] += 1
+            self.counts["expected"] += len(targets)
+
+    def run(self, ready, go):
+        for client in self.clients:
+            self.connect(client)
+        ready.wait()
+        go.wait()
+
+        history_rate = self.args.history_rate if self.protocol.history_supported else 0
+        started = monotonic()
+        self.window_start = started + self.args.warmup
+        self.window_end = self.window_start + self.args.duration
+        for client in self.clients:
+            self.schedule_random(self.args.rate, SEND, client)
+            self.schedule_random(history_rate, GET_HISTORY, client)
+            self.schedule_random(self.args.churn, CHURN, client)
+            self.schedule(random.uniform(0, HEARTBEAT_INTERVAL), HEARTBEAT, client)
+
+        while (now := monotonic()) < self.window_end + DRAIN_TIME:
+            timeout = min(0.05, max(0.0, self.timers[0][0] - now)) if self.timers else 0.05
+            for key, mask in self.selector.select(timeout):
+                client = key.data
+                if client.session is None:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(client)
+                if mask & selectors.EVENT_READ and client.session is not None:
+                    self.read(client)
+
+            now = monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, kind, client = heapq.heappop(self.timers)
+                self.fire(kind, client, now)
+
+        for client in self.clients:
+            self.disconnect(client)
+        return {
+            "counts": self.counts,
+            "latency": self.latency.state(),
+            "history_latency": self.history_latency.state(),
+            "handshake_latency": self.handshake_latency.state(),
+        }
+
+
+def run_worker(worker_id, args, ready, go, pipe):
+    random.seed(args.seed + worker_id)
+    pipe.send(Worker(worker_id, args).run(ready, go))
+    pipe.close()
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def process_usage(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as file:
+            status = dict(line.split(":", 1) for line in file if ":" in line)
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_kib": int(status["VmRSS"].split()[0]),
+        "max_rss_kib": int(status["VmHWM"].split()[0]),
+    }
+
+
+def summarize_histogram(histogram: Histogram):
+    summary = histogram.summary()
+    return {
+        "count": summary["count"],
+        "mean_ms": summary["sum"] / summary["count"] * 1000 if summary["count"] else 0.0,
+        **{f"p{fraction[2:].ljust(2, '0')}_ms": value * 1000 for fraction, value in summary["quantiles"].items()},
+        "max_ms": summary["max"] * 1000,
+    }
+
+
+def run(args):
+    raise_file_limit()
+    server_process = None
+    if args.spawn is not None:
+        server_process, (args.host, args.port), _ = spawn_server(SERVERS[args.spawn],
+                                                                 max_client=args.clients + args.processes)
+        args.server_pid = server_process.pid
+
+    args.clients_per_worker = [args.clients // args.processes + (worker_id < args.clients % args.processes)
+                               for worker_id in range(args.processes)]
+    ready = multiprocessing.Barrier(args.processes + 1)
+    go = multiprocessing.Event()
+    pipes = []
+    workers = []
+    for worker_id in range(args.processes):
+        parent_pipe, child_pipe = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=run_worker, args=(worker_id, args, ready, go, child_pipe))
+        worker.daemon = True
+        worker.start()
+        pipes.append(parent_pipe)
+        workers.append(worker)
+
+    ready.wait()
+    go.set()
+    sleep(args.warmup)
+    server_before = process_usage(args.server_pid) if args.server_pid else None
+    sleep(args.duration)
+    server_after = process_usage(args.server_pid) if args.server_pid else None
+
+    results = [pipe.recv() for pipe in pipes]
+    for worker in workers:
+        worker.join()
+    if server_process is not None:
+        server_process.terminate()
+        server_process.join()
+
+    counts = {}
+    latency, history_latency, handshake_latency = Histogram(), Histogram(), Histogram()
+    for result in results:
+        for name, value in result["counts"].items():
+            counts[name] = counts.get(name, 0) + value
+        latency.merge(result["latency"])
+        history_latency.merge(result["history_latency"])
+        handshake_latency.merge(result["handshake_latency"])
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server = None
+    if server_before is not None and server_after is not None:
+        server = {**server_after, "cpu_seconds": server_after["cpu_seconds"] - server_before["cpu_seconds"]}
+        server["cpu_utilization"] = server["cpu_seconds"] / args.duration
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {name: getattr(args, name) for name in ("protocol", "spawn", "host", "port", "clients", "processes",
+                                                          "rate", "fanout", "size", "history_rate", "churn",
+                                                          "duration", "warmup", "seed")},
+        "counts": counts,
+        "throughput": {
+            "sent_per_s": counts["sent"] / args.duration,
+            "delivered_per_s": counts["delivered"] / args.duration,
+            "delivery_ratio": counts["delivered"] / counts["expected"] if counts["expected"] else 0.0,
+        },
+        "latency": summarize_histogram(latency),
+        "history_latency": summarize_histogram(history_latency),
+        "handshake_latency": summarize_histogram(handshake_latency),
+        "loadgen": {"cpu_seconds": usage.ru_utime + usage.ru_stime, "max_rss_kib": usage.ru_maxrss},
+        "server": server,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive a chat server with simulated clients and report "
+                                                 "throughput, delivery latency and resource usage.")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default="v2")
+    parser.add_argument("--spawn", choices=SERVERS, default=None,
+                        help="start a local Chatroom_v2 server instead of connecting to --host/--port")
+    parser.add_argument("--host", default=SERVER_TCP_ADDR[0])
+    parser.add_argument("--port", type=int, default=SERVER_TCP_ADDR[1])
+    parser.add_argument("--server-pid", type=int, default=None, help="sample CPU and RSS of a running server")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per client")
+    parser.add_argument("--fanout", type=int, default=1, help="receivers per message (v1 sends to one)")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--history-rate", type=float, default=0.0, help="gethistory calls per second per client (v2)")
+    parser.add_argument("--churn", type=float, default=0.0, help="reconnects per second per client")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="append the result as one JSON line to this file")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args)
+
+    if args.output is not None:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        counts, throughput, latency = result["counts"], result["throughput"], result["latency"]
+        print(f"sent {counts['sent']} messages, delivered {counts['delivered']} of {counts['expected']} copies "
+              f"({throughput['delivery_ratio']:.1%}), {counts['deferred']} deferred, {counts['timeouts']} timed out")
+        print(f"throughput: {throughput['sent_per_s']:.0f} sent/s, {throughput['delivered_per_s']:.0f} delivered/s")
+        print(f"{'latency':<12}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+        for name in ("latency", "history_latency", "handshake_latency"):
+            summary = result[name]
+            print(f"{name.split('_')[0]:<12}{summary['count']:>8}{summary['mean_ms']:>10.3f}{summary['p50_ms']:>10.3f}"
+                  f"{summary['p99_ms']:>10.3f}{summary['p999_ms']:>10.3f}{summary['max_ms']:>10.3f}")
+        print(f"loadgen: {result['loadgen']['cpu_seconds']:.2f} s CPU, {result['loadgen']['max_rss_kib']} KiB max RSS")
+        if result["server"] is not None:
+            server = result["server"]
+            print(f"server: {server['cpu_utilization']:.1%} CPU, {server['rss_kib']} KiB RSS "
+                  f"({server['max_rss_kib']} KiB peak)")
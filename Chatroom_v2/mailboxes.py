@@ -0,0 +1,164 @@
+from threading import Thread, Lock
+from time import sleep
+from itertools import islice
+import os
+import json
+import logging
+
+from config import *
+
+
+class Mailbox:
+    def __init__(self, directory=MAILBOX_DIR, sync_interval=HISTORY_SYNC_INTERVAL):
+        self.directory = directory
+        self.sync_interval = sync_interval
+
+        self.lock = Lock()
+        self.files = {}
+        self.dirty = set()
+        self.counts = {}
+        self.offsets = {}
+        self.stored = 0
+        self.replayed = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        flusher = Thread(target=self.flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.box")
+
+    def offset_path(self, name):
+        return os.path.join(self.directory, f"{name}.pos")
+
+    def open_box(self, name):
+        box = self.files.get(name)
+        if box is not None:
+            return box
+
+        if len(self.files) >= MAILBOX_OPEN_FILES:
+            self.close_box(next(iter(self.files)))
+        box = open(self.path(name), "ab", buffering=0)
+        self.files[name] = box
+        return box
+
+    def close_box(self, name):
+        box = self.files.pop(name, None)
+        if box is None:
+            return
+        if box in self.dirty:
+            os.fsync(box.fileno())
+            self.dirty.discard(box)
+        box.close()
+
+    def store(self, name, sender_name, message):
+        with self.lock:
+            count = self.count(name)
+            box = self.open_box(name)
+            box.write(json.dumps([sender_name, message]).encode() + b"\n")
+            self.dirty.add(box)
+            self.counts[name] = count + 1
+            self.stored += 1
+
+    def offset(self, name):
+        if name not in self.offsets:
+            try:
+                file = open(self.offset_path(name), "r")
+                self.offsets[name] = int(file.read())
+                file.close()
+            except (OSError, ValueError):
+                self.offsets[name] = 0
+        return self.offsets[name]
+
+    def count(self, name):
+        if name not in self.counts:
+            try:
+                file = open(self.path(name), "rb")
+                file.seek(self.offset(name))
+                self.counts[name] = sum(1 for _ in file)
+                file.close()
+            except FileNotFoundError:
+                self.counts[name] = 0
+        return self.counts[name]
+
+    def pending(self, name):
+        with self.lock:
+            return self.count(name)
+
+    def peek(self, name, limit=MAILBOX_BATCH):
+        with self.lock:
+            try:
+                file = open(self.path(name), "rb")
+            except FileNotFoundError:
+                return [], None
+            file.seek(self.offset(name))
+            lines = list(islice(file, limit))
+            end = file.tell()
+            file.close()
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.info(f"Skipped a torn record in the mailbox of {name}.")
+        return records, (end, len(lines))
+
+    def commit(self, name, cursor):
+        end, consumed = cursor
+        with self.lock:
+            if self.count(name) <= consumed:
+                self.close_box(name)
+                for path in (self.path(name), self.offset_path(name)):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                self.counts.pop(name, None)
+                self.offsets.pop(name, None)
+            else:
+                file = open(self.offset_path(name) + ".tmp", "w")
+                file.write(str(end))
+                file.close()
+                os.replace(self.offset_path(name) + ".tmp", self.offset_path(name))
+                self.offsets[name] = end
+                self.counts[name] -= consumed
+            self.replayed += consumed
+
+    def flush_loop(self):
+        while True:
+            sleep(self.sync_interval)
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+
+        for box in dirty:
+            try:
+                os.fsync(box.fileno())
+            except (ValueError, OSError):
+                pass
+
+    def stats(self):
+        with self.lock:
+            mailboxes, messages, size = 0, 0, 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".box"):
+                    mailboxes += 1
+                    messages += self.count(entry.name[:-len(".box")])
+                    size += entry.stat().st_size
+            return {
+                "mailboxes": mailboxes,
+                "messages": messages,
+                "bytes": size,
+                "stored": self.stored,
+                "replayed": self.replayed,
+            }
+
+    def close(self):
+        with self.lock:
+            for name in list(self.files):
+                self.close_box(name)
@@ -0,0 +1,177 @@
+from threading import Lock
+from time import monotonic
+import threading
+import json
+
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_upper(index):
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, unit=1e-6):
+        self.unit = unit
+        self.lock = Lock()
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = bucket_index(int(seconds / self.unit))
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, fraction):
+        with self.lock:
+            target = fraction * self.count
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= target:
+                    return min(bucket_upper(index) * self.unit, self.max)
+        return 0.0
+
+    def state(self):
+        with self.lock:
+            return dict(self.buckets), self.count, self.total, self.max
+
+    def merge(self, state):
+        buckets, count, total, maximum = state
+        with self.lock:
+            for index, hits in buckets.items():
+                self.buckets[index] = self.buckets.get(index, 0) + hits
+            self.count += count
+            self.total += total
+            self.max = max(self.max, maximum)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "quantiles": {str(fraction): self.quantile(fraction) for fraction in QUANTILES},
+        }
+
+
+class Metrics:
+    def __init__(self, prefix="chat"):
+        self.prefix = prefix
+        self.started = monotonic()
+        self.lock = Lock()
+        self.counters = {}
+        self.busy = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.sections = {}
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(seconds)
+
+    def add_busy(self, role, seconds):
+        with self.lock:
+            self.busy[role] = self.busy.get(role, 0.0) + seconds
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def section(self, name, function):
+        self.sections[name] = function
+
+    def snapshot(self):
+        uptime = monotonic() - self.started
+        with self.lock:
+            counters = dict(self.counters)
+            busy = dict(self.busy)
+
+        gauges = {name: function() for name, function in self.gauges.items()}
+        gauges["threads"] = threading.active_count()
+        return {
+            "uptime": uptime,
+            "counters": counters,
+            "gauges": gauges,
+            "utilization": {role: seconds / uptime for role, seconds in busy.items()},
+            "histograms": {name: histogram.summary() for name, histogram in list(self.histograms.items())},
+            **{name: function() for name, function in self.sections.items()},
+        }
+
+    def to_json(self, snapshot=None):
+        return json.dumps(self.snapshot() if snapshot is None else snapshot)
+
+    def to_prometheus(self, snapshot=None):
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        lines = []
+
+        def metric(name, kind, samples):
+            if len(samples) == 0:
+                return
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{self.prefix}_{name}{labels} {value}")
+
+        metric("uptime_seconds", "gauge", [("", snapshot["uptime"])])
+        for name, value in sorted(snapshot["counters"].items()):
+            metric(f"{name}_total", "counter", [("", value)])
+        for name, value in sorted(snapshot["gauges"].items()):
+            metric(name, "gauge", [("", value)])
+        metric("utilization", "gauge", [(f'{{role="{escape_label(role)}"}}', value)
+                                        for role, value in sorted(snapshot["utilization"].items())])
+
+        for name, summary in sorted(snapshot["histograms"].items()):
+            samples = [(f'{{quantile="{fraction}"}}', value) for fraction, value in summary["quantiles"].items()]
+            metric(f"{name}_seconds", "summary", samples)
+            lines.append(f"{self.prefix}_{name}_seconds_sum {summary['sum']}")
+            lines.append(f"{self.prefix}_{name}_seconds_count {summary['count']}")
+
+        for section in [name for name in self.sections if name in snapshot]:
+            for key, value in sorted(snapshot[section].items()):
+                if isinstance(value, dict):
+                    metric(f"{section}_{key}", "gauge", [(f'{{name="{escape_label(label)}"}}', sample)
+                                                          for label, sample in sorted(value.items())])
+                else:
+                    metric(f"{section}_{key}", "gauge", [("", value)])
+        return "\n".join(lines) + "\n"
+
+    def render(self, fmt, limit=None):
+        snapshot = self.snapshot()
+        to_text = self.to_prometheus if fmt == "prometheus" else self.to_json
+        text = to_text(snapshot)
+        if limit is None:
+            return text
+
+        sections = sorted(self.sections, key=lambda name: len(json.dumps(snapshot[name])), reverse=True)
+        while len(text.encode()) > limit and sections:
+            del snapshot[sections.pop(0)]
+            snapshot["trimmed"] = [name for name in self.sections if name not in snapshot]
+            text = to_text(snapshot)
+        return text
@@ -0,0 +1,200 @@
+from collections import deque
+from threading import Condition
+from queue import Empty
+import os
+import json
+
+from config import *
+
+
+class POLICY:
+    DROP_OLDEST = "drop-oldest"
+    REJECT = "reject"
+    DISCONNECT = "disconnect"
+    SPILL = "spill"
+
+
+class Outbox:
+    def __init__(self, name, limit=OUTBOX_LIMIT, policy=OUTBOX_POLICY,
+                 high_water=OUTBOX_HIGH_WATER, spill_dir=SPILL_DIR):
+        self.name = name
+        self.limit = limit
+        self.policy = policy
+        self.high_water = max(1, int(limit * high_water))
+        self.spill_path = os.path.join(spill_dir, f"{name}.spill")
+        self.on_high_water = None
+
+        self.lock = Condition()
+        self.items = deque()
+        self.overflowed = False
+        self.closed = False
+        self.alerted = False
+        self.peak = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.spilled = 0
+        self.alerts = 0
+
+        self.spill_file = None
+        self.spill_offset = 0
+        self.spill_pending = 0
+        if os.path.exists(self.spill_path):
+            self.spill_file = open(self.spill_path, "a+b")
+            self.spill_file.seek(0)
+            self.spill_pending = sum(1 for _ in self.spill_file)
+
+    def __len__(self):
+        return len(self.items) + self.spill_pending
+
+    def put(self, envelope):
+        with self.lock:
+            if self.closed:
+                return False
+            if self.is_marker(envelope):
+                self.items.append(envelope)
+                self.lock.notify()
+                return True
+            if envelope is not None:
+                if self.overflowed:
+                    self.rejected += 1
+                    return False
+                if self.spill_pending > 0:
+                    self.spill(envelope)
+                    return True
+
+                if len(self.items) >= self.limit:
+                    if self.policy == POLICY.DROP_OLDEST:
+                        if self.items.popleft() is not None:
+                            self.dropped += 1
+                    elif self.policy == POLICY.SPILL:
+                        self.spill(envelope)
+                        self.lock.notify()
+                        return True
+                    elif self.policy == POLICY.DISCONNECT:
+                        self.rejected += 1
+                        self.items.clear()
+                        self.items.append(None)
+                        self.overflowed = True
+                        self.lock.notify()
+                        return False
+                    else:
+                        self.rejected += 1
+                        return False
+
+            self.items.append(envelope)
+            self.check_high_water()
+            self.lock.notify()
+            return True
+
+    def check_high_water(self):
+        depth = len(self)
+        self.peak = max(self.peak, depth)
+        if self.alerted or depth < self.high_water:
+            return
+
+        self.alerted = True
+        self.alerts += 1
+        if self.on_high_water is not None:
+            self.on_high_water(self.name, depth, self.limit)
+
+    def get(self, block=True):
+        with self.lock:
+            while len(self.items) == 0:
+                if self.spill_pending > 0:
+                    self.load_spill()
+                elif not block:
+                    raise Empty
+                else:
+                    self.lock.wait()
+
+            envelope = self.items.popleft()
+            if self.alerted and len(self) < self.high_water // 2:
+                self.alerted = False
+            return envelope
+
+    def requeue(self, envelopes):
+        with self.lock:
+            self.items.extendleft(reversed([envelope for envelope in envelopes if envelope is not None]))
+            self.lock.notify()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        with self.lock:
+            return len(self) == 0
+
+    def pending(self):
+        with self.lock:
+            return sum(1 for envelope in self.items if envelope is not None) + self.spill_pending
+
+    def take_overflow(self):
+        with self.lock:
+            overflowed, self.overflowed = self.overflowed, False
+            return overflowed
+
+    def spill(self, envelope):
+        if self.spill_file is None:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            self.spill_file = open(self.spill_path, "a+b")
+        for record in self.dump(envelope):
+            self.spill_file.write(json.dumps(record).encode() + b"\n")
+            self.spill_pending += 1
+            self.spilled += 1
+        self.spill_file.flush()
+        self.check_high_water()
+
+    def load_spill(self):
+        self.spill_file.seek(self.spill_offset)
+        for _ in range(min(self.limit, self.spill_pending)):
+            try:
+                envelope = self.load(json.loads(self.spill_file.readline()))
+            except ValueError:
+                self.spill_pending = 0
+                break
+            self.items.append(envelope)
+            self.spill_pending -= 1
+        self.spill_offset = self.spill_file.tell()
+
+        if self.spill_pending == 0:
+            self.discard_spill()
+
+    def discard_spill(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spill_offset = 0
+        self.spill_pending = 0
+        try:
+            os.remove(self.spill_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.items.clear()
+            self.items.append(None)
+            self.discard_spill()
+            self.lock.notify()
+
+    def is_marker(self, envelope):
+        return False
+
+    def dump(self, envelope):
+        return [envelope]
+
+    def load(self, record):
+        return record
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": len(self),
+                "limit": self.limit,
+                "peak": self.peak,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "spilled": self.spilled,
+                "alerts": self.alerts,
+            }
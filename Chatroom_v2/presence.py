@@ -0,0 +1,185 @@
+from collections import deque
+from threading import Thread, Lock, Event
+from time import sleep
+import json
+
+from config import *
+from codec import *
+from fanout import Envelope
+
+
+class Presence:
+    def __init__(self, log_size=PRESENCE_LOG_SIZE, datagram_size=PRESENCE_DATAGRAM_SIZE,
+                 reply_size=ACTIVE_USERS_DATAGRAM_SIZE):
+        self.lock = Lock()
+        self.active = {}
+        self.version = 0
+        self.log = deque(maxlen=log_size)
+        self.datagram_size = datagram_size
+        self.reply_size = reply_size
+        self.reply = b""
+        self.reply_version = 0
+        self.snapshot = []
+        self.snapshot_version = -1
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.active)
+
+    def __contains__(self, name):
+        return name in self.active
+
+    def record(self, name, status, remote):
+        self.version += 1
+        self.log.append((self.version, name, status))
+        for listener in self.listeners:
+            listener(name, status, remote)
+
+    def join(self, name, status, remote=False):
+        with self.lock:
+            self.active[name] = status
+            self.record(name, status, remote)
+
+    def leave(self, name, remote=False):
+        with self.lock:
+            if self.active.pop(name, None) is not None:
+                self.record(name, None, remote)
+
+    def set_status(self, name, status, remote=False):
+        with self.lock:
+            if name in self.active and self.active[name] != status:
+                self.active[name] = status
+                self.record(name, status, remote)
+
+    def apply(self, name, status, remote=True):
+        if status is None:
+            self.leave(name, remote)
+        elif name in self.active:
+            self.set_status(name, status, remote)
+        else:
+            self.join(name, status, remote)
+
+    def status_of(self, name):
+        return self.active.get(name)
+
+    def active_users_reply(self):
+        if self.reply_version == self.version:
+            return self.reply
+
+        with self.lock:
+            entries, size = [], 0
+            for name in self.active:
+                entry = f"{name};".encode()
+                if size + len(entry) > self.reply_size:
+                    break
+                entries.append(entry)
+                size += len(entry)
+            self.reply = b"".join(entries)
+            self.reply_version = self.version
+            return self.reply
+
+    def changes_since(self, version):
+        with self.lock:
+            if version > self.version or (version < self.version and
+                                          (len(self.log) == 0 or self.log[0][0] > version + 1)):
+                return None
+
+            changes = {}
+            for event_version, name, status in reversed(self.log):
+                if event_version <= version:
+                    break
+                changes.setdefault(name, status)
+            return self.version, changes
+
+    def presence_reply(self, version):
+        delta = self.changes_since(version)
+        if delta is not None:
+            current, changes = delta
+            events = [["+", name, status] if status is not None else ["-", name]
+                      for name, status in changes.items()]
+            reply = json.dumps({"type": "delta", "from": version, "version": current, "events": events}).encode()
+            if len(reply) <= self.datagram_size:
+                return [reply]
+        return self.snapshot_reply()
+
+    def full_snapshot(self):
+        with self.lock:
+            return json.dumps({"type": "snapshot", "version": self.version,
+                               "users": [[name, status] for name, status in self.active.items()]})
+
+    def snapshot_reply(self):
+        if self.snapshot_version == self.version:
+            return self.snapshot
+
+        with self.lock:
+            version = self.version
+            chunks, chunk, size = [], [], 0
+            for name, status in self.active.items():
+                entry_size = len(json.dumps([name, status])) + 2
+                if chunk and size + entry_size > self.datagram_size - 96:
+                    chunks.append(chunk)
+                    chunk, size = [], 0
+                chunk.append([name, status])
+                size += entry_size
+            chunks.append(chunk)
+
+            self.snapshot = [json.dumps({"type": "snapshot", "version": version, "part": part,
+                                         "parts": len(chunks), "users": users}).encode()
+                             for part, users in enumerate(chunks)]
+            self.snapshot_version = version
+            return self.snapshot
+
+
+class PresencePublisher:
+    def __init__(self, presence: Presence, interval=PRESENCE_PUSH_INTERVAL):
+        self.presence = presence
+        self.interval = interval
+        self.lock = Lock()
+        self.subscribers = set()
+        self.changed = Event()
+        self.pushed_version = presence.version
+        presence.listeners.append(self.on_change)
+
+        publisher_thread = Thread(target=self.run)
+        publisher_thread.daemon = True
+        publisher_thread.start()
+
+    def subscribe(self, client):
+        with self.lock:
+            self.subscribers.add(client)
+        client.enqueue_message(Envelope(OP.PRESENCE, self.presence.full_snapshot()))
+
+    def on_change(self, name, status, remote):
+        self.changed.set()
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.subscribers.discard(client)
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            sleep(self.interval)
+            self.changed.clear()
+            self.publish()
+
+    def publish(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        delta = self.presence.changes_since(self.pushed_version)
+        if delta is None:
+            self.pushed_version = self.presence.version
+            envelope = Envelope(OP.PRESENCE, self.presence.full_snapshot())
+        else:
+            version, changes = delta
+            if len(changes) == 0:
+                return
+            events = [["+", name, status] if status is not None else ["-", name]
+                      for name, status in changes.items()]
+            envelope = Envelope(OP.PRESENCE, json.dumps({"type": "delta", "from": self.pushed_version,
+                                                        "version": version, "events": events}))
+            self.pushed_version = version
+
+        for client in subscribers:
+            if client.active:
+                client.enqueue_message(envelope)
@@ -0,0 +1,142 @@
+from threading import Thread, Event, get_ident
+from datetime import datetime
+from time import monotonic
+import sys
+import os
+import json
+import time
+import logging
+
+from config import *
+from codec import OP
+
+
+HANDLERS = {
+    "start": "main loop",
+    "accept": "accept",
+    "handshake": "handshake",
+    "handle_data": "handshake",
+    "handle_req": "requests",
+    "read_frames": "requests",
+    "read_message": "requests",
+    "handle_res": "responses",
+    "deliver": "responses",
+    "flush": "responses",
+    "handle_udp": "udp",
+    "handle_udp_request": "udp",
+    "flush_loop": "disk flush",
+}
+
+OP_NAMES = {value: name for name, value in vars(OP).items() if not name.startswith("_")}
+
+
+def thread_cpu_time(ident):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+class Profiler:
+    def __init__(self, interval=PROFILE_INTERVAL, profile_dir=PROFILE_DIR):
+        self.interval = interval
+        self.profile_dir = profile_dir
+        self.thread = None
+        self.stopping = Event()
+
+    @property
+    def active(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.active:
+            return False
+        self.started = monotonic()
+        self.started_at = datetime.now()
+        self.samples = 0
+        self.idle_samples = 0
+        self.handlers = {}
+        self.commands = {}
+        self.self_counts = {}
+        self.cumulative_counts = {}
+        self.cpu_times = {}
+
+        self.stopping.clear()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.active:
+            return None
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        return self.dump(monotonic() - self.started)
+
+    def run(self):
+        own_ident = get_ident()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self.sample(ident, frame)
+
+    def sample(self, ident, frame):
+        cpu_time = thread_cpu_time(ident)
+        if cpu_time is not None:
+            previous = self.cpu_times.get(ident)
+            self.cpu_times[ident] = cpu_time
+            if previous is None or cpu_time == previous:
+                self.idle_samples += 1
+                return
+        self.samples += 1
+
+        handler = None
+        command = None
+        seen = set()
+        label = frame_label(frame)
+        self.self_counts[label] = self.self_counts.get(label, 0) + 1
+        while frame is not None:
+            name = frame.f_code.co_name
+            if handler is None and name in HANDLERS:
+                handler = HANDLERS[name]
+            if command is None and name == "handle_command":
+                command = OP_NAMES.get(frame.f_locals.get("opcode"), "unknown")
+
+            label = frame_label(frame)
+            if label not in seen:
+                seen.add(label)
+                self.cumulative_counts[label] = self.cumulative_counts.get(label, 0) + 1
+            frame = frame.f_back
+
+        handler = handler or "other"
+        self.handlers[handler] = self.handlers.get(handler, 0) + 1
+        if command is not None:
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+    def dump(self, duration):
+        hottest = sorted(self.self_counts, key=self.self_counts.get, reverse=True)[:PROFILE_TOP_FUNCTIONS]
+        report = {
+            "started": self.started_at.isoformat(timespec="seconds"),
+            "duration": duration,
+            "interval": self.interval,
+            "samples": self.samples,
+            "idle_samples": self.idle_samples,
+            "handlers": dict(sorted(self.handlers.items(), key=lambda item: item[1], reverse=True)),
+            "commands": dict(sorted(self.commands.items(), key=lambda item: item[1], reverse=True)),
+            "functions": [{"function": label, "self": self.self_counts[label],
+                           "cumulative": self.cumulative_counts.get(label, 0)} for label in hottest],
+        }
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"profile-{os.getpid()}-{self.started_at:%Y%m%d-%H%M%S}.json")
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Profile of {duration:.1f}s ({self.samples} samples) written to {path}.")
+        return path
@@ -1,201 +1,551 @@
-from time import sleep
-from queue import Queue
-from threading import Thread
+from queue import Empty
+from threading import Thread, Lock, current_thread, main_thread
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, perf_counter
 import socket
-import re
+import signal
+import os
 import logging
 import hashlib
 import json
 
 from config import *
+from codec import *
+from fanout import FanOut, EnvelopeOutbox, Replay, send_buffers
+from history import HistoryStore
+from directory import ClientDirectory, valid_name
+from presence import Presence, PresencePublisher
+from mailboxes import Mailbox
+from metrics import Metrics
+from profiler import Profiler
+from timerwheel import TimerWheel
+from sessions import Session
+from channels import ChannelDirectory, is_channel, valid_channel
 
 
 class Client:
-    def __init__(self, name: str, password: str, socket: socket):
+    def __init__(self, name: str, password: str, socket: socket, spill_dir=SPILL_DIR):
         self.socket = socket
-        self.message_queue = Queue()
+        self.message_queue = EnvelopeOutbox(name, spill_dir=spill_dir)
+        self.login = name
         self.name = name
         self.password = password
         self.status = STATUS.AVAILABLE
         self.active = True
-        self.history = {}
-        try:
-            file = open(f"{self.name}_hist.json", "r")
-            history_str = file.read()
-            self.history = json.loads(history_str)
-            file.close()
-        except Exception:
-            file = open(f"{self.name}_hist.json", "w")
-            file.write("{}")
-            file.close()
+        self.framed = False
+        self.compressor = None
+        self.tagged = False
+        self.session = None
+        self.replay_deferred = False
+        self.send_lock = Lock()
+        self.on_message = None
 
     def has_incoming_messages(self):
         return not self.message_queue.empty()
 
-    def enqueue_message(self, message, sender_name):
-        self.message_queue.put((message, sender_name))
+    def has_pending_messages(self):
+        return self.message_queue.pending() > 0
+
+    def has_session(self):
+        return self.session is not None and self.session.live()
+
+    def enqueue_message(self, envelope):
+        accepted = self.message_queue.put(envelope)
+        if self.on_message is not None:
+            self.on_message(self)
+        return accepted
 
     def dequeue_message(self):
         return self.message_queue.get()
 
+    def dequeue_messages(self, limit):
+        envelopes = [self.message_queue.get()]
+        while len(envelopes) < limit:
+            try:
+                envelopes.append(self.message_queue.get_nowait())
+            except Empty:
+                break
+        return envelopes
+
+    def compress(self, data):
+        if self.compressor is None:
+            return data
+        return self.compressor.compress_frames(data)
+
+    def encode_envelope(self, envelope):
+        if self.session is None:
+            return self.compress(envelope.encode(self.framed))
+        return self.compress(self.session.track(envelope))
+
+    def send_frame(self, opcode, *fields, rid=None):
+        with self.send_lock:
+            data = self.compress(encode(self.framed, opcode, *fields, rid=rid))
+            self.socket.sendall(data)
+        return len(data)
+
     def shutdown(self):
         self.active = False
-        self.socket.close()
+        if self.socket is not None:
+            self.socket.close()
         self.socket = None
-
-        file = open(f"{self.name}_hist.json", "w")
-        file.write(json.dumps(self.history))
-        file.close()
+        self.message_queue.put(None)
 
 
 class Server:
-    def __init__(self, tcp_addr, udp_addr, max_client=100):
+    def __init__(self, tcp_addr, udp_addr, max_client=100, reuse_port=False, history_dir=None, data_dir=""):
         self.max_client = max_client
-        self.client_list = {}
-        try:
-            file = open(f"clients_list.json", "r")
-            clients = json.loads(file.read())
-            for client_name in clients:
-                self.client_list[client_name] = Client(client_name, clients[client_name], None)
-                self.client_list[client_name].active = False
-            file.close()
-        except Exception:
-            file = open(f"clients_list.json", "w")
-            file.write("{}")
-            file.close()
+        self.data_dir = data_dir
+        self.metrics = Metrics()
+        self.profiler = Profiler(profile_dir=os.path.join(data_dir, PROFILE_DIR))
+        self.idle = TimerWheel()
+        self.history = HistoryStore(history_dir or os.path.join(data_dir, HISTORY_DIR))
+        self.client_list = ClientDirectory(Client, self.history, os.path.join(data_dir, CLIENTS_DIR),
+                                           spill_dir=os.path.join(data_dir, SPILL_DIR))
+        self.client_list.on_high_water = self.queue_alert
+        self.presence = Presence()
+        self.publisher = PresencePublisher(self.presence)
+        self.mailbox = Mailbox(os.path.join(data_dir, MAILBOX_DIR))
+        self.channels = ChannelDirectory(os.path.join(data_dir, CHANNELS_DIR))
+        self.fanout = FanOut(self.client_list, self.history, self.mailbox, self.metrics, self.channels)
+
+        self.metrics.gauge("clients_active", lambda: len(self.presence))
+        self.metrics.gauge("compression_ratio", self.compression_ratio)
+        self.metrics.section("queues", self.queue_depths)
+        self.metrics.section("directory", self.client_list.stats)
+        self.metrics.section("mailbox", self.mailbox.stats)
+        self.metrics.section("channels", self.channels.stats)
 
         self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-        self.socket.bind(tcp_addr)
-
         self.udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(tcp_addr)
         self.udp_socket.bind(udp_addr)
 
     def start(self):
+        self.install_signals()
         udp_thread = Thread(target=self.handle_udp)
         udp_thread.daemon = True
         udp_thread.start()
+        idle_thread = Thread(target=self.expire_idle)
+        idle_thread.daemon = True
+        idle_thread.start()
 
-        self.socket.listen(5)
+        self.socket.listen(LISTEN_BACKLOG)
+        handshakes = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS)
 
         logging.info("Server started, Listening to incoming connections.")
         while True:
             try:
                 client_socket, _ = self.socket.accept()
-
-                if len(self.client_list) <= self.max_client:
-                    client = None
-                    client_socket.send("?name".encode())
-                    client_name = client_socket.recv(1024).decode()
-                    client_socket.send("?pass".encode())
-                    client_password = client_socket.recv(1024).decode()
-
-                    if client_name in self.client_list:
-                        client = self.client_list[client_name]
-                        if hashlib.sha256(client_password.encode()).hexdigest() != client.password:
-                            client_socket.send("reject".encode())
-                            continue
-                        else:
-                            client_socket.send("accept".encode())
-                            client.socket = client_socket
-                            client.active = True
-                    else:
-                        hashed_pass = hashlib.sha256(client_password.encode()).hexdigest()
-                        client = Client(client_name, hashed_pass, client_socket)
-                        self.client_list[client_name] = client
-                        client_socket.send("accept".encode())
-                    
-                    logging.info(f"{client.name} entered the server.")
-
-                    req_thread = Thread(target=self.handle_req, args=[client])
-                    req_thread.daemon = True
-                    res_thread = Thread(target=self.handle_res, args=[client])
-                    res_thread.daemon = True
-                    
-                    req_thread.start()
-                    res_thread.start()
-
-                else:
-                    self.refuse(client_socket)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                enable_keepalive(client_socket)
+                self.metrics.incr("connections_accepted")
+                handshakes.submit(self.handshake, client_socket, perf_counter())
 
             except KeyboardInterrupt:
-                self.socket.close()
+                self.stop()
+                exit(0)
 
-                clients = {}
-                for client_name in self.client_list:
-                    clients[client_name] = self.client_list[client_name].password
-                file = open("clients_list.json", "w")
-                file.write(json.dumps(clients))
-                file.close()
+    def handshake(self, client_socket: socket, accepted):
+        if len(self.presence) >= self.max_client:
+            self.refuse(client_socket)
+            return
 
-                logging.info("Server turned off.")
-                exit(0)
+        try:
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            client_socket.send("?name".encode())
+            client_hello = client_socket.recv(1024).decode(errors="replace")
+            client = self.resume(client_hello, client_socket)
+            if client is None:
+                client_socket.send("?pass".encode())
+                client_password = client_socket.recv(1024).decode(errors="replace")
+                client = self.login(client_hello, client_password, client_socket)
+        except socket.error:
+            logging.info("A client didn't finish the handshake in time.")
+            client_socket.close()
+            return
+
+        if client is None:
+            client_socket.close()
+            return
+        self.metrics.observe("handshake", perf_counter() - accepted)
+
+        req_thread = Thread(target=self.handle_req, args=[client])
+        req_thread.daemon = True
+        res_thread = Thread(target=self.handle_res, args=[client])
+        res_thread.daemon = True
+
+        req_thread.start()
+        res_thread.start()
+
+    def stop(self):
+        self.socket.close()
+        self.client_list.close()
+        self.mailbox.close()
+        self.history.close()
+
+        logging.info("Server turned off.")
+
+    def login(self, client_hello, client_password, client_socket):
+        client_name, features = parse_hello(client_hello)
+        if not valid_name(client_name):
+            client_socket.send("reject".encode())
+            logging.info(f"Rejected a login with an invalid name: {client_name!r}")
+            return None
+
+        client = self.client_list.get(client_name)
+        if client is not None:
+            if hashlib.sha256(client_password.encode()).hexdigest() != client.password:
+                client_socket.send("reject".encode())
+                return None
+            else:
+                superseded, client.socket = client.socket, client_socket
+                client.active = True
+                self.supersede(superseded, client_socket)
+        else:
+            hashed_pass = hashlib.sha256(client_password.encode()).hexdigest()
+            client = self.client_list.register(client_name, hashed_pass, client_socket)
+
+        self.negotiate(client, features)
+        client.session = Session() if FEATURE_RESUME in features else None
+        if client.session is not None:
+            features = [*features, make_session(client.session.token)]
+        client_socket.send(make_accept(features).encode())
+        self.presence.join(client.login, client.status)
+        client.replay_deferred = not client.framed
+        if client.status == STATUS.AVAILABLE and client.framed:
+            self.fanout.replay(client)
+
+        logging.info(f"{client.name} entered the server.")
+        return client
+
+    def resume(self, client_hello, client_socket):
+        resumption = parse_session(client_hello.split("|")[1:])
+        if resumption is None:
+            return None
+        token, ack = resumption
+        client_name, features = parse_hello(client_hello)
+        client = self.client_list.get(client_name)
+        if client is None or client.session is None or not client.session.resumable(token, ack):
+            self.metrics.incr("resumes_rejected")
+            return None
+
+        session = client.session
+        session.ack(ack)
+        session.expires = None
+        with client.send_lock:
+            superseded, client.socket = client.socket, client_socket
+            client.active = True
+            self.negotiate(client, features)
+            client_socket.send(make_accept([*features, make_session(token), RESUMED]).encode())
+            tail = session.tail()
+            if tail:
+                client_socket.sendall(client.compress(b"".join(tail)))
+        self.supersede(superseded, client_socket)
+
+        self.metrics.incr("sessions_resumed")
+        self.metrics.incr("messages_resent", len(tail))
+        self.presence.join(client.login, client.status)
+        if client.status == STATUS.AVAILABLE:
+            self.fanout.replay(client)
+
+        logging.info(f"{client.name} resumed its session, resent {len(tail)} unacknowledged message(s).")
+        return client
+
+    def supersede(self, superseded, client_socket):
+        if superseded is None or superseded is client_socket:
+            return
+        try:
+            superseded.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def negotiate(self, client: Client, features):
+        client.framed = FEATURE_FRAMED in features
+        client.tagged = FEATURE_RID in features
+        client.compressor = None
+        if FEATURE_ZLIB in features:
+            client.compressor = FrameCompressor()
+            client.compressor.on_compress = self.compressed
+
+    def new_decoder(self, client: Client):
+        decoder = FrameDecoder(max_frame=MAX_FRAME_SIZE)
+        if client.compressor is not None:
+            decoder.enable_decompression()
+            decoder.on_decompress = self.decompressed
+        if client.tagged:
+            decoder.enable_tagging()
+        return decoder
+
+    def compressed(self, raw_size, wire_size, seconds):
+        self.metrics.incr("compressed_frames")
+        self.metrics.incr("compress_raw_bytes", raw_size)
+        self.metrics.incr("compress_wire_bytes", wire_size)
+        self.metrics.observe("compress", seconds)
+
+    def decompressed(self, raw_size, wire_size, seconds):
+        self.metrics.incr("decompressed_frames")
+        self.metrics.incr("decompress_raw_bytes", raw_size)
+        self.metrics.incr("decompress_wire_bytes", wire_size)
+        self.metrics.observe("decompress", seconds)
+
+    def compression_ratio(self):
+        counters = self.metrics.counters
+        raw_size = counters.get("compress_raw_bytes", 0) + counters.get("decompress_raw_bytes", 0)
+        wire_size = counters.get("compress_wire_bytes", 0) + counters.get("decompress_wire_bytes", 0)
+        return raw_size / wire_size if wire_size else 1.0
+
+    def logout(self, client: Client):
+        self.publisher.unsubscribe(client)
+        self.presence.leave(client.login)
+        if client.session is not None:
+            client.session.suspend()
+        client.shutdown()
+
+    def install_signals(self):
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGUSR1, lambda *_: self.toggle_profile())
+
+    def toggle_profile(self):
+        if self.profiler.start():
+            logging.info("Profiling started.")
+            return "profiling"
+        return self.profiler.stop()
 
     def handle_udp(self):
         while True:
-            message, addr = self.udp_socket.recvfrom(1024)
-            if message.decode() == "getactiveusers":
-                activeusers = ""
-                for name in self.client_list:
-                    if self.client_list[name].active:
-                        activeusers += f"{name};"
-                self.udp_socket.sendto(activeusers.encode(), addr)
+            try:
+                message, addr = self.udp_socket.recvfrom(1024)
+                self.handle_udp_request(message, addr)
+            except OSError as error:
+                logging.info(f"Couldn't answer a UDP request: {error}")
+            except Exception:
+                logging.exception("Handling a UDP request failed.")
+
+    def handle_udp_request(self, message, addr):
+        if (message == b"getstats" or message.startswith(b"getstats:")) and addr[0] in STATS_ADMIN_HOSTS:
+            fmt = message[len(b"getstats:"):].decode(errors="replace")
+            self.udp_socket.sendto(self.metrics.render(fmt, STATS_DATAGRAM_SIZE).encode(), addr)
+
+        elif message in (b"profile:start", b"profile:stop") and addr[0] in PROFILE_ADMIN_HOSTS:
+            if (message == b"profile:start") != self.profiler.active:
+                reply = self.toggle_profile()
+            else:
+                reply = "profiling" if self.profiler.active else "not profiling"
+            self.udp_socket.sendto(reply.encode(), addr)
+
+        elif message == b"getactiveusers":
+            self.udp_socket.sendto(self.presence.active_users_reply(), addr)
+
+        elif message.startswith(b"getpresence:"):
+            try:
+                version = int(message[len(b"getpresence:"):])
+            except ValueError:
+                return
+            for datagram in self.presence.presence_reply(version):
+                self.udp_socket.sendto(datagram, addr)
 
     def handle_req(self, client: Client):
-        client.socket.settimeout(10)
+        session_socket = client.socket
+        session_socket.settimeout(None)
+        self.idle.schedule(session_socket, IDLE_TIMEOUT)
+        decoder = self.new_decoder(client)
         while client.active:
             try:
-                message = client.socket.recv(2048).decode()
+                if client.framed:
+                    received = decoder.recv_from(client.socket)
+                    if received == 0:
+                        raise ConnectionResetError
+                    self.idle.touch(session_socket, IDLE_TIMEOUT)
+                    self.metrics.incr("bytes_in", received)
+                    started = perf_counter()
+                    for opcode, fields in self.parse_frames(decoder):
+                        if client.socket is not session_socket:
+                            break
+                        self.handle_command(client, opcode, fields, decoder.rid)
+                else:
+                    data = client.socket.recv(2048)
+                    if data == b"":
+                        raise ConnectionResetError
+                    if client.socket is not session_socket:
+                        break
+                    self.idle.touch(session_socket, IDLE_TIMEOUT)
+                    self.metrics.incr("bytes_in", len(data))
+                    started = perf_counter()
+                    self.handle_command(client, *self.parse_message(data.decode(errors="replace")))
+                self.metrics.add_busy("requests", perf_counter() - started)
+
+            except (socket.error, ProtocolError) as error:
+                if client.socket is session_socket:
+                    self.logout(client)
+                    if isinstance(error, ProtocolError):
+                        logging.info(f"{client.name} got disconnected for a malformed command: {error}")
+                    else:
+                        logging.info(f"{client.name} disconnected.")
+                break
+        self.idle.cancel(session_socket)
 
-                if message == "alive":
-                    continue
+    def expire_idle(self):
+        while True:
+            sleep(self.idle.tick)
+            for session_socket in self.idle.expired():
+                logging.info(f"Closing a connection that was idle for {IDLE_TIMEOUT}s.")
+                try:
+                    session_socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def parse_frames(self, decoder: FrameDecoder):
+        while True:
+            started = perf_counter()
+            frame = decoder.next_frame()
+            if frame is None:
+                return
+            self.metrics.observe("command_parse", perf_counter() - started)
+            yield frame
+
+    def parse_message(self, message):
+        started = perf_counter()
+        command = parse_legacy(message)
+        self.metrics.observe("command_parse", perf_counter() - started)
+        return command
+
+    def queue_depths(self):
+        stats = self.client_list.queue_stats()
+        deepest = sorted(stats, key=lambda name: stats[name]["depth"], reverse=True)[:STATS_TOP_QUEUES]
+        return {
+            "total_depth": sum(queue["depth"] for queue in stats.values()),
+            "depth": {name: stats[name]["depth"] for name in deepest},
+            "dropped": {name: stats[name]["dropped"] for name in deepest},
+        }
+
+    def handle_command(self, client: Client, opcode, fields, rid=None):
+        self.metrics.incr("commands")
+        if client.replay_deferred:
+            client.replay_deferred = False
+            if client.status == STATUS.AVAILABLE:
+                self.fanout.replay(client)
+        if opcode == OP.ALIVE:
+            return
+
+        elif opcode == OP.ACK and client.session is not None:
+            client.session.ack(parse_number(fields[0]))
+
+        elif opcode == OP.CLOSE:
+            client.session = None
+            self.logout(client)
+            logging.info(f"{client.name} left the server.")
+
+        elif opcode == OP.GETHISTORY:
+            self.reply(client, OP.HISTORY, json.dumps(self.history.conversations(client.login)), rid=rid)
+
+        elif opcode == OP.QUERYHISTORY and is_channel(fields[0]):
+            channel, since, limit = fields
+            since, limit = parse_number(since or 0), parse_number(limit or HISTORY_PAGE_SIZE)
+            if valid_channel(channel):
+                self.query_channel(client, channel, since, limit, rid)
+            else:
+                self.reply(client, OP.HISTORYPAGE, json.dumps(self.history.empty_page()), rid=rid)
 
-                elif message == "close":
-                    client.shutdown()
-                    logging.info(f"{client.name} left the server.")
-                    break
+        elif opcode == OP.QUERYHISTORY:
+            peer, since, limit = fields
+            since, limit = parse_number(since or 0), parse_number(limit or HISTORY_PAGE_SIZE)
+            if peer and not valid_name(peer):
+                page = self.history.empty_page()
+            else:
+                page = self.history.query(client.login, peer, since, limit)
+            self.reply(client, OP.HISTORYPAGE, json.dumps(page), rid=rid)
+
+        elif opcode in (OP.JOIN, OP.LEAVE):
+            channel = fields[0]
+            if not valid_channel(channel):
+                report = f"Invalid channel name: {channel}."
+            elif opcode == OP.JOIN:
+                joined = self.channels.join(channel, client.login)
+                report = f"Joined {channel}." if joined else f"Already a member of {channel}."
+            else:
+                left = self.channels.leave(channel, client.login)
+                report = f"Left {channel}." if left else f"Not a member of {channel}."
+            self.reply(client, OP.LOG, report, rid=rid)
 
-                elif message == "gethistory":
-                    client.socket.send(f"history:{json.dumps(client.history)}".encode())
+        elif opcode == OP.SUBSCRIBE and fields[0] == TOPIC_PRESENCE:
+            self.publisher.subscribe(client)
 
-                elif (matches := re.match(r"setstatus:(Available|Busy)", message)) is not None:
-                    client.status = matches.groups()[0]
+        elif opcode == OP.SETSTATUS and fields[0] in (STATUS.AVAILABLE, STATUS.BUSY):
+            client.status = fields[0]
+            self.presence.set_status(client.login, client.status)
+            if client.status == STATUS.AVAILABLE:
+                self.fanout.replay(client)
 
-                elif (matches := re.match(r"setname:(.+)", message)) is not None:
-                    client.name = matches.groups()[0]
-                    logging.info(f"{client.name} changed his/her name to: {client.name}.")
+        elif opcode == OP.SETNAME and valid_name(fields[0]) and self.client_list.get(fields[0]) is None:
+            logging.info(f"{client.name} changed his/her name to: {fields[0]}.")
+            client.name = fields[0]
 
-                elif (matches := re.match(r"sendto:(.+)\smsg:(.+)", message, flags=re.S)) is not None:
-                        receiver_names, sender_message = matches.groups()
+        elif opcode == OP.SENDTO:
+            receiver_names, sender_message = fields
+            report = self.fanout.send(client, receiver_names.split(","), sender_message)
+            self.reply(client, OP.LOG, report, rid=rid)
 
-                        for receiver_name in receiver_names.split(","):
+    def channel_page(self, name, channel, since, limit):
+        if name not in (self.channels.members_of(channel) or ()):
+            return self.history.empty_page()
+        return self.history.query(channel, None, since, limit)
 
-                            if self.client_list[receiver_name] is not None:
-                                receiver_client = self.client_list[receiver_name]
-                                if receiver_client.status == STATUS.AVAILABLE:
-                                    receiver_client.enqueue_message(sender_message, client.name)
-                                    if receiver_client.history.get(client.name) is None:
-                                        receiver_client.history[client.name] = []
-                                    receiver_client.history[client.name].append(sender_message)
-                                    client.socket.send(f"log:Message sent to {receiver_name} successfully.".encode())
-                                    logging.info(f"{client.name} sent a message to: {receiver_name}.")
-                                else:
-                                    client.socket.send(f"log:Specified user ({receiver_name}) is busy right now.".encode())
+    def query_channel(self, client: Client, channel, since, limit, rid=None):
+        page = self.channel_page(client.login, channel, since, limit)
+        self.reply(client, OP.HISTORYPAGE, json.dumps(page), rid=rid)
 
-                            else:
-                                client.socket.send(f"log:Specified user ({receiver_name}) doesn't exist.".encode())
+    def queue_alert(self, name, depth, limit):
+        logging.warning(f"Outbound queue of {name} is at {depth} of {limit} messages.")
 
-            except socket.error:
-                client.shutdown()
-                logging.info(f"{client.get_name_id()} disconnected.")
-                break
+    def reply(self, client: Client, opcode, *fields, rid=None):
+        self.metrics.incr("bytes_out", client.send_frame(opcode, *fields, rid=rid))
 
     def handle_res(self, client: Client):
-        while client.active:
-            if client.has_incoming_messages():
-                message, sender_name = client.dequeue_message()
-                client.socket.send(f"msgfrom:{sender_name} msg:{message}".encode())
-            else:
-                sleep(2)
+        session_socket = client.socket
+        gather = GATHER_LIMIT if client.framed else 1
+        while client.active and client.socket is session_socket:
+            dequeued = client.dequeue_messages(gather)
+            if client.socket is not session_socket:
+                client.message_queue.requeue(dequeued)
+                break
+            if client.message_queue.take_overflow():
+                if client.socket is session_socket:
+                    try:
+                        session_socket.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                    self.logout(client)
+                    logging.info(f"{client.name} got disconnected for not reading its messages.")
+                break
+            replaying = any(isinstance(envelope, Replay) for envelope in dequeued)
+            envelopes = [envelope for envelope in dequeued if envelope is not None and not isinstance(envelope, Replay)]
+            cursor = None
+            if replaying:
+                replayed, cursor = self.fanout.take_replay(client)
+                envelopes[0:0] = replayed
+            if len(envelopes) == 0:
+                continue
+            started = perf_counter()
+            try:
+                with client.send_lock:
+                    buffers = [client.encode_envelope(envelope) for envelope in envelopes]
+                    current = client.session is not None and client.active and client.socket is not None
+                    send_buffers(client.socket if current else session_socket, buffers, gather)
+            except socket.error:
+                if client.socket is not session_socket:
+                    client.message_queue.requeue(dequeued)
+                break
+            self.fanout.replayed(client, cursor)
+
+            sent = perf_counter()
+            for envelope in envelopes:
+                self.metrics.observe("enqueue_to_send", sent - envelope.created)
+            self.metrics.incr("messages_out", len(envelopes))
+            self.metrics.incr("bytes_out", sum(len(buffer) for buffer in buffers))
+            self.metrics.add_busy("responses", sent - started)
 
     def refuse(self, client_socket: socket):
         client_socket.send("Server is full! try again later.".encode())
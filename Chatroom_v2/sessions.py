@@ -0,0 +1,54 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+import secrets
+import hmac
+
+from config import *
+from codec import tag_frame
+from fanout import Batch
+
+
+class Session:
+    def __init__(self, limit=RESUME_TAIL_LIMIT):
+        self.token = secrets.token_urlsafe(16)
+        self.limit = limit
+        self.lock = Lock()
+        self.seq = 0
+        self.floor = 0
+        self.unacked = deque()
+        self.expires = None
+
+    def __len__(self):
+        return len(self.unacked)
+
+    def track(self, envelope):
+        envelopes = envelope.envelopes if isinstance(envelope, Batch) else [envelope]
+        frames = []
+        with self.lock:
+            for envelope in envelopes:
+                self.seq += 1
+                self.unacked.append((self.seq, envelope))
+                frames.append(tag_frame(self.seq, envelope.encode(True)))
+            while len(self.unacked) > self.limit:
+                self.floor = self.unacked.popleft()[0]
+        return b"".join(frames)
+
+    def ack(self, seq):
+        with self.lock:
+            while self.unacked and self.unacked[0][0] <= seq:
+                self.unacked.popleft()
+
+    def tail(self):
+        with self.lock:
+            return [tag_frame(seq, envelope.encode(True)) for seq, envelope in self.unacked]
+
+    def suspend(self, window=RESUME_WINDOW):
+        self.expires = monotonic() + window
+
+    def live(self):
+        return self.expires is None or monotonic() < self.expires
+
+    def resumable(self, token, ack):
+        return (hmac.compare_digest(token.encode(), self.token.encode()) and self.live()
+                and self.floor <= ack <= self.seq)
@@ -0,0 +1,353 @@
+import selectors
+import socket
+import logging
+import multiprocessing
+import tempfile
+import shutil
+import zlib
+import os
+import json
+from collections import OrderedDict, deque
+from itertools import islice
+
+from config import *
+from codec import *
+from channels import is_channel
+from server import Client
+from directory import ClientDirectory, valid_name
+from event_server import Connection, EventServer
+from fanout import consume_buffers
+
+
+def owner_of(name, workers):
+    return zlib.crc32(name.encode()) % workers
+
+
+class Router:
+    def __init__(self, run_dir, workers):
+        self.workers = workers
+        self.selector = selectors.DefaultSelector()
+        self.links = {}
+        self.backlog = {index: deque() for index in range(workers)}
+
+        self.socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+        self.socket.bind(os.path.join(run_dir, "router.sock"))
+        self.socket.listen(workers)
+        self.socket.setblocking(False)
+
+    def run(self, processes):
+        self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        while any(process.is_alive() for process in processes):
+            for key, mask in self.selector.select(1):
+                try:
+                    if isinstance(key.data, Connection):
+                        self.handle_event(key.data, mask)
+                    else:
+                        key.data()
+                except Exception:
+                    logging.exception("The shard router failed to handle an event.")
+
+    def accept(self):
+        link_socket, _ = self.socket.accept()
+        link_socket.setblocking(False)
+        link = Connection(self, link_socket, "worker")
+        link.decoder = FrameDecoder()
+        self.selector.register(link_socket, selectors.EVENT_READ, link)
+
+    def handle_event(self, link: Connection, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                received = link.decoder.recv_from(link.sock)
+            except (BlockingIOError, InterruptedError):
+                received = None
+            except OSError:
+                received = 0
+
+            if received == 0:
+                self.drop(link)
+                return
+            for opcode, fields in link.decoder.frames():
+                self.route(link, opcode, fields)
+
+        if mask & selectors.EVENT_WRITE and not link.closed:
+            self.flush(link)
+
+    def route(self, link: Connection, opcode, fields):
+        if opcode == ROUTE.REGISTER:
+            index = int(fields[0])
+            link.name = index
+            self.links[index] = link
+            while self.backlog[index]:
+                link.send(self.backlog[index].popleft())
+
+        elif opcode in (ROUTE.DELIVER, ROUTE.QUERY, ROUTE.REPLY):
+            self.send_to(int(fields[0]), encode_frame(opcode, *fields))
+
+        elif opcode == ROUTE.PRESENCE:
+            frame = encode_frame(opcode, *fields)
+            for index in range(self.workers):
+                if index != int(fields[0]):
+                    self.send_to(index, frame)
+
+    def send_to(self, index, frame):
+        link = self.links.get(index)
+        if link is None or link.closed:
+            self.backlog[index].append(frame)
+        else:
+            link.send(frame)
+
+    def want_write(self, link: Connection):
+        if link.closed or link.writing:
+            return
+        link.writing = True
+        self.selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, link)
+
+    def flush(self, link: Connection):
+        try:
+            while link.out_buffers:
+                consume_buffers(link.out_buffers, link.sock.sendmsg(list(islice(link.out_buffers, GATHER_LIMIT))))
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(link)
+            return
+
+        link.writing = False
+        self.selector.modify(link.sock, selectors.EVENT_READ, link)
+
+    def drop(self, link: Connection):
+        if link.closed:
+            return
+        link.closed = True
+        if self.links.get(link.name) is link:
+            del self.links[link.name]
+            logging.info(f"Shard worker {link.name} went away.")
+        self.selector.unregister(link.sock)
+        link.sock.close()
+
+
+class ShardWorker(EventServer):
+    def __init__(self, index, workers, tcp_addr, udp_addr, run_dir):
+        super().__init__(tcp_addr, udp_addr, reuse_port=True,
+                         history_dir=os.path.join(HISTORY_DIR, f"shard-{index}"))
+        self.index = index
+        self.workers = workers
+        self.run_dir = run_dir
+        self.link = None
+        self.known = OrderedDict()
+
+        self.fanout.router = self
+        self.presence.listeners.append(self.on_presence)
+
+        self.handoff_socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_DGRAM)
+        self.handoff_socket.bind(self.handoff_path(index))
+        self.handoff_socket.setblocking(False)
+
+    def handoff_path(self, index):
+        return os.path.join(self.run_dir, f"handoff-{index}.sock")
+
+    def start(self):
+        link_socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+        link_socket.connect(os.path.join(self.run_dir, "router.sock"))
+        link_socket.setblocking(False)
+        self.link = Connection(self, link_socket, "router")
+        self.link.state = "router"
+        self.link.decoder = FrameDecoder()
+        self.selector.register(link_socket, selectors.EVENT_READ, self.link)
+        self.link.send(encode_frame(ROUTE.REGISTER, str(self.index)))
+
+        self.selector.register(self.handoff_socket, selectors.EVENT_READ, self.read_handoff)
+        logging.info(f"Shard worker {self.index} of {self.workers} is up.")
+        super().start()
+
+    def is_local(self, name):
+        return owner_of(name, self.workers) == self.index
+
+    def forward(self, sender_name, receiver_names, message):
+        outcomes = {}
+        shards = {}
+        for receiver_name in receiver_names:
+            if is_channel(receiver_name):
+                shards.setdefault(owner_of(receiver_name, self.workers), []).append(receiver_name)
+                outcomes[receiver_name] = "sent"
+                continue
+            status = self.remote_status(receiver_name)
+            if status is None:
+                outcomes[receiver_name] = "missing"
+                continue
+            shards.setdefault(owner_of(receiver_name, self.workers), []).append(receiver_name)
+            outcomes[receiver_name] = "sent" if status == STATUS.AVAILABLE else "busy"
+
+        for shard, names in shards.items():
+            self.link.send(encode_frame(ROUTE.DELIVER, str(shard), ",".join(names), sender_name, message))
+        return outcomes
+
+    def remote_status(self, name):
+        status = self.presence.status_of(name)
+        if status is not None or not valid_name(name):
+            return status
+        if name in self.known:
+            self.known.move_to_end(name)
+            return self.known[name]
+
+        record = self.client_list.read_record(name)
+        status = None if record is None else record.get("status", STATUS.AVAILABLE)
+        self.known[name] = status
+        if len(self.known) > CLIENT_CACHE_SIZE:
+            self.known.popitem(last=False)
+        return status
+
+    def on_presence(self, name, status, remote):
+        self.known.pop(name, None)
+        if not remote and self.link is not None:
+            self.link.send(encode_frame(ROUTE.PRESENCE, str(self.index), name, status or ""))
+
+    def read_frames(self, conn: Connection):
+        if conn is not self.link:
+            super().read_frames(conn)
+            return
+
+        try:
+            received = conn.decoder.recv_from(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+
+        if received == 0:
+            self.disconnect(conn)
+            return
+        for opcode, fields in conn.decoder.frames():
+            self.handle_route(opcode, fields)
+
+    def handle_route(self, opcode, fields):
+        if opcode == ROUTE.DELIVER:
+            _, receiver_names, sender_name, message = fields
+            self.fanout.deliver(sender_name, receiver_names.split(","), message)
+
+        elif opcode == ROUTE.PRESENCE:
+            _, name, status = fields
+            self.presence.apply(name, status or None)
+
+        elif opcode == ROUTE.QUERY:
+            _, origin, name, rid, channel, since, limit = fields
+            page = self.channel_page(name, channel, int(since), int(limit))
+            self.link.send(encode_frame(ROUTE.REPLY, origin, name, rid, json.dumps(page)))
+
+        elif opcode == ROUTE.REPLY:
+            _, name, rid, page = fields
+            client = self.client_list.get(name)
+            if client is not None and client.active:
+                self.reply(client, OP.HISTORYPAGE, page, rid=int(rid) if rid else None)
+
+    def query_channel(self, client: Client, channel, since, limit, rid=None):
+        owner = owner_of(channel, self.workers)
+        if owner == self.index:
+            super().query_channel(client, channel, since, limit, rid)
+            return
+        self.link.send(encode_frame(ROUTE.QUERY, str(owner), str(self.index), client.login,
+                                    "" if rid is None else str(rid), channel, str(since), str(limit)))
+
+    def handle_data(self, conn: Connection, message):
+        if conn.state == "name":
+            owner = owner_of(parse_hello(message)[0], self.workers)
+            if owner != self.index:
+                self.hand_off(conn, message, owner)
+                return
+        super().handle_data(conn, message)
+
+    def hand_off(self, conn: Connection, hello, owner):
+        sender = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_DGRAM)
+        try:
+            sender.connect(self.handoff_path(owner))
+            socket.send_fds(sender, [hello.encode()], [conn.sock.fileno()])
+        except OSError:
+            logging.info(f"Couldn't hand a connection off to shard worker {owner}.")
+        finally:
+            sender.close()
+        conn.out_buffers.clear()
+        self.drop(conn)
+
+    def read_handoff(self):
+        while True:
+            try:
+                hello, fds, _, _ = socket.recv_fds(self.handoff_socket, 1024, 1)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            for fd in fds:
+                client_socket = socket.socket(fileno=fd)
+                client_socket.setblocking(False)
+                try:
+                    addr = client_socket.getpeername()
+                except OSError:
+                    client_socket.close()
+                    continue
+
+                conn = Connection(self, client_socket, addr)
+                self.connections[client_socket.fileno()] = conn
+                self.idle.schedule(conn, HANDSHAKE_TIMEOUT)
+                self.selector.register(client_socket, selectors.EVENT_READ, conn)
+                self.handle_data(conn, hello.decode(errors="replace"))
+
+    def disconnect(self, conn: Connection):
+        if conn is self.link:
+            logging.info(f"Shard worker {self.index} lost the router, shutting down.")
+            self.stop()
+            exit(0)
+        super().disconnect(conn)
+
+
+def run_worker(index, workers, tcp_addr, udp_addr, run_dir, inherited=()):
+    for fd in inherited:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    worker = ShardWorker(index, workers, tcp_addr, udp_addr, run_dir)
+    worker.start()
+
+
+class ShardedServer:
+    def __init__(self, tcp_addr, udp_addr, workers=SHARD_WORKERS):
+        self.workers = workers or os.cpu_count()
+
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        self.udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(tcp_addr)
+        self.udp_socket.bind(udp_addr)
+
+        ClientDirectory(Client, None)
+
+    def start(self):
+        run_dir = tempfile.mkdtemp(prefix="chatroom-shards-")
+        router = Router(run_dir, self.workers)
+        tcp_addr, udp_addr = self.socket.getsockname(), self.udp_socket.getsockname()
+
+        processes = []
+        inherited = (self.socket.fileno(), self.udp_socket.fileno())
+        for index in range(self.workers):
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(index, self.workers, tcp_addr, udp_addr, run_dir, inherited))
+            process.start()
+            processes.append(process)
+
+        self.socket.close()
+        self.udp_socket.close()
+        logging.info(f"Sharded server started with {self.workers} workers.")
+        try:
+            router.run(processes)
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+            logging.info("Server turned off.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    server = ShardedServer(SERVER_TCP_ADDR, SERVER_UDP_ADDR)
+    server.start()
@@ -0,0 +1,85 @@
+import pytest
+
+from codec import *
+
+
+def decode_all(data, **kwargs):
+    decoder = FrameDecoder(**kwargs)
+    decoder.feed(data)
+    return list(decoder.frames())
+
+
+def test_frame_round_trip():
+    data = encode_frame(OP.SENDTO, "bob", "hi\nthere") + encode_frame(OP.ALIVE) + encode_frame(OP.SETNAME, "alice")
+    assert decode_all(data) == [(OP.SENDTO, ["bob", "hi\nthere"]), (OP.ALIVE, []), (OP.SETNAME, ["alice"])]
+
+
+def test_last_field_keeps_separators():
+    assert decode_all(encode_frame(OP.SENDTO, "bob", "a\0b")) == [(OP.SENDTO, ["bob", "a\0b"])]
+
+
+def test_frame_split_across_reads():
+    data = encode_frame(OP.MSGFROM, "alice", "x" * 10000) * 3
+    decoder = FrameDecoder(size=16)
+    frames = []
+    for offset in range(0, len(data), 7):
+        decoder.feed(data[offset:offset + 7])
+        frames.extend(decoder.frames())
+    assert frames == [(OP.MSGFROM, ["alice", "x" * 10000])] * 3
+
+
+def test_tagged_round_trip():
+    decoder = FrameDecoder()
+    decoder.enable_tagging()
+    decoder.feed(encode_tagged(42, OP.LOG, "ok") + tag_frame(7, encode_frame(OP.HISTORY, "{}")))
+    assert decoder.next_frame() == (OP.LOG, ["ok"]) and decoder.rid == 42
+    assert decoder.next_frame() == (OP.HISTORY, ["{}"]) and decoder.rid == 7
+
+
+def test_compressed_round_trip():
+    compressor = FrameCompressor(threshold=64)
+    data = encode_frame(OP.HISTORY, "y" * 5000) + encode_frame(OP.LOG, "short")
+    compressed = compressor.compress_frames(data)
+    assert len(compressed) < len(data)
+
+    decoder = FrameDecoder()
+    decoder.enable_decompression()
+    decoder.feed(compressed)
+    assert list(decoder.frames()) == [(OP.HISTORY, ["y" * 5000]), (OP.LOG, ["short"])]
+
+
+def test_oversized_frame_is_refused():
+    with pytest.raises(ProtocolError):
+        decode_all(encode_frame(OP.LOG, "z" * 100), max_frame=64)
+
+
+def test_compressed_frame_cannot_inflate_past_limit():
+    compressed = FrameCompressor(threshold=0).compress_frames(encode_frame(OP.LOG, "z" * 10000))
+    decoder = FrameDecoder(max_frame=1000)
+    decoder.enable_decompression()
+    decoder.feed(compressed)
+    with pytest.raises(ProtocolError):
+        decoder.next_frame()
+
+
+@pytest.mark.parametrize("opcode, payload", [
+    (OP.SENDTO, b"bob"),
+    (OP.ALIVE, b"extra"),
+    (OP.LOG, b"\xff\xfe"),
+])
+def test_malformed_fields(opcode, payload):
+    with pytest.raises(ProtocolError):
+        decode_fields(opcode, payload)
+
+
+def test_legacy_round_trip():
+    for opcode, fields in [(OP.SENDTO, ["bob", "hi there"]), (OP.SETSTATUS, ["Busy"]),
+                           (OP.QUERYHISTORY, ["bob", "10", "50"]), (OP.GETHISTORY, [])]:
+        assert parse_legacy(encode_legacy(opcode, *fields).decode()) == (opcode, fields)
+    assert parse_legacy("nonsense") == (None, [])
+
+
+def test_encode_picks_the_wire_format():
+    assert encode(False, OP.LOG, "ok") == b"log:ok"
+    assert decode_all(encode(True, OP.LOG, "ok")) == [(OP.LOG, ["ok"])]
+    assert encode(True, OP.LOG, "ok", rid=3) == encode_tagged(3, OP.LOG, "ok")
@@ -0,0 +1,92 @@
+import os
+
+from history import HistoryStore, RECORD_HEADER, INDEX_ENTRY
+
+
+def fill(store, count):
+    for number in range(count):
+        store.append("alice", "bob", f"m{number}")
+        store.append("bob", "alice", f"m{number}")
+
+
+def messages(store, owner, peer=None):
+    return [item["msg"] for item in store.query(owner, peer, limit=1000)["messages"]]
+
+
+def test_reopen_keeps_history(tmp_path):
+    store = HistoryStore(str(tmp_path), segment_size=256)
+    fill(store, 20)
+    store.close()
+
+    store = HistoryStore(str(tmp_path), segment_size=256)
+    assert store.seq == 40
+    assert len(store.segments) > 1
+    assert messages(store, "alice", "bob") == [f"m{number}" for number in range(20)]
+    assert store.conversations("bob") == {"alice": [f"m{number}" for number in range(20)]}
+    store.close()
+
+
+def test_torn_tail_is_truncated_on_recovery(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    fill(store, 5)
+    path = store.segment_path(store.active_number)
+    store.close()
+    valid = os.path.getsize(path)
+
+    with open(path, "ab") as file:
+        file.write(RECORD_HEADER.pack(500) + b'{"seq": 11, "owner": "ali')
+
+    store = HistoryStore(str(tmp_path))
+    assert os.path.getsize(path) == valid
+    assert store.seq == 10
+    assert store.append("alice", "bob", "after") == 11
+    assert messages(store, "alice", "bob") == [f"m{number}" for number in range(5)] + ["after"]
+    store.close()
+
+
+def test_torn_header_is_truncated_on_recovery(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    fill(store, 3)
+    path = store.segment_path(store.active_number)
+    store.close()
+    valid = os.path.getsize(path)
+
+    with open(path, "ab") as file:
+        file.write(b"\x00\x00")
+
+    store = HistoryStore(str(tmp_path))
+    assert os.path.getsize(path) == valid
+    assert store.append("bob", "alice", "after") == 7
+    assert messages(store, "bob") == ["m0", "m1", "m2", "after"]
+    store.close()
+
+
+def test_empty_trailing_segment_falls_back_to_previous(tmp_path):
+    store = HistoryStore(str(tmp_path), segment_size=256)
+    fill(store, 20)
+    last = store.segments[-1]
+    store.close()
+
+    with open(os.path.join(str(tmp_path), "segments", f"{last + 1:08d}.log"), "wb") as file:
+        file.write(b"\x00\x00\x00")
+
+    store = HistoryStore(str(tmp_path), segment_size=256)
+    assert store.seq == 40
+    assert store.append("alice", "bob", "after") == 41
+    assert messages(store, "alice", "bob")[-2:] == ["m19", "after"]
+    store.close()
+
+
+def test_partial_index_entry_is_ignored(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    fill(store, 3)
+    store.close()
+
+    with open(store.index_path("alice", "bob"), "ab") as file:
+        file.write(b"\x01" * (INDEX_ENTRY.size - 1))
+
+    store = HistoryStore(str(tmp_path))
+    assert messages(store, "alice", "bob") == ["m0", "m1", "m2"]
+    assert store.append("alice", "bob", "after") == 7
+    assert messages(store, "alice", "bob") == ["m0", "m1", "m2", "after"]
+    store.close()
@@ -0,0 +1,87 @@
+import os
+
+from mailboxes import Mailbox
+
+
+def fill(mailbox, name, count, start=0):
+    for number in range(start, start + count):
+        mailbox.store(name, "alice", f"m{number}")
+
+
+def test_peek_does_not_consume(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    fill(mailbox, "bob", 3)
+
+    first, _ = mailbox.peek("bob")
+    second, _ = mailbox.peek("bob")
+    assert first == second == [["alice", "m0"], ["alice", "m1"], ["alice", "m2"]]
+    assert mailbox.pending("bob") == 3
+    mailbox.close()
+
+
+def test_commit_advances_past_a_batch(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    fill(mailbox, "bob", 5)
+
+    records, cursor = mailbox.peek("bob", limit=2)
+    assert [message for _, message in records] == ["m0", "m1"]
+    mailbox.commit("bob", cursor)
+    assert mailbox.pending("bob") == 3
+
+    records, cursor = mailbox.peek("bob", limit=2)
+    assert [message for _, message in records] == ["m2", "m3"]
+    mailbox.close()
+
+
+def test_commit_of_everything_removes_the_box(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    fill(mailbox, "bob", 3)
+
+    mailbox.commit("bob", mailbox.peek("bob")[1])
+    assert mailbox.pending("bob") == 0
+    assert mailbox.peek("bob") == ([], None)
+    assert not os.path.exists(mailbox.path("bob"))
+    assert not os.path.exists(mailbox.offset_path("bob"))
+    assert mailbox.stats()["replayed"] == 3
+    mailbox.close()
+
+
+def test_messages_stored_after_peek_survive_commit(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    fill(mailbox, "bob", 2)
+
+    _, cursor = mailbox.peek("bob")
+    fill(mailbox, "bob", 2, start=2)
+    mailbox.commit("bob", cursor)
+
+    records, _ = mailbox.peek("bob")
+    assert [message for _, message in records] == ["m2", "m3"]
+    assert mailbox.pending("bob") == 2
+    mailbox.close()
+
+
+def test_committed_offset_survives_a_restart(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    fill(mailbox, "bob", 4)
+    mailbox.commit("bob", mailbox.peek("bob", limit=3)[1])
+    mailbox.close()
+
+    mailbox = Mailbox(str(tmp_path))
+    assert mailbox.pending("bob") == 1
+    assert mailbox.peek("bob")[0] == [["alice", "m3"]]
+    mailbox.close()
+
+
+def test_torn_record_is_skipped_but_consumed(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    fill(mailbox, "bob", 1)
+    mailbox.close()
+    with open(mailbox.path("bob"), "ab") as file:
+        file.write(b'["alice", "m\n')
+
+    mailbox = Mailbox(str(tmp_path))
+    records, cursor = mailbox.peek("bob")
+    assert records == [["alice", "m0"]]
+    mailbox.commit("bob", cursor)
+    assert mailbox.pending("bob") == 0
+    mailbox.close()
@@ -0,0 +1,141 @@
+from threading import Thread
+from time import sleep
+import socket
+
+import pytest
+
+from codec import *
+from fanout import Envelope, Batch
+from sessions import Session
+from server import Server
+from event_server import EventServer
+from bench_common import BenchClient
+
+
+RESUME_FEATURES = [FEATURE_FRAMED, FEATURE_RID, FEATURE_RESUME]
+
+
+class SessionClient(BenchClient):
+    def __init__(self, addr, name, features=RESUME_FEATURES):
+        super().__init__(addr, name, features=features)
+        self.decoder.enable_tagging()
+        session = parse_session(self.features)
+        self.token = session[0] if session is not None else None
+
+    def handshake(self, addr, features, password):
+        self.socket = socket.create_connection(addr)
+        self.socket.recv(1024)
+        self.socket.send(make_hello(self.name, features).encode())
+        reply = self.socket.recv(1024)
+        if reply == b"?pass":
+            self.socket.send(password.encode())
+            reply = self.socket.recv(1024)
+        reply, pending = split_reply(reply)
+        self.decoder.feed(pending)
+        return reply
+
+    def messages(self, count):
+        self.socket.settimeout(5)
+        received = []
+        while len(received) < count:
+            _, (_, message) = self.receive(OP.MSGFROM)
+            received.append((self.decoder.rid, message))
+        return received
+
+
+def decode_tail(frames):
+    decoder = FrameDecoder()
+    decoder.enable_tagging()
+    decoder.feed(b"".join(frames))
+    return [(decoder.rid, fields) for _, fields in decoder.frames()]
+
+
+def test_session_tracks_and_acks():
+    session = Session()
+    session.track(Envelope(OP.MSGFROM, "alice", "m1"))
+    session.track(Batch([Envelope(OP.MSGFROM, "alice", "m2"), Envelope(OP.MSGFROM, "alice", "m3")]))
+    assert session.seq == 3 and len(session) == 3
+
+    session.ack(1)
+    assert decode_tail(session.tail()) == [(2, ["alice", "m2"]), (3, ["alice", "m3"])]
+    session.ack(3)
+    assert session.tail() == []
+
+
+def test_session_resumable_window():
+    session = Session(limit=2)
+    for number in range(5):
+        session.track(Envelope(OP.MSGFROM, "alice", f"m{number}"))
+
+    assert session.floor == 3
+    assert session.resumable(session.token, 3) and session.resumable(session.token, 5)
+    assert not session.resumable(session.token, 2)
+    assert not session.resumable(session.token, 6)
+    assert not session.resumable("forged", 4)
+
+    session.suspend(window=-1)
+    assert not session.resumable(session.token, 4)
+
+
+@pytest.fixture(params=[Server, EventServer])
+def server(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = request.param(("127.0.0.1", 0), ("127.0.0.1", 0))
+    server_thread = Thread(target=server.start)
+    server_thread.daemon = True
+    server_thread.start()
+    sleep(0.2)
+    yield server
+    server.stop()
+
+
+def send_all(sender, receiver, messages):
+    for message in messages:
+        sender.send(OP.SENDTO, receiver, message)
+        sender.receive(OP.LOG)
+
+
+def test_superseded_connection_hands_delivery_to_the_new_one(server):
+    addr = server.socket.getsockname()
+    sender = BenchClient(addr, "sender")
+    old = SessionClient(addr, "bob", features=[FEATURE_FRAMED])
+    new = SessionClient(addr, "bob", features=[FEATURE_FRAMED])
+    sleep(0.1)
+
+    send_all(sender, "bob", [f"m{number}" for number in range(20)])
+    assert [message for _, message in new.messages(20)] == [f"m{number}" for number in range(20)]
+    old.socket.close()
+    new.close()
+    sender.close()
+
+
+def test_resume_resends_the_unacknowledged_tail(server):
+    addr = server.socket.getsockname()
+    sender = BenchClient(addr, "sender")
+    bob = SessionClient(addr, "bob")
+    assert bob.token is not None
+
+    send_all(sender, "bob", ["m0", "m1", "m2", "m3"])
+    assert bob.messages(4) == [(1, "m0"), (2, "m1"), (3, "m2"), (4, "m3")]
+    bob.socket.shutdown(socket.SHUT_RDWR)
+    bob.socket.close()
+    sleep(0.3)
+
+    send_all(sender, "bob", ["m4", "m5"])
+    resumed = SessionClient(addr, "bob", features=[*RESUME_FEATURES, make_session(bob.token, 2)])
+    assert RESUMED in resumed.features
+    assert resumed.messages(4) == [(3, "m2"), (4, "m3"), (5, "m4"), (6, "m5")]
+    resumed.close()
+    sender.close()
+
+
+def test_forged_token_falls_back_to_a_fresh_login(server):
+    addr = server.socket.getsockname()
+    bob = SessionClient(addr, "bob")
+    bob.socket.close()
+    sleep(0.3)
+
+    fresh = SessionClient(addr, "bob", features=[*RESUME_FEATURES, make_session("forged", 0)])
+    assert RESUMED not in fresh.features
+    assert fresh.token not in (None, bob.token)
+    fresh.close()
@@ -0,0 +1,57 @@
+from threading import Lock
+from time import monotonic
+
+from config import *
+
+
+class TimerWheel:
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.deadlines = {}
+        self.lock = Lock()
+        self.current = int(monotonic() / tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def insert(self, key, deadline):
+        tick = max(int(deadline / self.tick), self.current + 1)
+        self.slots[tick % len(self.slots)].append(key)
+
+    def schedule(self, key, timeout):
+        deadline = monotonic() + timeout
+        with self.lock:
+            self.deadlines[key] = deadline
+            self.insert(key, deadline)
+
+    def touch(self, key, timeout):
+        deadline = monotonic() + timeout
+        with self.lock:
+            if key in self.deadlines:
+                self.deadlines[key] = deadline
+
+    def cancel(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def expired(self, now=None):
+        now = monotonic() if now is None else now
+        target = int(now / self.tick)
+        expired = []
+        with self.lock:
+            self.current = max(self.current, target - len(self.slots) + 1)
+            while self.current <= target:
+                index = self.current % len(self.slots)
+                slot, self.slots[index] = self.slots[index], []
+                for key in slot:
+                    deadline = self.deadlines.get(key)
+                    if deadline is None:
+                        continue
+                    if deadline <= now:
+                        del self.deadlines[key]
+                        expired.append(key)
+                    else:
+                        self.insert(key, deadline)
+                self.current += 1
+        return expired
@@ -1,2 +1,4 @@
 SERVER_TCP_ADDR = ("127.0.0.1", 1234)
-SERVER_UDP_ADDR = ("127.0.0.1", 4321)
\ No newline at end of file
+SERVER_UDP_ADDR = ("127.0.0.1", 4321)
+STATS_SOCKET = "string_modifier_stats.sock"
+STATS_TIMEOUT = 2
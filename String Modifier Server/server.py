@@ -1,11 +1,14 @@
 from threading import Thread
+from time import perf_counter
 import socket
 import logging
+import os
 
 from config import *
+from metrics import Metrics
 
 class Server:
-    def __init__(self, tcp_addr, udp_addr):
+    def __init__(self, tcp_addr, udp_addr, stats_path=STATS_SOCKET):
         self.tcp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
         self.tcp_socket.bind(tcp_addr)
 
@@ -14,15 +17,27 @@ class Server:
         self.udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self.udp_socket.bind(udp_addr)
 
+        self.metrics = Metrics(prefix="string_modifier")
+        self.metrics.gauge("tcp_clients", lambda: len(self.tcp_clients))
+
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+        self.stats_path = stats_path
+        self.stats_socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+        self.stats_socket.bind(stats_path)
+
     def start(self):
         tcp_handler = Thread(target=self.handle_tcp)
         udp_handler = Thread(target=self.handle_udp)
+        stats_handler = Thread(target=self.handle_stats)
 
         tcp_handler.daemon = True
         udp_handler.daemon = True
+        stats_handler.daemon = True
 
         tcp_handler.start()
         udp_handler.start()
+        stats_handler.start()
 
         try:
             tcp_handler.join()
@@ -33,11 +48,14 @@ class Server:
                 self.tcp_clients[client].close()
             self.tcp_socket.close()
             self.udp_socket.close()
+            self.stats_socket.close()
+            os.remove(self.stats_path)
 
     def handle_tcp(self):
         self.tcp_socket.listen(5)
         while True:
             client_socket, addr = self.tcp_socket.accept()
+            self.metrics.incr("tcp_connections")
             self.tcp_clients[hash(client_socket)] = client_socket
             logging.info(f"A TCP client connected to the server. Address: {addr}")
             client_handler = Thread(target=self.handle_client, args=[client_socket, addr])
@@ -47,7 +65,9 @@ class Server:
     def handle_client(self, client_socket: socket.socket, addr):
         while True:
             try:
-                string = client_socket.recv(1024).decode()
+                data = client_socket.recv(1024)
+                self.metrics.incr("bytes_in", len(data))
+                string = data.decode()
                 if string == "exit server":
                     logging.info(f"A client exited. Address: {addr}")
                     client_socket.close()
@@ -57,12 +77,15 @@ class Server:
                     client_socket.send(",N/A".encode())
                     continue
 
+                started = perf_counter()
                 codes_list = self.convert_string(string)
                 string = "," + self.find_largest_min_repeated(codes_list)
                 for code in reversed(codes_list):
                     string = str(code) + string
+                self.metrics.observe("tcp_request", perf_counter() - started)
+                self.metrics.incr("tcp_requests")
 
-                client_socket.send(string.encode())
+                self.metrics.incr("bytes_out", client_socket.send(string.encode()))
 
             except socket.error:
                 logging.info(f"A client disconnected. Address: {addr}")
@@ -73,9 +96,26 @@ class Server:
     def handle_udp(self):
         while True:
             data, addr = self.udp_socket.recvfrom(1024)
+            self.metrics.incr("bytes_in", len(data))
+            started = perf_counter()
             string = data.decode()
             most_repeated_char = self.find_max_repeated(string).upper()
-            self.udp_socket.sendto(f"{string[::-1].upper()},{most_repeated_char}".encode(), addr)
+            reply = f"{string[::-1].upper()},{most_repeated_char}".encode()
+            self.metrics.observe("udp_request", perf_counter() - started)
+            self.metrics.incr("udp_requests")
+            self.metrics.incr("bytes_out", self.udp_socket.sendto(reply, addr))
+
+    def handle_stats(self):
+        self.stats_socket.listen(5)
+        while True:
+            stats_client, _ = self.stats_socket.accept()
+            with stats_client:
+                try:
+                    stats_client.settimeout(STATS_TIMEOUT)
+                    fmt = stats_client.recv(64).decode(errors="replace").strip()
+                    stats_client.sendall(self.metrics.render(fmt).encode())
+                except OSError as error:
+                    logging.info(f"Couldn't answer a stats request: {error}")
 
     def find_max_repeated(self, string):
         if len(string) == 0: